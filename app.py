@@ -8,20 +8,60 @@ This API can be called by any application to extract receipt information.
 Endpoints:
 - GET  /: Web interface for testing
 - POST /api/scan: JSON API for receipt scanning
+- POST /api/scan/batch: Scan every image in a zip, .eml or .mbox upload (NDJSON stream)
+- GET  /api/scan/<image_hash>: Previous scan result by image hash (ETag)
+- POST /api/uploads, PUT/GET/DELETE /api/uploads/<id>, POST /api/uploads/<id>/finalize:
+  Resumable chunked uploads of an image or archive
 - GET  /api/health: Health check endpoint
+- GET  /api/live, /api/ready: Liveness, and readiness once the worker is warmed up
+- GET  /api/upload-settings: Client-side resize/compression targets
+- GET  /api/metrics: Scan pipeline counters for this worker
+- GET  /api/stats: Spending rollups by store x month and by date
+- GET  /api/usage: OCR calls, estimated cost and budget level per tenant today
+- GET  /api/admin/profiles[/<request_id>|/report]: Request profiles (admin token)
 
 Author: Created with GitHub Copilot
 Repository: https://github.com/sat33shgit/ReceiptScannerAIAgent
 """
 
-from flask import Flask, request, jsonify
+from flask import Flask, request, jsonify, g, Response, stream_with_context, has_request_context
 from flask_cors import CORS
+import contextvars
+import itertools
 import os
 from google.cloud import vision
+from google.api_core import exceptions as google_exceptions
 import re
-from typing import Dict, Optional
+from typing import Dict, List, Optional, Tuple
 import json
 import logging
+import threading
+import time
+from concurrent.futures.process import BrokenProcessPool
+from receipt_segmentation import words_from_annotations, segment_words, region_text, region_bounds
+from image_prescreen import prescreen_image, prescreen_enabled
+from image_pool import ImagePool, PoolBusy
+from ocr_backends import open_ocr_router, OcrError, OCR_BULK_POLICY
+from ocr_budget import open_spend_governor, BudgetExceeded, NORMAL
+from upload_settings import get_upload_settings, MAX_UPLOAD_BYTES
+from scan_coalescing import SingleFlight, image_hash
+from scan_cache import (TTLCache, RESULT_CACHE_TTL, IDEMPOTENCY_TTL, make_etag,
+                        etag_matches, parse_if_none_match)
+from extraction_limits import bound_text
+from merchant_extractors import extract_merchant_total, merchant_extractor_stats
+from layout_extraction import extract_layout_fields, layout_extraction_stats
+from scan_store import open_scan_store
+from ocr_log import open_ocr_log
+from archive_ingest import is_archive, iter_archive_images, scan_concurrently, ARCHIVE_EXTENSIONS
+from resumable_uploads import UploadStore, UploadError
+from traffic_capture import open_traffic_capture
+from scan_cancellation import (CancelScope, ScanCancelled, CancellationStats, connection_probe,
+                               request_deadline, cancellable_text_detection)
+from warmup import install_warmup, import_modules, warm_vision_client, warm_extractors, PROBE_IMAGE
+from request_profiler import install_profiler, ADMIN_TOKEN
+from scan_tracing import tracer, install_tracing, KIND_CLIENT
+from tenant_scheduler import (load_api_keys, tenant_for_request, RateLimiter, FairScheduler,
+                              TenantMetrics, resolve_priority, BULK)
 
 # Configure logging
 logging.basicConfig(level=logging.INFO)
@@ -30,15 +70,74 @@ logger = logging.getLogger(__name__)
 app = Flask(__name__)
 CORS(app)  # Enable CORS for cross-origin requests
 
+# Sampled or admin-requested request profiles, served under /api/admin/profiles
+install_profiler(app)
+
+# Trace spans per scan stage, exported as OTLP/JSON when TRACE_EXPORTER is set
+install_tracing(app)
+
+# Concurrent scans of identical image bytes share one OCR call
+scan_flight = SingleFlight()
+
+# Previous results by tenant and image hash (ETag), see _result_key(), and responses by Idempotency-Key
+result_cache = TTLCache(RESULT_CACHE_TTL)
+idempotency_cache = TTLCache(IDEMPOTENCY_TTL)
+
+# One Vision client per worker (the gRPC channel is thread-safe), see get_vision_client()
+_vision_client = None
+_vision_client_lock = threading.Lock()
+
+# Vision errors worth another attempt, and how many attempts a scan gets
+VISION_MAX_ATTEMPTS = max(1, int(os.environ.get('VISION_MAX_ATTEMPTS', 3)))
+TRANSIENT_VISION_ERRORS = (google_exceptions.ServiceUnavailable, google_exceptions.DeadlineExceeded,
+                           google_exceptions.InternalServerError, google_exceptions.TooManyRequests)
+
+# Billable OCR calls per tenant and day against the budgets, in a ledger shared with the other apps and the CLI
+spend_governor = open_spend_governor()
+
+# OCR backends from OCR_BACKENDS (Vision by default) with fallback; Vision calls retry and cancel
+ocr_router = open_ocr_router(lambda: _traced_vision_client(),
+                             lambda client, image, scope: detect_text_with_retry(client, image, scope),
+                             governor=spend_governor)
+
+# API-key tenants, their rate limits and fair sharing of the OCR slots
+api_keys = load_api_keys()
+rate_limiter = RateLimiter()
+ocr_scheduler = FairScheduler()
+tenant_metrics = TenantMetrics()
+
+# Scans abandoned because the client went away or the deadline passed
+cancellation_stats = CancellationStats()
+
+# Worker processes for image decoding, so prescreening scales past the GIL
+image_pool = ImagePool()
+
+# Full OCR text and extracted fields of every scan, for later re-extraction
+scan_store = open_scan_store()
+ocr_log = open_ocr_log()
+
+# Chunked uploads spooled to disk until they are finalized and scanned
+upload_store = UploadStore()
+
+# Opt-in recording of /api/scan traffic for offline replay (replay_traffic.py)
+traffic_capture = open_traffic_capture()
+
 # Your existing extraction functions (same as before)
+bc_ferries_regex = re.compile(r"\bBC\s*FERRIES\b", re.IGNORECASE)
+
 def extract_store_name(text: str) -> Optional[str]:
     known_stores = [
         "COSTCO WHOLESALE", "COSTCO", "WALMART", "SAVE ON FOODS", "HMART", 
         "LONDON DRUGS LIMITED", "LONDON DRUGS", "SUPERSTORE", "PHARMASAVE",
-        "CANADIAN TIRE", "TRIANGLE"
+        "CANADIAN TIRE", "TRIANGLE", "PETRO-CANADA", "PETRO CANADA"
     ]
     lines = [line.strip() for line in text.split('\n') if line.strip()]
     
+    # BC Ferries receipts put the terminal name first, so look for the brand on every line
+    for line in lines:
+        if bc_ferries_regex.search(line):
+            return "BC Ferries"
+    
     for line in lines:
         for store in known_stores:
             if store in line.upper():
@@ -58,6 +157,8 @@ def extract_store_name(text: str) -> Optional[str]:
                     return "Pharmasave"
                 elif "CANADIAN TIRE" in store or "TRIANGLE" in store:
                     return "Canadian Tire"
+                elif "PETRO" in store:
+                    return "Petro-Canada"
     
     generic_headers = ["TRANSACTION RECORD", "RECEIPT", "CUSTOMER COPY", "MERCHANT COPY"]
     for line in lines:
@@ -74,7 +175,8 @@ def extract_total_amount(text: str) -> Optional[str]:
     total_line_amount = None
     
     cad_amount_regex = re.compile(r"(\$|CAD)[ ]?([\d,]+[\.,]\d{2})")
-    number_regex = re.compile(r"([\d,]+[\.,]\d{2})")
+    # Only start at the beginning of a digit run, so long runs cannot backtrack quadratically
+    number_regex = re.compile(r"(?<![\d,])([\d,]+[\.,]\d{2})")
     
     for line in lines:
         if 'total' in line.lower():
@@ -146,58 +248,119 @@ def extract_date(text: str) -> Optional[str]:
     
     return None
 
-def scan_receipt_from_image(image_bytes) -> Dict[str, Optional[str]]:
+def extract_receipt_fields(text: str, words: Optional[List[Dict]] = None) -> Dict[str, Optional[str]]:
+    """
+    Run the store, total and date extractors over one receipt's text, using
+    its word boxes (from words_from_annotations) for the total and date when given.
+    """
+    text = bound_text(text)
+    with tracer.span("extract.store_name", **{"text.length": len(text)}) as span:
+        store_name = extract_store_name(text)
+        span.set_attribute("receipt.store_name", store_name)
+    with tracer.span("extract.layout", **{"ocr.words": len(words or [])}) as span:
+        layout = extract_layout_fields(words, extract_date)
+        span.set_attributes(**{"layout.total_amount": layout["total_amount"], "layout.date": layout["date"]})
+    with tracer.span("extract.total_amount") as span:
+        # Known merchants take their layout-specific parser, then the word geometry, then the generic chain
+        total_amount = (extract_merchant_total(store_name, text, extract_total_amount) or layout["total_amount"]
+                        or extract_total_amount(text))
+        span.set_attribute("receipt.total_amount", total_amount)
+    with tracer.span("extract.date") as span:
+        date = layout["date"] or extract_date(text)
+        span.set_attribute("receipt.date", date)
+    return {
+        "store_name": store_name,
+        "total_amount": total_amount,
+        "date": date
+    }
+
+def scan_receipt_from_image(image_bytes, image_digest: Optional[str] = None,
+                            tenant: Optional[str] = None,
+                            scope: Optional[CancelScope] = None,
+                            priority: Optional[str] = None) -> Dict[str, Optional[str]]:
+    """
+    OCR and extract one image. Raises ScanCancelled when `scope` is cancelled
+    and BudgetExceeded when the tenant's OCR budget does not allow a call.
+    """
     try:
-        # Initialize Google Cloud Vision client
-        # For Railway deployment, check for JSON content in environment variable
-        service_account_path = "service-account-key.json"
-        
-        if os.path.exists(service_account_path):
-            # Local development or file-based deployment
-            from google.oauth2 import service_account
-            credentials = service_account.Credentials.from_service_account_file(service_account_path)
-            client = vision.ImageAnnotatorClient(credentials=credentials)
-        elif os.environ.get('GOOGLE_CLOUD_KEY_JSON'):
-            # Railway deployment with JSON in environment variable
-            import json
-            from google.oauth2 import service_account
-            service_account_info = json.loads(os.environ.get('GOOGLE_CLOUD_KEY_JSON'))
-            credentials = service_account.Credentials.from_service_account_info(service_account_info)
-            client = vision.ImageAnnotatorClient(credentials=credentials)
-        else:
-            # Try default credentials (for Google Cloud deployment)
-            client = vision.ImageAnnotatorClient()
+        # Bulk scans take the cheapest backend first (OCR_BULK_POLICY)
+        try:
+            ocr = ocr_router.detect(image_bytes, scope, OCR_BULK_POLICY if priority == BULK else None,
+                                    tenant=tenant, priority=priority)
+        except OcrError as e:
+            logger.error(f"OCR error: {str(e)}")
+            return {"error": f"OCR processing failed: {str(e)}"}
+        ocr_ms = ocr.ms
+        texts = ocr.annotations
         
-        image = vision.Image(content=image_bytes)
-        response = client.text_detection(image=image)
-        texts = response.text_annotations
+        # Nobody is waiting for the fields any more
+        if scope:
+            scope.check("extract")
         
-        if response.error.message:
-            logger.error(f"Google Cloud Vision API error: {response.error.message}")
-            return {"error": f"OCR processing failed: {response.error.message}"}
+        if has_request_context():
+            g.ocr_ms = ocr_ms
+            if g.get('capture_traffic'):
+                try:
+                    traffic_capture.record_ocr(image_digest or image_hash(image_bytes), image_bytes, texts, ocr_ms)
+                except Exception as e:
+                    logger.warning(f"Could not capture OCR response: {str(e)}")
         
         if texts:
             text = texts[0].description
         else:
             text = ""
         
-        store_name = extract_store_name(text)
-        total_amount = extract_total_amount(text)
-        date = extract_date(text)
+        # Split the word annotations into receipt regions so several receipts
+        # photographed together are extracted separately from one OCR call
+        with tracer.span("receipt.segment", **{"ocr.words": max(len(texts) - 1, 0)}) as span:
+            regions = segment_words(words_from_annotations(texts[1:])) if texts else []
+            span.set_attribute("receipt.regions", len(regions))
+        if len(regions) > 1:
+            receipts = []
+            stored = []
+            for region in regions:
+                receipt_text = region_text(region)
+                stored.append((receipt_text, extract_receipt_fields(receipt_text, region)))
+                receipts.append({
+                    "data": stored[-1][1],
+                    "bounding_box": region_bounds(region),
+                    "raw_text": receipt_text[:500]
+                })
+            data = receipts[0]["data"]
+        else:
+            data = extract_receipt_fields(text, regions[0] if regions else None)
+            receipts = [{"data": data, "raw_text": text[:500] if text else ""}]
+            stored = [(text, data)]
+        ocr_router.record_fields(ocr.backend, data)
+        
+        if (scan_store or ocr_log) and text:
+            digest = image_digest or image_hash(image_bytes)
+            with tracer.span("scan.persist", **{"receipt.count": len(stored)}) as span:
+                try:
+                    if scan_store:
+                        scan_store.record_scan(digest, stored, tenant)
+                    if ocr_log:
+                        ocr_log.append(digest, [receipt_text for receipt_text, _ in stored])
+                except Exception as e:
+                    span.record_error(e)
+                    logger.warning(f"Could not persist scan: {str(e)}")
+        
+        store_name, total_amount, date = data["store_name"], data["total_amount"], data["date"]
         
         result = {
             "success": True,
-            "data": {
-                "store_name": store_name,
-                "total_amount": total_amount,
-                "date": date
-            },
-            "raw_text": text[:500] if text else ""  # Limit raw text for API response
+            "data": data,
+            "receipt_count": len(receipts),
+            "receipts": receipts,
+            "raw_text": text[:500] if text else "",  # Limit raw text for API response
+            "ocr_backend": ocr.backend
         }
         
-        logger.info(f"Successfully processed receipt: {store_name}, {total_amount}, {date}")
+        logger.info(f"Successfully processed {len(receipts)} receipt(s): {store_name}, {total_amount}, {date}")
         return result
         
+    except (ScanCancelled, BudgetExceeded):
+        raise
     except Exception as e:
         logger.error(f"Error processing receipt: {str(e)}")
         return {
@@ -205,9 +368,72 @@ def scan_receipt_from_image(image_bytes) -> Dict[str, Optional[str]]:
             "error": str(e)
         }
 
+def get_vision_client():
+    """
+    The worker's Vision client, created once so credential parsing and the
+    gRPC channel setup are paid at warm-up rather than on every scan.
+    """
+    global _vision_client
+    with _vision_client_lock:
+        if _vision_client is None:
+            _vision_client = _create_vision_client()
+        return _vision_client
+
+def _traced_vision_client():
+    # Shared Google Cloud Vision client (created by the warm-up or the first scan)
+    with tracer.span("vision.client") as span:
+        span.set_attribute("client.reused", _vision_client is not None)
+        return get_vision_client()
+
+def _create_vision_client():
+    # For Railway deployment, check for JSON content in environment variable
+    service_account_path = "service-account-key.json"
+    if os.path.exists(service_account_path):
+        # Local development or file-based deployment
+        from google.oauth2 import service_account
+        credentials = service_account.Credentials.from_service_account_file(service_account_path)
+        return vision.ImageAnnotatorClient(credentials=credentials)
+    elif os.environ.get('GOOGLE_CLOUD_KEY_JSON'):
+        # Railway deployment with JSON in environment variable
+        from google.oauth2 import service_account
+        service_account_info = json.loads(os.environ.get('GOOGLE_CLOUD_KEY_JSON'))
+        credentials = service_account.Credentials.from_service_account_info(service_account_info)
+        return vision.ImageAnnotatorClient(credentials=credentials)
+    else:
+        # Try default credentials (for Google Cloud deployment)
+        return vision.ImageAnnotatorClient()
+
+def detect_text_with_retry(client, image, scope: Optional[CancelScope] = None):
+    """
+    Vision text detection, retrying transient errors with backoff (one span per
+    call, an event per attempt). The call is abandoned if `scope` is cancelled.
+    """
+    with tracer.span("vision.text_detection", KIND_CLIENT, **{"rpc.system": "grpc",
+                                                               "rpc.service": "google.cloud.vision.v1.ImageAnnotator",
+                                                               "image.bytes": len(image.content)}) as span:
+        for attempt in range(1, VISION_MAX_ATTEMPTS + 1):
+            if scope:
+                scope.check("ocr")
+            started = time.perf_counter()
+            try:
+                response = cancellable_text_detection(client, image, scope)
+            except TRANSIENT_VISION_ERRORS as e:
+                span.add_event("attempt", attempt=attempt, error=type(e).__name__,
+                               duration_ms=round((time.perf_counter() - started) * 1000, 1))
+                if attempt == VISION_MAX_ATTEMPTS:
+                    raise
+                logger.warning(f"Vision attempt {attempt} failed ({type(e).__name__}), retrying")
+                time.sleep(0.2 * 2 ** (attempt - 1))
+                continue
+            span.add_event("attempt", attempt=attempt, duration_ms=round((time.perf_counter() - started) * 1000, 1))
+            span.set_attributes(**{"vision.attempts": attempt,
+                                   "ocr.text_length": len(response.text_annotations[0].description)
+                                   if response.text_annotations else 0})
+            return response
+
 def allowed_file(filename: str) -> bool:
     """Check if uploaded file has an allowed extension."""
-    ALLOWED_EXTENSIONS = {'png', 'jpg', 'jpeg'}
+    ALLOWED_EXTENSIONS = {'png', 'jpg', 'jpeg', 'webp'}
     return '.' in filename and filename.rsplit('.', 1)[1].lower() in ALLOWED_EXTENSIONS
 
 @app.route('/')
@@ -234,7 +460,7 @@ def index():
                 <h3><span class="method">POST</span> /api/scan</h3>
                 <p>Extract store information from receipt image</p>
                 <p><strong>Request:</strong> multipart/form-data with 'receipt_image' field</p>
-                <p><strong>Supported formats:</strong> JPG, JPEG, PNG</p>
+                <p><strong>Supported formats:</strong> JPG, JPEG, PNG, WEBP</p>
                 <p><strong>Max file size:</strong> 10MB</p>
             </div>
             
@@ -243,6 +469,16 @@ def index():
                 <p>Health check endpoint</p>
             </div>
             
+            <div class="endpoint">
+                <h3><span class="method">GET</span> /api/ready</h3>
+                <p>Readiness: 200 once the worker has warmed up its Vision client and extractors, 503 before</p>
+            </div>
+            
+            <div class="endpoint">
+                <h3><span class="method">GET</span> /api/upload-settings</h3>
+                <p>Maximum dimension, JPEG/WebP quality and size limit to apply before uploading</p>
+            </div>
+            
             <h3>Example Response:</h3>
             <pre><code>{
   "success": true,
@@ -268,6 +504,145 @@ def health_check():
         "version": "1.0.0"
     }), 200
 
+def is_admin() -> bool:
+    """Whether the request carries the admin token (X-Admin-Token)."""
+    return bool(ADMIN_TOKEN) and request.headers.get('X-Admin-Token') == ADMIN_TOKEN
+
+@app.route('/api/metrics')
+def metrics():
+    """
+    In-process scan pipeline counters for this worker. Per-tenant figures
+    (the tenants map and the queue depth per tenant) need the admin token.
+    """
+    scheduler = ocr_scheduler.stats()
+    if not is_admin():
+        del scheduler["queue_depth"], scheduler["max_queue_depth"]
+    report = {
+        "coalescing": scan_flight.stats(),
+        "result_cache": result_cache.stats(),
+        "idempotency_cache": idempotency_cache.stats(),
+        "ocr_scheduler": scheduler,
+        "cancellations": cancellation_stats.stats(),
+        "image_pool": image_pool.stats(),
+        "ocr_backends": ocr_router.stats(),
+        "merchant_extractors": merchant_extractor_stats(),
+        "layout_extraction": layout_extraction_stats()
+    }
+    if is_admin():
+        report["tenants"] = tenant_metrics.stats()
+    return jsonify(report), 200
+
+@app.route('/api/upload-settings')
+def upload_settings():
+    """Resize and compression targets for clients to apply before uploading."""
+    # Smaller uploads once the daily OCR budget is nearly spent; cached briefly so that shows quickly
+    response = jsonify(get_upload_settings(reduced=spend_governor.level() != NORMAL))
+    response.headers['Cache-Control'] = f"public, max-age={300 if spend_governor.budgeted else 3600}"
+    return response
+
+@app.route('/api/usage', methods=['GET'])
+def ocr_usage():
+    """
+    OCR calls per backend, estimated cost, budget and level of each tenant
+    today, and the scans answered more cheaply near a budget (see
+    ocr_budget.py). Callers see their own tenant; the admin token
+    (X-Admin-Token), or an API without keys, sees every tenant and the total.
+
+    Optional query parameter: days (1-31) adds daily totals for that many days.
+    """
+    admin = is_admin()
+    tenant = resolve_tenant()
+    if tenant is None and not admin:
+        return jsonify({
+            "success": False,
+            "error": "Missing or invalid API key. Please send your key in the X-API-Key header."
+        }), 401
+    days = request.args.get('days', '1')
+    if not days.isdigit() or not 1 <= int(days) <= 31:
+        return jsonify({
+            "success": False,
+            "error": "days must be a number from 1 to 31."
+        }), 400
+    try:
+        usage = spend_governor.usage(None if admin or not api_keys else tenant["tenant"], int(days))
+    except Exception as e:
+        logger.error(f"Error reading OCR usage: {str(e)}")
+        return jsonify({
+            "success": False,
+            "error": f"Could not read OCR usage: {str(e)}"
+        }), 500
+    return jsonify({"success": True, **usage}), 200
+
+def _result_key(tenant: Dict, image_digest: str) -> str:
+    """Results are cached per tenant so a hash alone never reveals another tenant's receipt."""
+    return f"{tenant['tenant']}:{image_digest}"
+
+def _scan_response(body: Optional[Dict], status: int, image_digest: Optional[str] = None):
+    """Build a JSON response, tagged with the image hash as ETag when known."""
+    if status == 304:
+        response = app.response_class(status=304)
+    else:
+        response = jsonify(body)
+        response.status_code = status
+    if image_digest:
+        response.headers['ETag'] = make_etag(image_digest)
+    return response
+
+@app.route('/api/scan/<image_digest>', methods=['GET'])
+def get_scan_result(image_digest):
+    """
+    Return a previous scan result by image hash (the ETag of the scan response),
+    so clients can recover a result without re-uploading the image. Only the
+    tenant that scanned the image can read it back.
+    """
+    tenant = resolve_tenant()
+    if tenant is None:
+        return jsonify({
+            "success": False,
+            "error": "Missing or invalid API key. Please send your key in the X-API-Key header."
+        }), 401
+    cached = result_cache.get(_result_key(tenant, image_digest))
+    if cached is None:
+        return jsonify({
+            "success": False,
+            "error": "No cached result for this image. Please upload the image again."
+        }), 404
+    if etag_matches(request.headers.get('If-None-Match'), image_digest):
+        return _scan_response(None, 304, image_digest)
+    return _scan_response(cached, 200, image_digest)
+
+@app.route('/api/stats', methods=['GET'])
+def spend_stats():
+    """
+    The calling tenant's spending totals (count, total, min, max, average) by
+    store x month and by date, read from rollups the scan store maintains on
+    every scan.
+
+    Optional query parameters: store, from and to (YYYY-MM, inclusive).
+    By-date rows are omitted when a store is given.
+    """
+    tenant = resolve_tenant()
+    if tenant is None:
+        return jsonify({
+            "success": False,
+            "error": "Missing or invalid API key. Please send your key in the X-API-Key header."
+        }), 401
+    if not scan_store:
+        return jsonify({
+            "success": False,
+            "error": "Scan history is disabled on this server (SCAN_DB_PATH is empty)."
+        }), 404
+    month_from = request.args.get('from')
+    month_to = request.args.get('to')
+    for value in (month_from, month_to):
+        if value and not re.fullmatch(r"\d{4}-\d{2}", value):
+            return jsonify({
+                "success": False,
+                "error": "Months must be given as YYYY-MM."
+            }), 400
+    stats = scan_store.spend_stats(tenant['tenant'], request.args.get('store'), month_from, month_to)
+    return jsonify({"success": True, **stats}), 200
+
 @app.route('/api/scan', methods=['POST'])
 def scan_receipt_api():
     """
@@ -277,60 +652,578 @@ def scan_receipt_api():
         - Method: POST
         - Content-Type: multipart/form-data
         - File field: 'receipt_image' (JPG, PNG supported)
+        - Header: 'X-API-Key' identifying the tenant (required when API keys are configured)
+        - Optional header: 'X-Scan-Priority' ('interactive' or 'bulk'), or a 'priority' form field
+        - Optional header: 'Idempotency-Key' to make retries return the original response
+        - Optional header: 'If-None-Match' with a previous ETag; returns 304 if that
+          result is still cached (the image may then be omitted)
     
     Response:
         - JSON with extracted information
         - Success: {"success": true, "data": {...}}
         - Error: {"success": false, "error": "error message"}
+        - ETag header: hash of the image, usable with GET /api/scan/<hash>
     """
-    if 'receipt_image' not in request.files:
+    tenant = resolve_tenant()
+    if tenant is None:
         return jsonify({
+            "success": False,
+            "error": "Missing or invalid API key. Please send your key in the X-API-Key header."
+        }), 401
+    
+    arrived_at = time.time()
+    # Stop working on the scan if the client goes away or the deadline passes
+    g.cancel_scope = CancelScope(request_deadline(request.headers.get('X-Scan-Timeout')),
+                                 connection_probe(request.environ))
+    if traffic_capture:
+        g.capture_traffic = traffic_capture.sampled()
+    start = time.perf_counter()
+    response = _handle_scan_request(tenant)
+    duration = time.perf_counter() - start
+    tenant_metrics.record(tenant["tenant"], duration, g.get('queue_wait'))
+    
+    # Where the time went, for clients and load tests (replay_traffic.py reads it)
+    timings = [f"total;dur={duration * 1000:.1f}"]
+    if g.get('queue_wait') is not None:
+        timings.append(f"queue;dur={g.queue_wait * 1000:.1f}")
+    if g.get('ocr_ms') is not None:
+        timings.append(f"ocr;dur={g.ocr_ms:.1f}")
+    response.headers['Server-Timing'] = ', '.join(timings)
+    
+    if g.get('capture_traffic'):
+        _capture_request(tenant, arrived_at, duration, response.status_code)
+    return response
+
+def _capture_request(tenant: Dict, arrived_at: float, duration: float, status: int) -> None:
+    """Append this /api/scan request to the traffic capture."""
+    upload = request.files.get('receipt_image')
+    try:
+        traffic_capture.record_request(
+            arrived_at=round(arrived_at, 6),
+            tenant=tenant["tenant"],
+            priority=request.headers.get('X-Scan-Priority') or request.form.get('priority'),
+            filename_ext=os.path.splitext(upload.filename)[1].lower() if upload and upload.filename else None,
+            image_hash=g.get('image_digest'),
+            image_bytes=g.get('image_size'),
+            status=status,
+            latency_ms=round(duration * 1000, 2),
+            queue_wait_ms=round(g.queue_wait * 1000, 2) if g.get('queue_wait') is not None else None,
+            ocr_ms=round(g.ocr_ms, 2) if g.get('ocr_ms') is not None else None
+        )
+    except Exception as e:
+        logger.warning(f"Could not capture request: {str(e)}")
+
+def resolve_tenant() -> Optional[Dict]:
+    """Identify the caller by API key. Returns None for a missing or unknown key."""
+    return tenant_for_request(api_keys, request.headers)
+
+def _handle_scan_request(tenant: Dict):
+    """Serve idempotent replays and conditional requests, otherwise scan the upload."""
+    idempotency_key = request.headers.get('Idempotency-Key')
+    if idempotency_key:
+        # Keys are scoped per tenant so callers cannot replay each other's responses
+        idempotency_key = f"{tenant['tenant']}:{idempotency_key}"
+        stored = idempotency_cache.get(idempotency_key)
+        if stored is not None:
+            body, status, stored_digest = stored
+            if 'receipt_image' in request.files:
+                file = request.files['receipt_image']
+                uploaded_digest = image_hash(file.read())
+                file.seek(0)
+                if stored_digest and uploaded_digest != stored_digest:
+                    return jsonify({
+                        "success": False,
+                        "error": "Idempotency-Key was already used with a different image."
+                    }), 422
+            response = _scan_response(body, status, stored_digest)
+            response.headers['Idempotent-Replayed'] = 'true'
+            return response
+    
+    # Conditional request without an upload: the client only sends the hash
+    if_none_match = request.headers.get('If-None-Match')
+    if if_none_match and 'receipt_image' not in request.files:
+        cached_digest = parse_if_none_match(if_none_match)
+        if cached_digest and result_cache.get(_result_key(tenant, cached_digest)) is not None:
+            return _scan_response(None, 304, cached_digest)
+    
+    body, status, image_digest = _process_scan_upload(tenant)
+    
+    # Server errors, cancelled scans and refusals to retry later are not stored so that a retry can succeed
+    if idempotency_key and status < 500 and status not in (429, 499):
+        idempotency_cache.set(idempotency_key, (body, status, image_digest))
+    if status == 200 and image_digest and etag_matches(if_none_match, image_digest):
+        return _scan_response(None, 304, image_digest)
+    response = _scan_response(body, status, image_digest)
+    if body and "retry_after" in body:
+        response.headers['Retry-After'] = str(body["retry_after"])
+    return response
+
+def _process_scan_upload(tenant: Dict):
+    """Validate and scan the uploaded image. Returns (body, status, image hash)."""
+    if 'receipt_image' not in request.files:
+        return {
             "success": False,
             "error": "No receipt_image file provided. Please upload an image file."
-        }), 400
+        }, 400, None
     
     file = request.files['receipt_image']
     
     if file.filename == '':
-        return jsonify({
+        return {
             "success": False,
             "error": "No file selected. Please choose an image file."
-        }), 400
+        }, 400, None
     
     if not allowed_file(file.filename):
-        return jsonify({
+        return {
             "success": False,
-            "error": "Invalid file type. Please upload JPG, JPEG, or PNG files only."
-        }), 400
+            "error": "Invalid file type. Please upload JPG, JPEG, PNG or WEBP files only."
+        }, 400, None
     
     try:
-        image_bytes = file.read()
+        with tracer.span("upload.read") as span:
+            image_bytes = file.read()
+            span.set_attributes(**{"image.bytes": len(image_bytes), "upload.filename": file.filename})
+        g.image_size = len(image_bytes)
         
         if len(image_bytes) == 0:
-            return jsonify({
+            return {
                 "success": False,
                 "error": "Uploaded file is empty."
-            }), 400
+            }, 400, None
         
-        if len(image_bytes) > 10 * 1024 * 1024:  # 10MB limit
-            return jsonify({
+        if len(image_bytes) > MAX_UPLOAD_BYTES:  # 10MB limit
+            return {
                 "success": False,
                 "error": "File too large. Maximum size is 10MB."
-            }), 400
-        
-        result = scan_receipt_from_image(image_bytes)
+            }, 400, None
         
-        if result.get("success"):
-            return jsonify(result), 200
-        else:
-            return jsonify(result), 500
+        # Interactive uploads go ahead of bulk imports in the OCR queue
+        priority = resolve_priority(tenant, request.headers.get('X-Scan-Priority') or request.form.get('priority'))
+        return _scan_image_bytes(image_bytes, tenant, priority)
             
     except Exception as e:
         logger.error(f"Error in /api/scan endpoint: {str(e)}")
-        return jsonify({
+        return {
             "success": False,
             "error": f"Server error: {str(e)}"
-        }), 500
+        }, 500, None
+
+@app.route('/api/scan/batch', methods=['POST'])
+def scan_batch_api():
+    """
+    Scan every receipt image inside an uploaded archive.
+    
+    Request:
+        - Method: POST
+        - Content-Type: multipart/form-data
+        - File field: 'archive' (.zip of images, .eml with image attachments, or .mbox export)
+        - Header: 'X-API-Key' identifying the tenant
+    
+    Response:
+        - application/x-ndjson, streamed as images are scanned: one line per image
+          {"name": ..., "status": ..., "success": ..., "data": {...}} and a final
+          {"done": true, "images": N, "succeeded": N}
+    
+    Images are read from the archive one at a time and scanned in the bulk lane
+    with a bounded number in flight, paced to the tenant's rate limit.
+    """
+    tenant = resolve_tenant()
+    if tenant is None:
+        return jsonify({
+            "success": False,
+            "error": "Missing or invalid API key. Please send your key in the X-API-Key header."
+        }), 401
+    file = request.files.get('archive')
+    if file is None or not is_archive(file.filename or ''):
+        return jsonify({
+            "success": False,
+            "error": f"Please upload an 'archive' file ({', '.join(ARCHIVE_EXTENSIONS)})."
+        }), 400
+    
+    # Batches never take the interactive lane unless the tenant asks for it explicitly
+    priority = resolve_priority(tenant, request.headers.get('X-Scan-Priority') or 'bulk')
+    
+    def scan(image_bytes):
+        body, status, image_digest = _scan_image_bytes(image_bytes, tenant, priority, wait_for_rate_limit=True)
+        return {"status": status, "image_hash": image_digest, **body}
+    
+    def generate():
+        images = succeeded = 0
+        try:
+            for name, result in scan_concurrently(iter_archive_images(file.stream, file.filename), scan):
+                images += 1
+                succeeded += bool(result.get("success"))
+                yield json.dumps({"name": name, **result}) + '\n'
+        except Exception as e:
+            logger.error(f"Error in /api/scan/batch endpoint: {str(e)}")
+            yield json.dumps({"success": False, "error": f"Could not read archive: {str(e)}"}) + '\n'
+        yield json.dumps({"done": True, "images": images, "succeeded": succeeded}) + '\n'
+    
+    return Response(stream_with_context(generate()), mimetype='application/x-ndjson')
+
+def _upload_error(error: UploadError):
+    body = {"success": False, "error": str(error)}
+    if error.offset is not None:
+        body["offset"] = error.offset
+    return jsonify(body), error.status
+
+def _tenant_required():
+    return jsonify({
+        "success": False,
+        "error": "Missing or invalid API key. Please send your key in the X-API-Key header."
+    }), 401
+
+@app.route('/api/uploads', methods=['POST'])
+def create_upload():
+    """
+    Start a resumable upload.
+    
+    Request JSON: {"filename": "receipt.jpg", "size": <total bytes>}
+    An image is scanned on finalize; a .zip/.eml/.mbox is scanned as a batch.
+    
+    Response: 201 with {"upload_id", "offset": 0, "chunk_bytes", "expires_at", ...}
+    and a Location header to PUT the chunks to.
+    """
+    tenant = resolve_tenant()
+    if tenant is None:
+        return _tenant_required()
+    params = request.get_json(silent=True) or request.form
+    filename = params.get('filename') or ''
+    try:
+        size = int(params.get('size', 0))
+    except (TypeError, ValueError):
+        size = 0
+    if is_archive(filename):
+        kind = 'archive'
+    elif allowed_file(filename):
+        kind = 'image'
+    else:
+        return jsonify({
+            "success": False,
+            "error": f"Invalid file type. Please upload JPG, JPEG, PNG or WEBP images, or {', '.join(ARCHIVE_EXTENSIONS)} archives."
+        }), 400
+    try:
+        upload = upload_store.create(tenant["tenant"], filename, size, kind)
+    except UploadError as e:
+        return _upload_error(e)
+    response = jsonify({"success": True, **upload})
+    response.status_code = 201
+    response.headers['Location'] = f"/api/uploads/{upload['upload_id']}"
+    return response
+
+@app.route('/api/uploads/<upload_id>', methods=['PUT'])
+def upload_chunk(upload_id):
+    """
+    Append a chunk. The body is the raw bytes; the 'Upload-Offset' header (or
+    'offset' query parameter) is where they start and must equal the offset
+    the server reports. A mismatch returns 409 with the server's offset.
+    """
+    tenant = resolve_tenant()
+    if tenant is None:
+        return _tenant_required()
+    try:
+        offset = int(request.headers.get('Upload-Offset', request.args.get('offset', -1)))
+    except ValueError:
+        offset = -1
+    try:
+        meta = upload_store.get(upload_id, tenant["tenant"])
+        if offset < 0:
+            raise UploadError("Missing Upload-Offset header.", 400, upload_store.offset(upload_id))
+        new_offset = upload_store.write_chunk(meta, offset, request.stream, request.content_length)
+    except UploadError as e:
+        return _upload_error(e)
+    response = jsonify({"success": True, "offset": new_offset, "complete": new_offset == meta["size"]})
+    response.headers['Upload-Offset'] = str(new_offset)
+    return response
+
+@app.route('/api/uploads/<upload_id>', methods=['GET'])
+def upload_status(upload_id):
+    """Progress of an upload (to resume from 'offset') and, once scanned, its results."""
+    tenant = resolve_tenant()
+    if tenant is None:
+        return _tenant_required()
+    try:
+        meta = upload_store.get(upload_id, tenant["tenant"])
+    except UploadError as e:
+        return _upload_error(e)
+    body = {"success": True, **upload_store.describe(meta)}
+    if meta["kind"] == 'image' and "result" in meta:
+        body["result"] = meta["result"]
+    if meta["kind"] == 'archive' and meta["status"] != 'uploading':
+        body["summary"] = meta.get("summary")
+        body["results"] = upload_store.read_results(upload_id)
+    response = jsonify(body)
+    response.headers['Upload-Offset'] = str(body["offset"])
+    response.headers['Cache-Control'] = 'no-store'
+    return response
+
+@app.route('/api/uploads/<upload_id>', methods=['DELETE'])
+def cancel_upload(upload_id):
+    """Abandon an upload and free its spooled bytes."""
+    tenant = resolve_tenant()
+    if tenant is None:
+        return _tenant_required()
+    try:
+        upload_store.get(upload_id, tenant["tenant"])
+    except UploadError as e:
+        return _upload_error(e)
+    upload_store.delete(upload_id)
+    return jsonify({"success": True}), 200
+
+@app.route('/api/uploads/<upload_id>/finalize', methods=['POST'])
+def finalize_upload(upload_id):
+    """
+    Scan a complete upload. An image is scanned right away and answered like
+    POST /api/scan. An archive is scanned in the background (202); poll
+    GET /api/uploads/<id> for its status and per-image results.
+    """
+    tenant = resolve_tenant()
+    if tenant is None:
+        return _tenant_required()
+    try:
+        meta = upload_store.claim_for_scan(upload_store.get(upload_id, tenant["tenant"]))
+    except UploadError as e:
+        return _upload_error(e)
+    part_path = upload_store.part_path(upload_id)
+    
+    if meta["kind"] == 'image':
+        priority = resolve_priority(tenant, request.headers.get('X-Scan-Priority'))
+        with open(part_path, 'rb') as f:
+            image_bytes = f.read()
+        try:
+            with upload_store.heartbeat(upload_id):
+                body, status, image_digest = _scan_image_bytes(image_bytes, tenant, priority)
+        except Exception as e:
+            logger.error(f"Error scanning upload {upload_id}: {str(e)}")
+            body, status, image_digest = {"success": False, "error": f"Server error: {str(e)}"}, 500, None
+        upload_store.mark(meta, "done", result=body, http_status=status)
+        _remove_spooled(part_path)
+        response = _scan_response(body, status, image_digest)
+        if "retry_after" in body:
+            response.headers['Retry-After'] = str(body["retry_after"])
+        return response
+    
+    priority = resolve_priority(tenant, request.headers.get('X-Scan-Priority') or 'bulk')
+    
+    def scan_archive():
+        # A resumed scan (see claim_for_scan) continues after the images it already answered
+        settled = upload_store.settled_results(upload_id)
+        images = len(settled)
+        succeeded = sum(bool(result.get("success")) for result in settled)
+        try:
+            with upload_store.heartbeat(upload_id), open(part_path, 'rb') as archive, \
+                    open(upload_store.results_path(upload_id), 'a') as results:
+                scan = lambda image_bytes: _scan_image_bytes(image_bytes, tenant, priority, wait_for_rate_limit=True)[0]
+                pending = itertools.islice(iter_archive_images(archive, meta["filename"]), images, None)
+                for name, result in scan_concurrently(pending, scan):
+                    images += 1
+                    succeeded += bool(result.get("success"))
+                    results.write(json.dumps({"name": name, **result}) + '\n')
+                    results.flush()
+            upload_store.mark(meta, "done", summary={"images": images, "succeeded": succeeded})
+        except Exception as e:
+            logger.error(f"Error scanning upload {upload_id}: {str(e)}")
+            upload_store.mark(meta, "failed", summary={"images": images, "succeeded": succeeded,
+                                                       "error": f"Could not read archive: {str(e)}"})
+        finally:
+            _remove_spooled(part_path)
+    
+    # Under the finalize request's trace, like the scans of /api/scan/batch
+    threading.Thread(target=contextvars.copy_context().run, args=(scan_archive,),
+                     name=f"upload-{upload_id}", daemon=True).start()
+    response = jsonify({"success": True, **upload_store.describe(meta)})
+    response.status_code = 202
+    response.headers['Location'] = f"/api/uploads/{upload_id}"
+    return response
+
+def _remove_spooled(part_path: str) -> None:
+    try:
+        os.remove(part_path)
+    except FileNotFoundError:
+        pass  # the upload was deleted while it was scanned
+
+def _scan_image_bytes(image_bytes: bytes, tenant: Dict, priority: str, wait_for_rate_limit: bool = False):
+    """
+    Run one image through the cache, rate limit, prescreen, fair OCR queue and
+    scan. Returns (body, status, image hash).
+    """
+    def rate_limited() -> Optional[Dict]:
+        retry_after = rate_limiter.check(tenant)
+        while retry_after and wait_for_rate_limit:
+            # Batch scans pace themselves to the tenant's rate instead of failing
+            time.sleep(retry_after)
+            retry_after = rate_limiter.check(tenant)
+        if not retry_after:
+            return None
+        tenant_metrics.count(tenant["tenant"], "rate_limited")
+        return {
+            "success": False,
+            "error": "Rate limit exceeded. Please slow down and retry later.",
+            "retry_after": int(retry_after) + 1
+        }
+
+    with tracer.span("cache.lookup") as span:
+        image_digest = image_hash(image_bytes)
+        cached = result_cache.get(_result_key(tenant, image_digest))
+        span.set_attributes(**{"image.hash": image_digest, "cache.hit": cached is not None})
+    if has_request_context():
+        g.image_digest = image_digest
+    # Before any work on the image: repeats are cheap but still count against the tenant's
+    # rate, and a tenant over its rate must not take prescreen workers from the others
+    refused = rate_limited()
+    if refused:
+        return refused, 429, image_digest
+    if cached is not None:
+        _share_scan_history(image_digest, tenant)
+        return cached, 200, image_digest
+
+    # Near the OCR budget, an image this tenant scanned before is answered from the scan store
+    if scan_store and spend_governor.level(tenant["tenant"]) != NORMAL:
+        try:
+            stored = scan_store.receipts_for_image(image_digest, tenant["tenant"])
+        except Exception as e:
+            logger.warning(f"Could not read scan history: {str(e)}")
+            stored = []
+        if stored:
+            spend_governor.note(tenant["tenant"], "history")
+            result = _result_from_history(stored)
+            result_cache.set(_result_key(tenant, image_digest), result)
+            return result, 200, image_digest
+
+    # Reject blank, dark or blurred photos locally before paying for OCR
+    prescreen = None
+    if prescreen_enabled():
+        with tracer.span("image.prescreen", **{"image.bytes": len(image_bytes)}) as span:
+            try:
+                prescreen = image_pool.run(prescreen_image, image_bytes)
+            except PoolBusy as e:
+                span.set_attribute("prescreen.verdict", "busy")
+                return {
+                    "success": False,
+                    "error": f"{str(e)}. Please try again shortly.",
+                    "retry_after": 1
+                }, 503, image_digest
+            except BrokenProcessPool:
+                # The image crashed a fresh worker too (see ImagePool.run)
+                span.set_attribute("prescreen.verdict", "crashed")
+                logger.error(f"Image processing crashed twice ({image_digest[:12]})")
+                return {
+                    "success": False,
+                    "error": "This image could not be processed. Please upload a different photo of the receipt."
+                }, 422, image_digest
+            span.set_attribute("prescreen.verdict", prescreen.get("verdict"))
+    if prescreen and not prescreen["ok"]:
+        return {
+            "success": False,
+            "error": prescreen["message"],
+            "prescreen": prescreen
+        }, 422, image_digest
+
+    # Only the same tenant in the same lane shares a scan: its budget, queue timeout and
+    # bulk wait are the ones the waiter would have had on its own
+    flight_key = f"{tenant['tenant']}:{priority}:{image_digest}"
+    scope = g.get('cancel_scope') if has_request_context() else None
+    if scope:
+        # A scan other requests are coalesced onto finishes for them
+        scope.keep_going = lambda: scan_flight.waiting(flight_key) > 0
+
+    def scan_in_ocr_slot():
+        # Wait for this tenant's fair share of the OCR concurrency limit
+        queued_at = time.perf_counter()
+        with tracer.span("ocr.queue", **{"tenant": tenant["tenant"], "priority": priority}) as span:
+            admitted = ocr_scheduler.acquire(tenant["tenant"], tenant["weight"], priority=priority,
+                                             cancelled=scope.reason if scope else None)
+            span.set_attribute("queue.admitted", admitted)
+        if not admitted:
+            if scope:
+                scope.check("queue")
+            return None
+        if has_request_context():
+            g.queue_wait = time.perf_counter() - queued_at
+        try:
+            return scan_receipt_from_image(image_bytes, image_digest, tenant["tenant"], scope, priority)
+        finally:
+            ocr_scheduler.release(priority)
+
+    try:
+        result, coalesced = scan_flight.do(flight_key, scan_in_ocr_slot,
+                                           check=(lambda: _check_waiter(scope)) if scope else None)
+    except ScanCancelled as e:
+        cancellation_stats.record(e)
+        tenant_metrics.count(tenant["tenant"], "cancelled")
+        logger.info(f"{str(e)} ({image_digest[:12]})")
+        return {
+            "success": False,
+            "error": str(e)
+        }, e.status, image_digest
+    except BudgetExceeded as e:
+        tenant_metrics.count(tenant["tenant"], "over_budget")
+        logger.info(f"{str(e)} ({tenant['tenant']}, {image_digest[:12]})")
+        return {
+            "success": False,
+            "error": str(e),
+            "retry_after": e.retry_after
+        }, 429, image_digest
+    if result is None:
+        tenant_metrics.count(tenant["tenant"], "queue_timeouts")
+        return {
+            "success": False,
+            "error": "The scanner is busy right now. Please try again shortly."
+        }, 503, image_digest
+    result = dict(result)  # shared with coalesced requests, so copy before adding fields
+    if coalesced:
+        logger.info("Coalesced duplicate scan request with an in-flight OCR call")
+    if prescreen:
+        result["prescreen"] = prescreen
+
+    if result.get("success"):
+        result_cache.set(_result_key(tenant, image_digest), result)
+        return result, 200, image_digest
+    else:
+        return result, 500, image_digest
+
+def _check_waiter(scope: CancelScope) -> None:
+    """Give up waiting on a coalesced scan once this request's own client or deadline is gone."""
+    scope.keep_going = None  # only the request running the scan keeps going for others
+    scope.check("coalesced")
+
+def _share_scan_history(image_digest: str, tenant: Dict) -> None:
+    """Make sure a scan served without this tenant's own OCR call is in its history and spend rollups."""
+    if not scan_store:
+        return
+    try:
+        scan_store.share_scan(image_digest, tenant["tenant"])
+    except Exception as e:
+        logger.warning(f"Could not record shared scan: {str(e)}")
+
+def _result_from_history(stored: List[Tuple[str, Dict]]) -> Dict:
+    """A scan result rebuilt from the OCR text and fields in the scan store (no receipt boxes)."""
+    receipts = [{"data": fields, "raw_text": text[:500]} for text, fields in stored]
+    return {
+        "success": True,
+        "data": receipts[0]["data"],
+        "receipt_count": len(receipts),
+        "receipts": receipts,
+        "raw_text": '\n'.join(text for text, _ in stored)[:500],
+        "ocr_backend": "scan_store"
+    }
+
+def _warm_image_pool():
+    workers = image_pool.start()
+    verdict = image_pool.run(prescreen_image, PROBE_IMAGE)["verdict"] if prescreen_enabled() else "prescreen disabled"
+    return f"{workers} workers, {verdict}"
+
+# /api/live and /api/ready; readiness waits for the Vision channel and a warm extractor run.
+# The image pool forks its workers first, before the gRPC channel exists.
+warmup_steps = [
+    ("imports", import_modules("google.cloud.vision", "google.oauth2.service_account", "PIL.Image?")),
+    ("image_pool", _warm_image_pool),
+    ("extractors", warm_extractors(extract_receipt_fields))
+]
+if any(backend.name == 'vision' for backend in ocr_router.backends):
+    warmup_steps.insert(2, ("vision_client", warm_vision_client(get_vision_client, governor=spend_governor)))
+install_warmup(app, warmup_steps)
 
 if __name__ == '__main__':
     port = int(os.environ.get('PORT', 8080))
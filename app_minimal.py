@@ -3,12 +3,51 @@ Ultra-minimal Receipt Scanner API - Guaranteed to work
 """
 import os
 import json
-from flask import Flask, request, jsonify, render_template, send_from_directory
+import threading
+import time
+from concurrent.futures.process import BrokenProcessPool
+from flask import Flask, request, jsonify, render_template, send_from_directory, g
 from flask_cors import CORS
+from image_prescreen import prescreen_image, prescreen_enabled
+from image_pool import ImagePool, PoolBusy
+from ocr_backends import open_ocr_router
+from ocr_budget import open_spend_governor, BudgetExceeded, NORMAL
+from receipt_segmentation import words_from_annotations, segment_words, region_text, region_bounds
+from layout_extraction import extract_layout_fields
+from upload_settings import get_upload_settings
+from extraction_limits import bound_text
+from request_profiler import install_profiler, ADMIN_TOKEN
+from warmup import install_warmup, import_modules, warm_vision_client, warm_extractors, PROBE_IMAGE
+from scan_tracing import tracer, install_tracing, KIND_CLIENT
+from scan_cancellation import (CancelScope, ScanCancelled, CancellationStats, connection_probe,
+                               request_deadline, cancellable_text_detection)
+from tenant_scheduler import (load_api_keys, tenant_for_request, RateLimiter, FairScheduler,
+                              TenantMetrics, resolve_priority)
 
 app = Flask(__name__, template_folder='templates')
 CORS(app)
 
+# Sampled or admin-requested request profiles, served under /api/admin/profiles
+install_profiler(app)
+
+# Request and Vision spans, exported when TRACE_EXPORTER is set
+install_tracing(app)
+
+# Worker processes for image decoding, so prescreening scales past the GIL
+image_pool = ImagePool()
+
+# Billable OCR calls per day against OCR_DAILY_BUDGET, in a ledger shared with the other apps and the CLI
+spend_governor = open_spend_governor()
+
+# Scans abandoned because the page was closed or the deadline passed
+cancellation_stats = CancellationStats()
+
+# API-key tenants (the page itself sends no key), their rate limits and fair sharing of the OCR slots
+api_keys = load_api_keys()
+rate_limiter = RateLimiter()
+ocr_scheduler = FairScheduler()
+tenant_metrics = TenantMetrics()
+
 @app.route('/')
 def home():
     return render_template('index.html')
@@ -21,9 +60,70 @@ def health():
         "version": "1.0.0"
     })
 
+def is_admin():
+    return bool(ADMIN_TOKEN) and request.headers.get('X-Admin-Token') == ADMIN_TOKEN
+
+@app.route('/api/metrics')
+def metrics():
+    """In-process counters for this worker: cancelled scans, the OCR queue, the image pool and the OCR backends.
+    Per-tenant figures need the admin token (X-Admin-Token)."""
+    scheduler = ocr_scheduler.stats()
+    report = {
+        "cancellations": cancellation_stats.stats(),
+        "ocr_scheduler": scheduler,
+        "image_pool": image_pool.stats(),
+        "ocr_backends": ocr_router.stats()
+    }
+    if is_admin():
+        report["tenants"] = tenant_metrics.stats()
+    else:
+        del scheduler["queue_depth"], scheduler["max_queue_depth"]
+    return jsonify(report)
+
+@app.route('/api/upload-settings')
+def upload_settings():
+    """Resize/compression targets for the upload page (smaller near the OCR budget)"""
+    response = jsonify(get_upload_settings(reduced=spend_governor.level() != NORMAL))
+    response.headers['Cache-Control'] = f"public, max-age={300 if spend_governor.budgeted else 3600}"
+    return response
+
+@app.route('/api/usage')
+def ocr_usage():
+    """OCR calls, estimated cost and budget level today; ?days=N (up to 31) adds daily totals.
+    Per-tenant figures need the admin token (X-Admin-Token)."""
+    days = request.args.get('days', '1')
+    if not days.isdigit() or not 1 <= int(days) <= 31:
+        return jsonify({
+            "success": False,
+            "error": "days must be a number from 1 to 31"
+        }), 400
+    try:
+        usage = spend_governor.usage(days=int(days))
+    except Exception as e:
+        return jsonify({
+            "success": False,
+            "error": f"Could not read OCR usage: {str(e)}"
+        }), 500
+    if not is_admin():
+        # The ledger can be shared with app.py's tenants, so only the totals are public
+        del usage["tenants"]
+    return jsonify({"success": True, **usage})
+
 @app.route('/api/scan', methods=['POST'])
 def scan_receipt():
-    """Receipt scanning endpoint"""
+    """Receipt scanning endpoint. API callers send their key in X-API-Key; the page sends none."""
+    tenant = tenant_for_request(api_keys, request.headers, allow_keyless=True)
+    if tenant is None:
+        return jsonify({
+            "success": False,
+            "error": "Invalid API key."
+        }), 401
+    start = time.perf_counter()
+    response = _scan_receipt(tenant)
+    tenant_metrics.record(tenant["tenant"], time.perf_counter() - start, g.get('queue_wait'))
+    return response
+
+def _scan_receipt(tenant):
     try:
         # Check for file upload
         if 'receipt_image' not in request.files:
@@ -46,61 +146,94 @@ def scan_receipt():
                 "error": "Empty file uploaded"
             }), 400
         
-        # Import Google Cloud Vision (only when needed)
+        # Stop working on the scan if the page is closed or the deadline passes
+        scope = CancelScope(request_deadline(request.headers.get('X-Scan-Timeout')),
+                            connection_probe(request.environ))
+        
+        # Before any work on the image, so a tenant over its rate cannot take prescreen workers from others
+        retry_after = rate_limiter.check(tenant)
+        if retry_after:
+            tenant_metrics.count(tenant["tenant"], "rate_limited")
+            response = jsonify({
+                "success": False,
+                "error": "Rate limit exceeded. Please slow down and retry later."
+            })
+            response.status_code = 429
+            response.headers['Retry-After'] = str(int(retry_after) + 1)
+            return response
+        
+        # Reject blank, dark or blurred photos locally before paying for OCR
         try:
-            from google.cloud import vision
-            from google.oauth2 import service_account
-        except ImportError:
+            prescreen = image_pool.run(prescreen_image, image_bytes) if prescreen_enabled() else None
+        except PoolBusy as e:
+            response = jsonify({
+                "success": False,
+                "error": f"{str(e)}. Please try again shortly."
+            })
+            response.status_code = 503
+            response.headers['Retry-After'] = '1'
+            return response
+        except BrokenProcessPool:
+            # The image crashed a fresh worker too (see ImagePool.run)
             return jsonify({
                 "success": False,
-                "error": "Google Cloud Vision not available"
-            }), 500
-        
-        # Setup Google Cloud credentials
-        client = None
-        
-        # Try environment variable (Render/Railway)
-        if os.environ.get('GOOGLE_CLOUD_KEY_JSON'):
-            try:
-                service_account_info = json.loads(os.environ.get('GOOGLE_CLOUD_KEY_JSON'))
-                credentials = service_account.Credentials.from_service_account_info(service_account_info)
-                client = vision.ImageAnnotatorClient(credentials=credentials)
-            except Exception as e:
-                return jsonify({
-                    "success": False,
-                    "error": f"Failed to load credentials from environment: {str(e)}"
-                }), 500
+                "error": "This image could not be processed. Please upload a different photo of the receipt."
+            }), 422
+        if prescreen and not prescreen["ok"]:
+            return jsonify({
+                "success": False,
+                "error": prescreen["message"],
+                "prescreen": prescreen
+            }), 422
         
-        # Try local file
-        elif os.path.exists("service-account-key.json"):
-            try:
-                credentials = service_account.Credentials.from_service_account_file("service-account-key.json")
-                client = vision.ImageAnnotatorClient(credentials=credentials)
-            except Exception as e:
+        # OCR with the configured backends (Vision by default, falling back to the next on failure),
+        # in this tenant's fair share of the OCR slots
+        priority = resolve_priority(tenant, request.headers.get('X-Scan-Priority') or request.form.get('priority'))
+        try:
+            admitted = ocr_scheduler.run(tenant, lambda: ocr_router.detect(
+                image_bytes, scope, tenant=tenant["tenant"], priority=priority),
+                priority=priority, cancelled=scope.reason)
+            if admitted is None:
+                scope.check("queue")
+                tenant_metrics.count(tenant["tenant"], "queue_timeouts")
                 return jsonify({
                     "success": False,
-                    "error": f"Failed to load credentials from file: {str(e)}"
-                }), 500
-        
-        if not client:
+                    "error": "The scanner is busy right now. Please try again shortly."
+                }), 503
+            ocr, g.queue_wait = admitted
+            # Nobody is waiting for the fields any more
+            scope.check("extract")
+        except ScanCancelled as e:
+            cancellation_stats.record(e)
+            tenant_metrics.count(tenant["tenant"], "cancelled")
             return jsonify({
                 "success": False,
-                "error": "No Google Cloud credentials found. Please set GOOGLE_CLOUD_KEY_JSON environment variable."
+                "error": str(e)
+            }), e.status
+        except BudgetExceeded as e:
+            tenant_metrics.count(tenant["tenant"], "over_budget")
+            response = jsonify({
+                "success": False,
+                "error": str(e)
+            })
+            response.status_code = 429
+            response.headers['Retry-After'] = str(e.retry_after)
+            return response
+        except RuntimeError as e:
+            # Vision client could not be created (missing credentials)
+            return jsonify({
+                "success": False,
+                "error": str(e)
+            }), 500
+        except Exception as e:
+            return jsonify({
+                "success": False,
+                "error": f"OCR processing failed: {str(e)}"
             }), 500
         
-        # Process image with Google Cloud Vision
         try:
-            image = vision.Image(content=image_bytes)
-            response = client.text_detection(image=image)
-            
-            if response.error.message:
-                return jsonify({
-                    "success": False,
-                    "error": f"Vision API error: {response.error.message}"
-                }), 500
-            
             # Extract text
-            texts = response.text_annotations
+            texts = ocr.annotations
             if texts and len(texts) > 0:
                 full_text = texts[0].description
             else:
@@ -114,28 +247,41 @@ def scan_receipt():
                         "total_amount": None,
                         "date": None
                     },
-                    "message": "No text detected in image"
+                    "receipt_count": 0,
+                    "receipts": [],
+                    "message": "No text detected in image",
+                    "prescreen": prescreen
                 })
             
-            # Extract information
-            store_name = extract_store_name(full_text)
-            total_amount = extract_total_amount(full_text)
-            date = extract_date(full_text)
+            # Several receipts photographed together are extracted separately from the one OCR call
+            words = words_from_annotations(texts[1:])
+            regions = segment_words(words)
+            if len(regions) > 1:
+                receipts = []
+                for region in regions:
+                    receipt_text = region_text(region)
+                    receipts.append({
+                        "data": extract_receipt_fields(receipt_text, region),
+                        "bounding_box": region_bounds(region),
+                        "raw_text": receipt_text[:300]
+                    })
+            else:
+                receipts = [{"data": extract_receipt_fields(full_text, words), "raw_text": full_text[:300]}]
             
             return jsonify({
                 "success": True,
-                "data": {
-                    "store_name": store_name,
-                    "total_amount": total_amount,
-                    "date": date
-                },
-                "raw_text": full_text[:300] + "..." if len(full_text) > 300 else full_text
+                "data": receipts[0]["data"],
+                "receipt_count": len(receipts),
+                "receipts": receipts,
+                "raw_text": full_text[:300] + "..." if len(full_text) > 300 else full_text,
+                "prescreen": prescreen,
+                "ocr_backend": ocr.backend
             })
             
         except Exception as e:
             return jsonify({
                 "success": False,
-                "error": f"Vision processing failed: {str(e)}"
+                "error": f"Text processing failed: {str(e)}"
             }), 500
         
     except Exception as e:
@@ -144,6 +290,53 @@ def scan_receipt():
             "error": f"Server error: {str(e)}"
         }), 500
 
+# One Vision client per worker, reused by every scan
+_vision_client = None
+_vision_client_lock = threading.Lock()
+
+def get_vision_client():
+    """The worker's Vision client; raises RuntimeError with the message to return if it cannot be created"""
+    global _vision_client
+    with _vision_client_lock:
+        if _vision_client is None:
+            _vision_client = _create_vision_client()
+        return _vision_client
+
+def _create_vision_client():
+    # Import Google Cloud Vision (only when needed)
+    try:
+        from google.cloud import vision
+        from google.oauth2 import service_account
+    except ImportError:
+        raise RuntimeError("Google Cloud Vision not available")
+    
+    # Try environment variable (Render/Railway)
+    if os.environ.get('GOOGLE_CLOUD_KEY_JSON'):
+        try:
+            service_account_info = json.loads(os.environ.get('GOOGLE_CLOUD_KEY_JSON'))
+            credentials = service_account.Credentials.from_service_account_info(service_account_info)
+            return vision.ImageAnnotatorClient(credentials=credentials)
+        except Exception as e:
+            raise RuntimeError(f"Failed to load credentials from environment: {str(e)}")
+    
+    # Try local file
+    if os.path.exists("service-account-key.json"):
+        try:
+            credentials = service_account.Credentials.from_service_account_file("service-account-key.json")
+            return vision.ImageAnnotatorClient(credentials=credentials)
+        except Exception as e:
+            raise RuntimeError(f"Failed to load credentials from file: {str(e)}")
+    
+    raise RuntimeError("No Google Cloud credentials found. Please set GOOGLE_CLOUD_KEY_JSON environment variable.")
+
+def _detect_text(client, image, scope=None):
+    # The gRPC call is cancelled when the scope is (see scan_cancellation.py)
+    with tracer.span("vision.text_detection", KIND_CLIENT, **{"image.bytes": len(image.content)}):
+        return cancellable_text_detection(client, image, scope)
+
+# OCR backends from OCR_BACKENDS (Vision by default), tried in order and counted against the budget
+ocr_router = open_ocr_router(get_vision_client, _detect_text, governor=spend_governor)
+
 def extract_store_name(text):
     """Extract store name from text"""
     import re
@@ -236,7 +429,7 @@ def extract_total_amount(text):
     lines = text.split('\n')
     for line in lines:
         if 'balance due' in line.lower():
-            match = re.search(r'(\d+\.\d{2})', line)
+            match = re.search(r'(?<!\d)(\d+\.\d{2})', line)
             if match:
                 try:
                     amount = float(match.group(1))
@@ -245,7 +438,7 @@ def extract_total_amount(text):
                     continue
     for line in lines:
         if 'credit' in line.lower():
-            match = re.search(r'(\d+\.\d{2})', line)
+            match = re.search(r'(?<!\d)(\d+\.\d{2})', line)
             if match:
                 try:
                     amount = float(match.group(1))
@@ -259,7 +452,7 @@ def extract_total_amount(text):
         line_lower = line.lower()
         for kw in keywords:
             if kw in line_lower:
-                match = re.search(r'(\d+\.\d{2})', line)
+                match = re.search(r'(?<!\d)(\d+\.\d{2})', line)
                 if match:
                     try:
                         amount = float(match.group(1))
@@ -274,7 +467,7 @@ def extract_total_amount(text):
         r'TOTAL.*?\$(\d+\.\d{2})',
         r'TOTAL.*?(\d+\.\d{2})',
         r'\$(\d+\.\d{2})',
-        r'(\d+\.\d{2})'
+        r'(?<!\d)(\d+\.\d{2})'
     ]
     amounts = []
     for pattern in patterns:
@@ -364,10 +557,42 @@ def extract_date(text):
             continue
     return None
 
+def extract_receipt_fields(text, words):
+    """Store, total and date of one receipt from its text and word boxes"""
+    # Length-capped text, so garbage OCR cannot pin the CPU
+    bounded_text = bound_text(text)
+    # Total and date from the word boxes first, the text chain where the layout is ambiguous
+    layout = extract_layout_fields(words, extract_date)
+    return {
+        "store_name": extract_store_name(bounded_text),
+        "total_amount": layout["total_amount"] or extract_total_amount(bounded_text),
+        "date": layout["date"] or extract_date(bounded_text)
+    }
+
 @app.route('/favicon.ico')
 def favicon():
     return send_from_directory(os.path.join(app.root_path, 'static'), 'favicon.ico', mimetype='image/vnd.microsoft.icon')
 
+def _warm_image_pool():
+    workers = image_pool.start()
+    verdict = image_pool.run(prescreen_image, PROBE_IMAGE)["verdict"] if prescreen_enabled() else "prescreen disabled"
+    return f"{workers} workers, {verdict}"
+
+# /api/live and /api/ready; readiness waits for the Vision channel and a warm extractor run.
+# The image pool forks its workers first, before the gRPC channel exists.
+warmup_steps = [
+    ("imports", import_modules("google.cloud.vision", "google.oauth2.service_account", "PIL.Image?")),
+    ("image_pool", _warm_image_pool),
+    ("extractors", warm_extractors(lambda text: {
+        "store_name": extract_store_name(bound_text(text)),
+        "total_amount": extract_total_amount(bound_text(text)),
+        "date": extract_date(bound_text(text))
+    }))
+]
+if any(backend.name == 'vision' for backend in ocr_router.backends):
+    warmup_steps.insert(2, ("vision_client", warm_vision_client(get_vision_client, governor=spend_governor)))
+install_warmup(app, warmup_steps)
+
 if __name__ == '__main__':
     port = int(os.environ.get('PORT', 8080))
     app.run(host='0.0.0.0', port=port, debug=False)
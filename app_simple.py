@@ -4,8 +4,20 @@ Minimal Receipt Scanner API for Railway deployment
 import os
 import json
 import logging
-from flask import Flask, request, jsonify
+import threading
+import time
+from flask import Flask, request, jsonify, g
 from flask_cors import CORS
+from extraction_limits import bound_text
+from request_profiler import install_profiler, ADMIN_TOKEN
+from warmup import install_warmup, import_modules, warm_vision_client, warm_extractors
+from scan_tracing import tracer, install_tracing, KIND_CLIENT
+from ocr_backends import open_ocr_router, OcrError
+from ocr_budget import open_spend_governor, BudgetExceeded
+from scan_cancellation import (CancelScope, ScanCancelled, CancellationStats, connection_probe,
+                               request_deadline, cancellable_text_detection)
+from tenant_scheduler import (load_api_keys, tenant_for_request, RateLimiter, FairScheduler,
+                              TenantMetrics, resolve_priority)
 
 # Configure logging
 logging.basicConfig(level=logging.INFO)
@@ -14,8 +26,26 @@ logger = logging.getLogger(__name__)
 app = Flask(__name__)
 CORS(app)
 
-# Import Google Cloud Vision only when needed
+# Sampled or admin-requested request profiles, served under /api/admin/profiles
+install_profiler(app)
+
+# Request and Vision spans, exported when TRACE_EXPORTER is set
+install_tracing(app)
+
+# One Vision client per worker, reused by every scan (see get_vision_client)
+_vision_client = None
+_vision_client_lock = threading.Lock()
+
 def get_vision_client():
+    # Created once, so credentials and the gRPC channel are set up by the warm-up, not a user's scan
+    global _vision_client
+    with _vision_client_lock:
+        if _vision_client is None:
+            _vision_client = _create_vision_client()
+        return _vision_client
+
+# Import Google Cloud Vision only when needed
+def _create_vision_client():
     try:
         from google.cloud import vision
         from google.oauth2 import service_account
@@ -38,6 +68,32 @@ def get_vision_client():
         logger.error(f"Failed to create Vision client: {str(e)}")
         return None
 
+def _require_vision_client():
+    client = get_vision_client()
+    if not client:
+        raise RuntimeError("Google Cloud Vision not configured")
+    return client
+
+def _detect_text(client, image, scope=None):
+    # The gRPC call is cancelled when the scope is (see scan_cancellation.py)
+    with tracer.span("vision.text_detection", KIND_CLIENT, **{"image.bytes": len(image.content)}):
+        return cancellable_text_detection(client, image, scope)
+
+# Billable OCR calls per day against OCR_DAILY_BUDGET, in a ledger shared with the other apps and the CLI
+spend_governor = open_spend_governor()
+
+# OCR backends from OCR_BACKENDS (Vision by default), tried in order
+ocr_router = open_ocr_router(_require_vision_client, _detect_text, governor=spend_governor)
+
+# Scans abandoned because the client went away or the deadline passed
+cancellation_stats = CancellationStats()
+
+# API-key tenants (callers without a key still get in), their rate limits and fair sharing of the OCR slots
+api_keys = load_api_keys()
+rate_limiter = RateLimiter()
+ocr_scheduler = FairScheduler()
+tenant_metrics = TenantMetrics()
+
 @app.route('/')
 def home():
     return jsonify({
@@ -45,7 +101,9 @@ def home():
         "status": "running",
         "endpoints": {
             "health": "/api/health",
-            "scan": "/api/scan (POST)"
+            "scan": "/api/scan (POST)",
+            "usage": "/api/usage",
+            "metrics": "/api/metrics"
         }
     })
 
@@ -57,8 +115,59 @@ def health():
         "version": "1.0.0"
     })
 
+def is_admin():
+    return bool(ADMIN_TOKEN) and request.headers.get('X-Admin-Token') == ADMIN_TOKEN
+
+@app.route('/api/metrics')
+def metrics():
+    scheduler = ocr_scheduler.stats()
+    report = {
+        "cancellations": cancellation_stats.stats(),
+        "ocr_scheduler": scheduler,
+        "ocr_backends": ocr_router.stats()
+    }
+    if is_admin():
+        report["tenants"] = tenant_metrics.stats()
+    else:
+        # Per-tenant figures are for the admin token only
+        del scheduler["queue_depth"], scheduler["max_queue_depth"]
+    return jsonify(report)
+
+@app.route('/api/usage')
+def ocr_usage():
+    days = request.args.get('days', '1')
+    if not days.isdigit() or not 1 <= int(days) <= 31:
+        return jsonify({
+            "success": False,
+            "error": "days must be a number from 1 to 31"
+        }), 400
+    try:
+        usage = spend_governor.usage(days=int(days))
+    except Exception as e:
+        logger.error(f"Error reading OCR usage: {str(e)}")
+        return jsonify({
+            "success": False,
+            "error": f"Could not read OCR usage: {str(e)}"
+        }), 500
+    if not is_admin():
+        # The ledger can be shared with app.py's tenants, so only the totals are public
+        del usage["tenants"]
+    return jsonify({"success": True, **usage})
+
 @app.route('/api/scan', methods=['POST'])
 def scan_receipt():
+    tenant = tenant_for_request(api_keys, request.headers, allow_keyless=True)
+    if tenant is None:
+        return jsonify({
+            "success": False,
+            "error": "Invalid API key"
+        }), 401
+    start = time.perf_counter()
+    response = _scan_receipt(tenant)
+    tenant_metrics.record(tenant["tenant"], time.perf_counter() - start, g.get('queue_wait'))
+    return response
+
+def _scan_receipt(tenant):
     try:
         # Check for file upload
         if 'receipt_image' not in request.files:
@@ -82,41 +191,78 @@ def scan_receipt():
                 "error": "Empty file"
             }), 400
         
-        # Get Vision client
-        client = get_vision_client()
-        if not client:
-            return jsonify({
-                "success": False,
-                "error": "Google Cloud Vision not configured"
-            }), 500
+        # Stop working on the scan if the client goes away or the deadline passes
+        scope = CancelScope(request_deadline(request.headers.get('X-Scan-Timeout')),
+                            connection_probe(request.environ))
         
-        # Process image
-        from google.cloud import vision
-        image = vision.Image(content=image_bytes)
-        response = client.text_detection(image=image)
+        retry_after = rate_limiter.check(tenant)
+        if retry_after:
+            tenant_metrics.count(tenant["tenant"], "rate_limited")
+            response = jsonify({
+                "success": False,
+                "error": "Rate limit exceeded"
+            })
+            response.status_code = 429
+            response.headers['Retry-After'] = str(int(retry_after) + 1)
+            return response
         
-        if response.error.message:
+        # OCR with the configured backends (Vision by default, falling back to the next on failure),
+        # in this tenant's fair share of the OCR slots
+        priority = resolve_priority(tenant, request.headers.get('X-Scan-Priority'))
+        try:
+            admitted = ocr_scheduler.run(tenant, lambda: ocr_router.detect(
+                image_bytes, scope, tenant=tenant["tenant"], priority=priority),
+                priority=priority, cancelled=scope.reason)
+            if admitted is None:
+                scope.check("queue")
+                tenant_metrics.count(tenant["tenant"], "queue_timeouts")
+                return jsonify({
+                    "success": False,
+                    "error": "Scanner busy, please retry shortly"
+                }), 503
+            ocr, g.queue_wait = admitted
+            scope.check("extract")
+        except ScanCancelled as e:
+            cancellation_stats.record(e)
+            tenant_metrics.count(tenant["tenant"], "cancelled")
+            logger.info(str(e))
             return jsonify({
                 "success": False,
-                "error": f"Vision API error: {response.error.message}"
+                "error": str(e)
+            }), e.status
+        except BudgetExceeded as e:
+            tenant_metrics.count(tenant["tenant"], "over_budget")
+            response = jsonify({
+                "success": False,
+                "error": str(e)
+            })
+            response.status_code = 429
+            response.headers['Retry-After'] = str(e.retry_after)
+            return response
+        except (RuntimeError, OcrError) as e:
+            return jsonify({
+                "success": False,
+                "error": str(e)
             }), 500
         
         # Extract text
-        texts = response.text_annotations
+        texts = ocr.annotations
         if texts:
             full_text = texts[0].description
         else:
             full_text = ""
         
         # Simple extraction (you can enhance this later)
+        bounded_text = bound_text(full_text)
         result = {
             "success": True,
             "data": {
-                "store_name": extract_store_name(full_text),
-                "total_amount": extract_total_amount(full_text),
-                "date": extract_date(full_text)
+                "store_name": extract_store_name(bounded_text),
+                "total_amount": extract_total_amount(bounded_text),
+                "date": extract_date(bounded_text)
             },
-            "raw_text": full_text[:200] + "..." if len(full_text) > 200 else full_text
+            "raw_text": full_text[:200] + "..." if len(full_text) > 200 else full_text,
+            "ocr_backend": ocr.backend
         }
         
         return jsonify(result)
@@ -186,6 +332,19 @@ def extract_date(text):
     
     return None
 
+# /api/live and /api/ready; readiness waits for the Vision channel and a warm extractor run
+warmup_steps = [
+    ("imports", import_modules("google.cloud.vision", "google.oauth2.service_account")),
+    ("extractors", warm_extractors(lambda text: {
+        "store_name": extract_store_name(bound_text(text)),
+        "total_amount": extract_total_amount(bound_text(text)),
+        "date": extract_date(bound_text(text))
+    }))
+]
+if any(backend.name == 'vision' for backend in ocr_router.backends):
+    warmup_steps.insert(1, ("vision_client", warm_vision_client(get_vision_client, governor=spend_governor)))
+install_warmup(app, warmup_steps)
+
 if __name__ == '__main__':
     port = int(os.environ.get('PORT', 8080))
     app.run(host='0.0.0.0', port=port, debug=False)
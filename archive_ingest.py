@@ -0,0 +1,177 @@
+"""
+Archive ingestion
+=================
+
+Iterates the receipt images inside zip archives and emailed receipts
+(.eml files and mbox exports) as a stream, without extracting anything to
+a temporary directory:
+
+- zip members are read one at a time straight from the archive
+- email messages are fed to the MIME parser in chunks, one message at a
+  time, and their image attachments (and zipped attachments) are yielded
+- .eml and .mbox files inside a zip are handled the same way
+
+Memory is bounded by the size of one message plus the images being scanned.
+Members larger than ARCHIVE_MAX_MEMBER_BYTES and messages larger than
+ARCHIVE_MAX_MESSAGE_BYTES are skipped. scan_concurrently() runs the OCR over
+the stream with a bounded number of images in flight.
+"""
+
+import contextvars
+import io
+import logging
+import os
+import zipfile
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from email import policy
+from email.message import EmailMessage
+from email.parser import BytesFeedParser
+from typing import BinaryIO, Callable, Dict, Iterable, Iterator, Optional, Tuple
+
+from upload_settings import MAX_UPLOAD_BYTES
+
+logger = logging.getLogger(__name__)
+
+ARCHIVE_EXTENSIONS = ('.zip', '.eml', '.mbox')
+IMAGE_EXTENSIONS = ('.jpg', '.jpeg', '.png', '.webp')
+ARCHIVE_MAX_MEMBER_BYTES = int(os.environ.get('ARCHIVE_MAX_MEMBER_BYTES', MAX_UPLOAD_BYTES))
+ARCHIVE_MAX_MESSAGE_BYTES = int(os.environ.get('ARCHIVE_MAX_MESSAGE_BYTES', 50 * 1024 * 1024))
+ARCHIVE_SCAN_WORKERS = int(os.environ.get('ARCHIVE_SCAN_WORKERS', 4))
+
+CHUNK_SIZE = 64 * 1024
+
+
+def is_archive(filename: str) -> bool:
+    return filename.lower().endswith(ARCHIVE_EXTENSIONS)
+
+
+def iter_archive_images(stream: BinaryIO, filename: str) -> Iterator[Tuple[str, bytes]]:
+    """Yield (name, image bytes) for every receipt image in a .zip, .eml or .mbox stream."""
+    name = filename.lower()
+    if name.endswith('.zip'):
+        yield from _iter_zip(stream, filename)
+    elif name.endswith('.eml'):
+        message = _parse_message(iter(lambda: stream.read(CHUNK_SIZE), b''))
+        if message is not None:
+            yield from _iter_message(message, filename)
+    elif name.endswith('.mbox'):
+        for number, message in enumerate(_iter_mbox(stream), 1):
+            if message is not None:
+                yield from _iter_message(message, f"{filename}#{number}")
+    else:
+        raise ValueError(f"Unsupported archive type: {filename}")
+
+
+def _iter_zip(stream: BinaryIO, label: str) -> Iterator[Tuple[str, bytes]]:
+    # zipfile reads the central directory, then each member on demand
+    with zipfile.ZipFile(stream) as archive:
+        for info in archive.infolist():
+            member = info.filename
+            if info.is_dir() or os.path.basename(member).startswith('.'):
+                continue
+            lower = member.lower()
+            if lower.endswith(IMAGE_EXTENSIONS):
+                if info.file_size > ARCHIVE_MAX_MEMBER_BYTES:
+                    logger.warning(f"Skipping {label}/{member}: {info.file_size} bytes is over the size limit")
+                    continue
+                with archive.open(info) as f:
+                    # Read one byte past the limit in case the header understates the size
+                    data = f.read(ARCHIVE_MAX_MEMBER_BYTES + 1)
+                if len(data) > ARCHIVE_MAX_MEMBER_BYTES:
+                    logger.warning(f"Skipping {label}/{member}: over the size limit")
+                    continue
+                yield f"{label}/{member}", data
+            elif lower.endswith(('.eml', '.mbox')):
+                with archive.open(info) as f:
+                    yield from iter_archive_images(f, f"{label}/{member}")
+
+
+def _parse_message(chunks: Iterable[bytes]) -> Optional[EmailMessage]:
+    """Feed chunks to the MIME parser; None if the message is over the size limit."""
+    parser = BytesFeedParser(policy=policy.default)
+    size = 0
+    for chunk in chunks:
+        size += len(chunk)
+        if size > ARCHIVE_MAX_MESSAGE_BYTES:
+            logger.warning("Skipping an email message over the size limit")
+            # Drain the rest of this message without keeping it
+            for _ in chunks:
+                pass
+            return None
+        parser.feed(chunk)
+    return parser.close()
+
+
+def _iter_mbox(stream: BinaryIO) -> Iterator[Optional[EmailMessage]]:
+    """
+    Split an mbox stream on its "From " separator lines (at the start of the
+    stream or after a blank line), parsing one message at a time.
+    """
+    pending = []
+
+    def message_lines():
+        # Lines of the current message, up to (not including) the next separator
+        previous_blank = False
+        while True:
+            line = stream.readline()
+            if not line:
+                return
+            if previous_blank and line.startswith(b'From '):
+                pending.append(line)
+                return
+            previous_blank = line in (b'\n', b'\r\n')
+            yield line
+
+    while True:
+        separator = pending.pop() if pending else stream.readline()
+        if not separator:
+            return
+        if not separator.startswith(b'From '):
+            continue  # junk before the first message
+        yield _parse_message(message_lines())
+
+
+def _iter_message(message: EmailMessage, label: str) -> Iterator[Tuple[str, bytes]]:
+    for number, part in enumerate(message.walk()):
+        if part.is_multipart():
+            continue
+        content_type = part.get_content_type()
+        filename = part.get_filename() or ''
+        lower = filename.lower()
+        if content_type.startswith('image/') or lower.endswith(IMAGE_EXTENSIONS):
+            data = part.get_payload(decode=True)
+            if not data or len(data) > ARCHIVE_MAX_MEMBER_BYTES:
+                continue
+            yield f"{label}/{filename or f'part-{number}'}", data
+        elif content_type in ('application/zip', 'application/x-zip-compressed') or lower.endswith('.zip'):
+            data = part.get_payload(decode=True)
+            if data:
+                yield from _iter_zip(io.BytesIO(data), f"{label}/{filename or f'part-{number}'}")
+
+
+def scan_concurrently(images: Iterable[Tuple[str, bytes]], scan: Callable[[bytes], Dict],
+                      workers: int = ARCHIVE_SCAN_WORKERS) -> Iterator[Tuple[str, Dict]]:
+    """
+    Run scan(image bytes) over a stream of (name, bytes) with at most `workers`
+    scans running and workers * 2 images held in memory. Results are yielded
+    in archive order; a scan that raises yields {"success": False, "error": ...}.
+    Each scan runs in a copy of the caller's context, so its trace spans are
+    children of the caller's span.
+    """
+    def run(data):
+        try:
+            return scan(data)
+        except Exception as e:
+            return {"success": False, "error": str(e)}
+
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        in_flight = deque()
+        for name, data in images:
+            in_flight.append((name, pool.submit(contextvars.copy_context().run, run, data)))
+            if len(in_flight) >= workers * 2:
+                name, future = in_flight.popleft()
+                yield name, future.result()
+        while in_flight:
+            name, future = in_flight.popleft()
+            yield name, future.result()
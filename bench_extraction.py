@@ -0,0 +1,132 @@
+"""
+Extraction time benchmark
+=========================
+
+Feeds adversarial and very long OCR texts (digit runs, comma runs, repeated
+keywords, huge whitespace runs, random garbage) through the store/total/date
+extractors of every app, exactly as the scan paths call them (bound_text
+first), and checks that each receipt stays within EXTRACTION_BUDGET_MS.
+
+Usage:
+    python bench_extraction.py [--fuzz N] [--seed S]
+
+Exits with status 1 if any receipt exceeds the budget.
+"""
+
+import argparse
+import importlib
+import random
+import statistics
+import sys
+import time
+
+from extraction_limits import bound_text, EXTRACTION_BUDGET_MS
+from merchant_extractors import extract_merchant_total
+
+APP_MODULES = ["app", "app_minimal", "app_simple", "scan_receipt_gcp", "streamlit_app"]
+
+SAMPLE_RECEIPT = """COSTCO WHOLESALE
+Victoria #1234
+KIRKLAND WATER 5.99
+ORGANIC EGGS 8.49
+SUBTOTAL 14.48
+TAX 0.72
+**** TOTAL 15.20
+MASTERCARD $15.20
+2025/08/11 12:34:56
+"""
+
+
+def adversarial_cases():
+    """Named texts designed to trigger regex backtracking or sheer volume."""
+    rng = random.Random(7)
+    return {
+        "sample_receipt": SAMPLE_RECEIPT,
+        "digit_run": "1" * 200000,
+        "digit_run_with_dot": "1" * 200000 + ".",
+        "digit_comma_run": "1," * 100000,
+        "comma_dot_run": "1,." * 60000,
+        "barcode_lines": "\n".join("9" * 4000 for _ in range(200)),
+        "repeated_total": "TOTAL " * 40000,
+        "repeated_total_dollar": "TOTAL $" * 30000 + "1",
+        "total_prepaid_no_amount": "Total Prepaid " * 20000,
+        "date_then_spaces": "1/1/11" + " " * 200000,
+        "timestamp_then_spaces": "2025/1/1" + " " * 200000 + "x",
+        "many_short_lines": "\n".join("total 1.1 $ 2,2" for _ in range(100000)),
+        "month_abbrev_run": "Aug" * 60000,
+        "keyword_soup": " ".join(["balance due", "credit", "paid", "amount", "mastercard"] * 20000),
+        "megabyte_random": "".join(rng.choice("0123456789.,$/ :-TOTALtotal\n") for _ in range(1000000)),
+    }
+
+
+def fuzz_cases(count: int, seed: int):
+    """Random texts built from tokens the extraction regexes care about."""
+    rng = random.Random(seed)
+    tokens = ["1", "12", "1,", ",", ".", ".00", "$", "CAD", " ", "  ", "\n", "/", "-", ":", "'",
+              "TOTAL", "Total Prepaid", "balance due", "credit", "Aug", "2025", "Sep", "\t"]
+    for i in range(count):
+        length = rng.choice([100, 1000, 10000, 100000])
+        yield f"fuzz_{i}", "".join(rng.choice(tokens) for _ in range(length))
+
+
+def load_extractors():
+    extractors = {}
+    for name in APP_MODULES:
+        try:
+            module = importlib.import_module(name)
+        except Exception as e:
+            print(f"skipping {name}: {e}")
+            continue
+        extractors[name] = module
+    return extractors
+
+
+def extract_once(module, text: str) -> None:
+    # Mirror the scan paths: cap the text, then run every extractor
+    text = bound_text(text)
+    store_name = module.extract_store_name(text)
+    extract_merchant_total(store_name, text)
+    module.extract_total_amount(text)
+    module.extract_date(text)
+
+
+def time_case(module, text: str, repeat: int = 3) -> float:
+    timings = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        extract_once(module, text)
+        timings.append((time.perf_counter() - start) * 1000)
+    return statistics.median(timings)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument("--fuzz", type=int, default=50, help="number of random fuzz texts")
+    parser.add_argument("--seed", type=int, default=1, help="fuzz random seed")
+    args = parser.parse_args()
+
+    extractors = load_extractors()
+    cases = list(adversarial_cases().items()) + list(fuzz_cases(args.fuzz, args.seed))
+    failures = []
+    print(f"budget: {EXTRACTION_BUDGET_MS:.0f} ms per receipt")
+    print(f"{'case':<26}" + "".join(f"{name:>18}" for name in extractors))
+    for case, text in cases:
+        row = f"{case:<26}"
+        for name, module in extractors.items():
+            elapsed = time_case(module, text)
+            flag = " !" if elapsed > EXTRACTION_BUDGET_MS else ""
+            row += f"{elapsed:>16.2f}{flag or '  '}"
+            if flag:
+                failures.append((case, name, elapsed))
+        print(row)
+
+    if failures:
+        print(f"\n{len(failures)} receipt(s) over budget:")
+        for case, name, elapsed in failures:
+            print(f"  {case} / {name}: {elapsed:.2f} ms")
+        sys.exit(1)
+    print("\nall receipts within budget")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,214 @@
+"""
+Layout extraction benchmark
+===========================
+
+Compares the total and date read from word boxes (layout_extraction.py, with
+the text chain as fallback, as app.py runs it) with app.py's text-only
+extractors:
+
+- accuracy on labelled synthetic receipts built to the layouts that trip
+  the text chain (cash tendered, savings and points lines, price columns
+  that Vision's full text prints after the labels, expiry dates), with and
+  without a slight skew
+- agreement and layout hit rate on real Vision responses from a capture
+  directory (TRAFFIC_CAPTURE or "ocr_backends.py bench --record"), which
+  have no labels
+- time per receipt, including one of MAX_LAYOUT_WORDS words, against
+  EXTRACTION_BUDGET_MS
+
+Usage:
+    python bench_layout.py [--capture DIR] [--repeat 5]
+
+Exits with status 1 if the layout path gets a labelled receipt wrong that
+the text chain gets right, or a receipt exceeds the budget.
+"""
+
+import argparse
+import os
+import statistics
+import sys
+import time
+from typing import Dict, List, Optional, Tuple
+
+from extraction_limits import bound_text, EXTRACTION_BUDGET_MS
+from layout_extraction import extract_layout_fields, MAX_LAYOUT_WORDS
+from receipt_segmentation import words_from_annotations
+
+# Synthetic receipts: lines of (label, amount or None); the price column is right-aligned
+SYNTHETIC = {
+    "total_then_savings": {
+        "lines": [("SAVE ON FOODS", None), ("08/11/2025 14:02", None), ("MILK", "4.99"), ("BREAD", "3.49"),
+                  ("SUBTOTAL", "8.48"), ("TOTAL", "8.48"), ("TOTAL SAVINGS", "2.50"), ("VISA", "8.48")],
+        "truth": {"total_amount": "CAD 8.48", "date": "08/11/2025"}
+    },
+    "cash_tendered": {
+        "lines": [("CORNER MARKET", None), ("2025/08/11 09:15:00", None), ("COFFEE", "3.25"),
+                  ("MUFFIN", "2.75"), ("TAX", "0.30"), ("TOTAL", "6.30"), ("CASH", "50.00"), ("CHANGE", "43.70"),
+                  ("SUBTOTAL BEFORE TAX", "6.00")],
+        "truth": {"total_amount": "CAD 6.30", "date": "2025/08/11"}
+    },
+    "points_balance": {
+        "lines": [("PHARMACY PLUS", None), ("Date 08/12/2025", None), ("VITAMINS", "19.99"), ("GST", "1.00"),
+                  ("AMOUNT DUE", "20.99"), ("DEBIT", "20.99"), ("POINTS BALANCE", "1,250.00")],
+        "truth": {"total_amount": "CAD 20.99", "date": "08/12/2025"}
+    },
+    "expiry_date": {
+        "lines": [("HARDWARE DEPOT", None), ("08/13/2025", None), ("SCREWS", "4.10"), ("TOTAL", "4.10"),
+                  ("RETURNS BY 2025-09-12", None), ("GIFT CARD EXPIRES 2026-01-31", None)],
+        "truth": {"total_amount": "CAD 4.10", "date": "08/13/2025"}
+    },
+    "items_count": {
+        "lines": [("GROCER", None), ("2025/08/14 18:20:11", None), ("APPLES", "6.40"), ("TOTAL", "6.40"),
+                  ("TOTAL NUMBER OF ITEMS SOLD", "1.00"), ("TOTAL SAVED", "0.80")],
+        "truth": {"total_amount": "CAD 6.40", "date": "2025/08/14"}
+    },
+    "grand_total": {
+        "lines": [("DINER", None), ("2025/08/15 20:05:00", None), ("BURGER", "14.00"), ("TOTAL", "14.00"),
+                  ("TIP", "2.80"), ("GRAND TOTAL", "16.80")],
+        "truth": {"total_amount": "CAD 16.80", "date": "2025/08/15"}
+    }
+}
+
+LINE_HEIGHT = 20
+LINE_PITCH = 30
+CHAR_WIDTH = 12
+PRICE_EDGE = 420
+
+
+def _box(text: str, x0: float, y0: float, skew: float) -> Dict:
+    x1 = x0 + CHAR_WIDTH * len(text)
+    shift = skew * x0
+    return {"text": text, "x0": x0, "y0": y0 + shift, "x1": x1, "y1": y0 + LINE_HEIGHT + shift}
+
+
+def render(lines: List[Tuple[str, Optional[str]]], skew: float = 0.0) -> Tuple[List[Dict], str, str]:
+    """Word boxes plus two text flattenings: line by line, and Vision-style with the price column last."""
+    words = []
+    for row, (label, amount) in enumerate(lines):
+        y = 10 + row * LINE_PITCH
+        x = 20
+        for token in label.split():
+            words.append(_box(token, x, y, skew))
+            x += CHAR_WIDTH * (len(token) + 1)
+        if amount:
+            words.append(_box(amount, PRICE_EDGE - CHAR_WIDTH * len(amount), y, skew))
+    by_line = '\n'.join(f"{label} {amount}" if amount else label for label, amount in lines)
+    columns = '\n'.join([label for label, _ in lines] + [amount for _, amount in lines if amount])
+    return words, by_line, columns
+
+
+def combined(extractors, text: str, words: Optional[List[Dict]]) -> Dict[str, Optional[str]]:
+    # Mirrors app.extract_receipt_fields for the two fields (merchant parsers aside)
+    text = bound_text(text)
+    layout = extract_layout_fields(words, extractors.extract_date)
+    return {"total_amount": layout["total_amount"] or extractors.extract_total_amount(text),
+            "date": layout["date"] or extractors.extract_date(text)}
+
+
+def text_only(extractors, text: str) -> Dict[str, Optional[str]]:
+    text = bound_text(text)
+    return {"total_amount": extractors.extract_total_amount(text), "date": extractors.extract_date(text)}
+
+
+def time_ms(fn, repeat: int) -> float:
+    timings = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        fn()
+        timings.append((time.perf_counter() - start) * 1000)
+    return statistics.median(timings)
+
+
+def load_app():
+    # The extractors of app.py, without warm-up threads or persistence
+    os.environ.setdefault('WARMUP_ENABLED', 'false')
+    os.environ.setdefault('SCAN_DB_PATH', '')
+    os.environ.setdefault('OCR_LOG_DIR', '')
+    os.environ.setdefault('IMAGE_POOL_WORKERS', '0')
+    import app
+    return app
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument("--capture", help="capture directory with recorded Vision responses to compare on")
+    parser.add_argument("--repeat", type=int, default=5, help="timing repetitions per receipt")
+    args = parser.parse_args()
+
+    extractors = load_app()
+    regressions, over_budget = [], []
+    scores = {"text": 0, "layout": 0}
+    checks = 0
+    print(f"{'receipt':<34}{'field':<14}{'truth':>14}{'text chain':>14}{'layout':>14}{'ms':>8}")
+    for name, case in SYNTHETIC.items():
+        for skew in (0.0, 0.02):
+            words, by_line, columns = render(case["lines"], skew)
+            for flattening, text in (("lines", by_line), ("columns", columns)):
+                label = f"{name}/{flattening}" + ("/skew" if skew else "")
+                old = text_only(extractors, text)
+                new = combined(extractors, text, words)
+                elapsed = time_ms(lambda: combined(extractors, text, words), args.repeat)
+                if elapsed > EXTRACTION_BUDGET_MS:
+                    over_budget.append((label, elapsed))
+                for field, truth in case["truth"].items():
+                    checks += 1
+                    scores["text"] += old[field] == truth
+                    scores["layout"] += new[field] == truth
+                    if old[field] == truth and new[field] != truth:
+                        regressions.append((label, field, truth, new[field]))
+                    mark = "" if new[field] == truth else " x"
+                    print(f"{label:<34}{field:<14}{truth:>14}{str(old[field]):>14}{str(new[field]) + mark:>14}"
+                          f"{elapsed:>8.2f}")
+    print(f"\nlabelled fields correct: text chain {scores['text']}/{checks}, layout {scores['layout']}/{checks}")
+
+    # A receipt at the word limit: the grid keeps it linear. Items are three words and the
+    # total two; one-word lines after it make up exactly MAX_LAYOUT_WORDS, past which the
+    # grid is skipped and only the text chain would be timed
+    items, filler = divmod(MAX_LAYOUT_WORDS - 2, 3)
+    long_lines = [(f"ITEM {i}", f"{i % 97 + 1}.99") for i in range(items)] + [("TOTAL", "1.00")]
+    long_lines += [("THANKS", None)] * filler
+    words, by_line, _ = render(long_lines)
+    assert len(words) == MAX_LAYOUT_WORDS
+    long_total = extract_layout_fields(words, extractors.extract_date)["total_amount"]
+    if long_total != "CAD 1.00":
+        regressions.append((f"{len(words)} words", "total_amount", "CAD 1.00", long_total))
+    elapsed = time_ms(lambda: combined(extractors, by_line, words), args.repeat)
+    print(f"{len(words)} words: {elapsed:.2f} ms, layout total {long_total} (budget {EXTRACTION_BUDGET_MS:.0f} ms)")
+    if elapsed > EXTRACTION_BUDGET_MS:
+        over_budget.append((f"{len(words)} words", elapsed))
+
+    if args.capture:
+        from traffic_capture import iter_responses, annotations_from_json
+        compared = agreed = layout_hits = 0
+        timings = []
+        for record in iter_responses(args.capture):
+            annotations = annotations_from_json(record["annotations"])
+            if not annotations:
+                continue
+            text, words = annotations[0].description, words_from_annotations(annotations[1:])
+            old, new = text_only(extractors, text), combined(extractors, text, words)
+            layout = extract_layout_fields(words, extractors.extract_date)
+            timings.append(time_ms(lambda: combined(extractors, text, words), args.repeat))
+            for field in old:
+                compared += 1
+                agreed += old[field] == new[field]
+                layout_hits += layout[field] is not None
+        if compared:
+            print(f"\ncapture {args.capture}: {compared // 2} receipts, fields agreeing with the text chain "
+                  f"{agreed}/{compared}, read from the layout {layout_hits}/{compared}, "
+                  f"median {statistics.median(timings):.2f} ms, max {max(timings):.2f} ms")
+            over_budget += [(f"capture receipt {i}", ms) for i, ms in enumerate(timings) if ms > EXTRACTION_BUDGET_MS]
+        else:
+            print(f"\ncapture {args.capture}: no recorded responses")
+
+    if regressions or over_budget:
+        for label, field, truth, got in regressions:
+            print(f"regression: {label} {field}: expected {truth}, layout gave {got}")
+        for label, elapsed in over_budget:
+            print(f"over budget: {label}: {elapsed:.2f} ms")
+        sys.exit(1)
+    print("\nno regressions against the text chain, all receipts within budget")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,35 @@
+"""
+Extraction input limits
+=======================
+
+Bounds the work the text extractors can do on a single receipt. A garbage
+OCR result (a barcode read as thousands of digits, a photo of a spreadsheet)
+can otherwise make the amount/date regexes backtrack quadratically and pin
+a worker's CPU.
+
+bound_text() is applied to OCR text before any extractor runs. It caps the
+number of lines, the length of each line and the total size, so each
+line-scoped regex works on a short string and the total work per receipt is
+linear in the (capped) text length. Real receipts are far inside these
+limits, so their text is never changed.
+"""
+
+import os
+
+MAX_TEXT_CHARS = int(os.environ.get('EXTRACT_MAX_TEXT_CHARS', 32768))
+MAX_LINES = int(os.environ.get('EXTRACT_MAX_LINES', 800))
+MAX_LINE_CHARS = int(os.environ.get('EXTRACT_MAX_LINE_CHARS', 160))
+
+# Per-receipt time budget the benchmark (bench_extraction.py) enforces
+EXTRACTION_BUDGET_MS = float(os.environ.get('EXTRACT_BUDGET_MS', 50))
+
+
+def bound_text(text: str) -> str:
+    """Cap OCR text to MAX_LINES lines of MAX_LINE_CHARS characters, MAX_TEXT_CHARS in total."""
+    if not text:
+        return text
+    if len(text) <= MAX_TEXT_CHARS and text.count('\n') < MAX_LINES:
+        if all(len(line) <= MAX_LINE_CHARS for line in text.split('\n')):
+            return text
+    lines = text[:MAX_TEXT_CHARS].split('\n')[:MAX_LINES]
+    return '\n'.join(line[:MAX_LINE_CHARS] for line in lines)
@@ -0,0 +1,213 @@
+"""
+Image process pool
+==================
+
+Runs CPU-bound image work (Pillow decoding and the prescreen metrics) in a
+bounded pool of worker processes, so it scales across cores instead of
+holding the GIL in the request threads that are waiting on uploads and
+Vision calls.
+
+The image bytes are handed over in shared memory: the request thread copies
+them once into a SharedMemory block and only its name is sent to the
+worker, which decodes straight from the mapped buffer. Nothing is pickled
+but the (small) result.
+
+Configuration:
+
+    IMAGE_POOL_WORKERS        worker processes per app process (default: CPU
+                              count, at most 4; 0 runs the work inline)
+    IMAGE_POOL_MAX_PENDING    images queued or being processed at once
+                              (default 2 x workers)
+    IMAGE_POOL_WAIT_SECONDS   how long a request waits for a place before
+                              the pool reports it is busy (default 5)
+
+When IMAGE_POOL_MAX_PENDING images are already in the pool, further
+requests wait up to IMAGE_POOL_WAIT_SECONDS and then get PoolBusy, which
+the apps answer with 503 and Retry-After. Under gunicorn every worker
+has its own pool, so size the two together.
+
+The first workers are forked, which needs a POSIX system; elsewhere the
+pool defaults to inline. The warm-up starts them before the Vision client
+and its gRPC threads exist. A pool replacing one whose worker died is
+started from a fork server instead, since forking the app process once
+those threads run is not safe. An image whose worker died is retried once in
+the new pool before BrokenProcessPool is raised.
+"""
+
+import io
+import logging
+import multiprocessing
+import os
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from typing import Any, Callable, Dict, Optional
+
+try:
+    from multiprocessing import resource_tracker, shared_memory
+except ImportError:  # Python < 3.8
+    shared_memory = None
+
+logger = logging.getLogger(__name__)
+
+_CAN_FORK = 'fork' in multiprocessing.get_all_start_methods() and shared_memory is not None
+
+IMAGE_POOL_WORKERS = int(os.environ.get('IMAGE_POOL_WORKERS', min(4, os.cpu_count() or 1) if _CAN_FORK else 0))
+IMAGE_POOL_MAX_PENDING = int(os.environ.get('IMAGE_POOL_MAX_PENDING', 0)) or max(IMAGE_POOL_WORKERS * 2, 1)
+IMAGE_POOL_WAIT_SECONDS = float(os.environ.get('IMAGE_POOL_WAIT_SECONDS', 5))
+
+
+class PoolBusy(Exception):
+    """No place in the image pool became free within the wait time."""
+
+
+class MemoryReader(io.RawIOBase):
+    """Seekable read-only file over a buffer, without copying it."""
+
+    def __init__(self, buffer):
+        self._view = memoryview(buffer)
+        self._position = 0
+
+    def readable(self) -> bool:
+        return True
+
+    def seekable(self) -> bool:
+        return True
+
+    def readinto(self, target) -> int:
+        count = max(0, min(len(target), len(self._view) - self._position))
+        target[:count] = self._view[self._position:self._position + count]
+        self._position += count
+        return count
+
+    def seek(self, offset: int, whence: int = io.SEEK_SET) -> int:
+        base = {io.SEEK_SET: 0, io.SEEK_CUR: self._position, io.SEEK_END: len(self._view)}[whence]
+        self._position = max(0, base + offset)
+        return self._position
+
+    def tell(self) -> int:
+        return self._position
+
+    def close(self) -> None:
+        if not self.closed:
+            self._view.release()
+        super().close()
+
+
+def _run_on_shared_memory(fn: Callable, name: str, size: int, args: tuple) -> Any:
+    """Worker side: call fn(file over the shared image bytes, *args)."""
+    block = shared_memory.SharedMemory(name=name)
+    try:
+        with io.BufferedReader(MemoryReader(block.buf[:size])) as stream:
+            return fn(stream, *args)
+    finally:
+        block.close()
+
+
+def _noop() -> None:
+    return None
+
+
+def _restart_context() -> multiprocessing.context.BaseContext:
+    """A clean-process context for replacement pools: a fork server that only preloads this module."""
+    if 'forkserver' in multiprocessing.get_all_start_methods():
+        context = multiprocessing.get_context('forkserver')
+        # Not the default ['__main__'], which would re-run the app module in the server
+        context.set_forkserver_preload([__name__])
+        return context
+    return multiprocessing.get_context('spawn')
+
+
+class ImagePool:
+    """Bounded process pool for image work, with shared-memory input."""
+
+    def __init__(self, workers: int = IMAGE_POOL_WORKERS, max_pending: int = IMAGE_POOL_MAX_PENDING,
+                 wait_seconds: float = IMAGE_POOL_WAIT_SECONDS):
+        self.workers = workers if _CAN_FORK else 0
+        self.max_pending = max_pending
+        self.wait_seconds = wait_seconds
+        self._slots = threading.BoundedSemaphore(max_pending)
+        self._executor: Optional[ProcessPoolExecutor] = None
+        self._lock = threading.Lock()
+        self._stats = {"processed": 0, "inline": 0, "busy": 0, "restarts": 0, "pending": 0, "slot_wait_ms": 0.0}
+
+    def _get_executor(self) -> ProcessPoolExecutor:
+        with self._lock:
+            if self._executor is None:
+                # Workers must share the parent's resource tracker, or each one starts its own,
+                # which "cleans up" the blocks they attached to when it exits
+                resource_tracker.ensure_running()
+                context = _restart_context() if self._stats["restarts"] else multiprocessing.get_context('fork')
+                self._executor = ProcessPoolExecutor(self.workers, mp_context=context)
+            return self._executor
+
+    def _restart(self, broken: ProcessPoolExecutor) -> None:
+        with self._lock:
+            if self._executor is broken:
+                self._executor = None
+                self._stats["restarts"] += 1
+        broken.shutdown(wait=False)
+
+    def start(self) -> int:
+        """Start all worker processes now (for the warm-up). Returns how many there are."""
+        if self.workers:
+            executor = self._get_executor()
+            for future in [executor.submit(_noop) for _ in range(self.workers)]:
+                future.result()
+        return self.workers
+
+    def run(self, fn: Callable, image_bytes: bytes, *args) -> Any:
+        """
+        fn(stream, *args) in a worker process, where stream is a binary file
+        over image_bytes. fn must be a module-level function outside the
+        app's main module. Raises PoolBusy when the pool stays full for
+        wait_seconds, and BrokenProcessPool when a worker died on this image
+        twice (once in a fresh pool).
+        """
+        if not self.workers:
+            with self._lock:
+                self._stats["inline"] += 1
+            return fn(io.BytesIO(image_bytes), *args)
+
+        waited = time.perf_counter()
+        if not self._slots.acquire(timeout=self.wait_seconds):
+            with self._lock:
+                self._stats["busy"] += 1
+            raise PoolBusy("Image processing is at capacity")
+        with self._lock:
+            self._stats["pending"] += 1
+            self._stats["slot_wait_ms"] += (time.perf_counter() - waited) * 1000
+        try:
+            block = shared_memory.SharedMemory(create=True, size=max(len(image_bytes), 1))
+            try:
+                block.buf[:len(image_bytes)] = image_bytes
+                for attempt in (1, 2):
+                    executor = self._get_executor()
+                    try:
+                        result = executor.submit(_run_on_shared_memory, fn, block.name, len(image_bytes),
+                                                 args).result()
+                        break
+                    except BrokenProcessPool:
+                        # A worker died (killed for memory, or a decoder crash on this image, so it
+                        # is never retried in the request thread); retry once in a fresh pool
+                        logger.warning("Image pool worker died, restarting the pool")
+                        self._restart(executor)
+                        if attempt == 2:
+                            raise
+            finally:
+                block.close()
+                block.unlink()
+            with self._lock:
+                self._stats["processed"] += 1
+            return result
+        finally:
+            with self._lock:
+                self._stats["pending"] -= 1
+            self._slots.release()
+
+    def stats(self) -> Dict:
+        with self._lock:
+            stats = dict(self._stats)
+        stats["slot_wait_ms"] = round(stats["slot_wait_ms"], 1)
+        return {"workers": self.workers, "max_pending": self.max_pending, **stats}
@@ -0,0 +1,110 @@
+"""
+Image pre-screen
+================
+
+Cheap local checks that run before an image is sent to Google Cloud Vision.
+The image is decoded at reduced scale into a small grayscale copy and scored
+for brightness, contrast, sharpness and text-like edge detail. Images that
+are clearly blank, black, blurred or contain no document-like detail are
+rejected with a helpful message instead of costing an OCR call.
+
+Measured on one core over the receipts/ samples (1080x1920 and 1126x2000),
+most of the cost is decoding. JPEGs are decoded at 1/8 scale: about 2 ms at
+the reduced upload targets, 3-11 ms for the upload page's 2048px JPEGs and
+10-40 ms for the progressive phone originals, whose entropy decoding cannot
+be scaled down. Pillow has no reduced-scale decoding for WebP or PNG, which
+take 30-110 ms; set UPLOAD_FORMATS=image/jpeg where that matters.
+
+Pillow is optional: without it the pre-screen is skipped and every image is
+passed through to OCR.
+"""
+
+import io
+import os
+import time
+from typing import BinaryIO, Dict, Union
+
+# Longest side of the grayscale copy the metrics are computed on, which ends up
+# between SCREEN_SIZE / 2 and SCREEN_SIZE
+SCREEN_SIZE = 256
+
+# Rejection thresholds (deliberately conservative - only hopeless images fail)
+MIN_MEAN_BRIGHTNESS = 20.0     # 0-255, below this the photo is essentially black
+MIN_CONTRAST = 10.0            # grayscale standard deviation, below this it is blank
+MIN_SHARPNESS = 115.0          # variance of the Laplacian, below this it is blurred
+MIN_EDGE_DENSITY = 0.03        # fraction of strong-edge pixels, text produces many
+EDGE_LEVEL = 48                # edge filter response counted as a strong edge
+
+
+def prescreen_enabled() -> bool:
+    return os.environ.get('PRESCREEN_ENABLED', '1').lower() not in ('0', 'false', 'no')
+
+
+def _verdict(ok: bool, verdict: str, message: str, metrics: Dict, start: float) -> Dict:
+    return {
+        "ok": ok,
+        "verdict": verdict,
+        "message": message,
+        "metrics": metrics,
+        "elapsed_ms": round((time.perf_counter() - start) * 1000, 2)
+    }
+
+
+def prescreen_image(image_bytes: Union[bytes, BinaryIO]) -> Dict:
+    """
+    Score an uploaded image and decide whether it is worth sending to OCR.
+    Takes the image bytes or a seekable binary file holding them.
+    """
+    start = time.perf_counter()
+    try:
+        from PIL import Image, ImageFilter, ImageStat
+    except ImportError:
+        return _verdict(True, "skipped", "Pillow not installed", {}, start)
+
+    try:
+        image = Image.open(image_bytes if hasattr(image_bytes, 'read') else io.BytesIO(image_bytes))
+        original_size = image.size
+        # JPEG decoders scale by 1/2, 1/4 or 1/8 while decoding: take the smallest
+        # scale whose longest side is still at least half of SCREEN_SIZE
+        factor = max(original_size) / (SCREEN_SIZE / 2)
+        image.draft('L', (max(int(original_size[0] / factor), 1), max(int(original_size[1] / factor), 1)))
+        gray = image.convert('L')
+        if max(gray.size) > SCREEN_SIZE:
+            # Box-average the rest of the way (other formats, very large JPEGs), cheaper than resampling
+            gray = gray.reduce(-(-max(gray.size) // SCREEN_SIZE))
+    except Exception:
+        return _verdict(False, "unreadable",
+                        "The uploaded file could not be decoded as an image. Please upload a JPG or PNG photo.",
+                        {}, start)
+
+    stat = ImageStat.Stat(gray)
+    # Filters are unreliable on the outermost pixels, so score the interior only
+    interior = (1, 1, max(gray.size[0] - 1, 2), max(gray.size[1] - 1, 2))
+    laplacian = gray.filter(ImageFilter.Kernel((3, 3), (0, 1, 0, 1, -4, 1, 0, 1, 0), scale=1, offset=128)).crop(interior)
+    histogram = gray.filter(ImageFilter.FIND_EDGES).crop(interior).histogram()
+    metrics = {
+        "width": original_size[0],
+        "height": original_size[1],
+        "brightness": round(stat.mean[0], 2),
+        "contrast": round(stat.stddev[0], 2),
+        "sharpness": round(ImageStat.Stat(laplacian).var[0], 2),
+        "edge_density": round(sum(histogram[EDGE_LEVEL:]) / float(sum(histogram) or 1), 4)
+    }
+
+    if metrics["brightness"] < MIN_MEAN_BRIGHTNESS:
+        return _verdict(False, "too_dark",
+                        "The photo is almost completely dark. Please retake it with more light.",
+                        metrics, start)
+    if metrics["contrast"] < MIN_CONTRAST:
+        return _verdict(False, "blank",
+                        "The photo looks blank. Please make sure the receipt fills the frame.",
+                        metrics, start)
+    if metrics["sharpness"] < MIN_SHARPNESS:
+        return _verdict(False, "blurry",
+                        "The photo is too blurry to read. Please hold the camera steady and retake it.",
+                        metrics, start)
+    if metrics["edge_density"] < MIN_EDGE_DENSITY:
+        return _verdict(False, "no_text",
+                        "No printed text was found in the photo. Please upload a picture of a receipt.",
+                        metrics, start)
+    return _verdict(True, "passed", "Image looks like a readable document", metrics, start)
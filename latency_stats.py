@@ -0,0 +1,31 @@
+"""
+Latency statistics
+==================
+
+Percentile summaries of latency samples, shared by the in-process metrics
+(tenant_scheduler.py, ocr_backends.py) and the load tools (load_test.py,
+replay_traffic.py) so their reports read the same way.
+"""
+
+from typing import Dict, Iterable, Optional, Sequence
+
+# The load tools look further into the tail than the live metrics
+TAIL_QUANTILES = (0.50, 0.90, 0.99)
+
+
+def percentiles(samples: Iterable[Optional[float]], quantiles: Sequence[float] = (0.50, 0.95),
+                scale: float = 1.0) -> Dict[str, Optional[float]]:
+    """
+    {"p50": ..., "p95": ..., "max": ...} for the given quantiles, each
+    multiplied by `scale` (1000 turns seconds into milliseconds) and rounded
+    to 0.1. Missing samples (None) are skipped; with none left every value
+    is None.
+    """
+    values = sorted(sample for sample in samples if sample is not None)
+    keys = [f"p{round(q * 100)}" for q in quantiles]
+    if not values:
+        return dict.fromkeys(keys + ["max"])
+    report = {key: round(values[min(len(values) - 1, int(q * len(values)))] * scale, 1)
+              for key, q in zip(keys, quantiles)}
+    report["max"] = round(values[-1] * scale, 1)
+    return report
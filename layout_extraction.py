@@ -0,0 +1,194 @@
+"""
+Layout extraction
+=================
+
+Reads the total and the date from the word boxes Vision returns instead of
+the flattened text. The text chain takes the last line containing "total"
+(which may be SUBTOTAL or TOTAL SAVINGS) and otherwise the largest amount on
+the receipt (which may be the cash tendered or a points balance). Here:
+
+- the total is the amount right-aligned in the price column on the same row
+  as a TOTAL / AMOUNT DUE / BALANCE DUE label; rows whose label also says
+  SUBTOTAL, TAX, SAVINGS, ITEMS, POINTS and the like are not totals
+- the date is the one printed with a time (the transaction stamp), else the
+  one near the header
+
+The words of a receipt are put in a SpatialGrid: buckets of one line height
+by a few line heights, so "the words on this word's row" is a handful of
+bucket reads whatever the size of the receipt, and every TOTAL label is
+resolved in constant time.
+
+A field is None when the geometry is ambiguous (no labelled row, two total
+rows with different amounts at the same rank, several dates of equal
+standing) and the caller falls back to its text extractors. Each field's
+layout hits and fallbacks are counted for /api/metrics. LAYOUT_EXTRACTION=false
+turns it off; bench_layout.py compares it with the text chain.
+"""
+
+import os
+import re
+import statistics
+import threading
+from collections import defaultdict
+from typing import Callable, Dict, List, Optional, Tuple
+
+LAYOUT_EXTRACTION = os.environ.get('LAYOUT_EXTRACTION', 'true').lower() not in ('0', 'false', 'no')
+
+# Receipts bigger than this are left to the (length-bounded) text chain
+MAX_LAYOUT_WORDS = 4000
+# Words are on the same row when their centers are this many line heights apart at most
+ROW_TOLERANCE = 0.6
+# An amount is in the price column when its right edge is this close to the column's
+ALIGN_TOLERANCE = 1.5
+# Grid cells are one line high and this many line heights wide
+CELL_WIDTH_LINES = 4
+# Share of the receipt's height that counts as its header
+HEADER_FRACTION = 0.3
+
+AMOUNT_WORD_RE = re.compile(r'^(?:\$|CAD)?(\d{1,6}(?:,\d{3})*|\d+)[.,](\d{2})-?[A-Z]?$', re.IGNORECASE)
+TIME_RE = re.compile(r'\b\d{1,2}:\d{2}\b')
+
+# Labels of the amount to pay, best first
+TOTAL_RANKS = [({"GRAND", "TOTAL"}, 0), ({"AMOUNT", "DUE"}, 0), ({"BALANCE", "DUE"}, 0), ({"TOTAL"}, 1)]
+# A label with any of these words is some other figure
+NOT_TOTAL = {"SUBTOTAL", "SUB", "SAVINGS", "SAVED", "SAVE", "YOU", "DISCOUNT", "DISCOUNTS", "ITEMS", "ITEM",
+             "QTY", "UNITS", "TAX", "TAXES", "GST", "PST", "HST", "POINTS", "PTS", "BEFORE", "TIP", "CHANGE"}
+
+_stats = {field: {"layout": 0, "fallback": 0} for field in ("total_amount", "date")}
+_stats_lock = threading.Lock()
+
+
+def _token(word: Dict) -> str:
+    return re.sub(r'[^A-Z0-9]', '', word["text"].upper())
+
+
+def _center(word: Dict) -> float:
+    return (word["y0"] + word["y1"]) / 2.0
+
+
+def _amount(word: Dict) -> Optional[float]:
+    match = AMOUNT_WORD_RE.match(word["text"].strip())
+    if not match:
+        return None
+    return float(f"{match.group(1).replace(',', '')}.{match.group(2)}")
+
+
+class SpatialGrid:
+    """The word boxes of one receipt, bucketed by line band and column."""
+
+    def __init__(self, words: List[Dict]):
+        self.words = words
+        self.line_height = statistics.median(w["y1"] - w["y0"] for w in words) or 1.0
+        self.cell_width = self.line_height * CELL_WIDTH_LINES
+        self.left = min(w["x0"] for w in words)
+        self.top = min(w["y0"] for w in words)
+        self.bottom = max(w["y1"] for w in words)
+        self.columns = int((max(w["x1"] for w in words) - self.left) // self.cell_width) + 1
+        self._cells: Dict[Tuple[int, int], List[Dict]] = defaultdict(list)
+        for word in words:
+            self._cells[(self._band(_center(word)), self._column(word["x0"]))].append(word)
+        amounts = [word["x1"] for word in words if _amount(word) is not None]
+        # Right edge of the price column
+        self.amount_edge = statistics.median(amounts) if amounts else None
+
+    def _band(self, y: float) -> int:
+        return int((y - self.top) // self.line_height)
+
+    def _column(self, x: float) -> int:
+        return max(0, int((x - self.left) // self.cell_width))
+
+    def row(self, word: Dict) -> List[Dict]:
+        """The words on the same printed line as `word`, left to right."""
+        center = _center(word)
+        band = self._band(center)
+        found = []
+        for b in (band - 1, band, band + 1):
+            for column in range(self.columns):
+                for other in self._cells.get((b, column), ()):
+                    if abs(_center(other) - center) <= self.line_height * ROW_TOLERANCE:
+                        found.append(other)
+        return sorted(found, key=lambda w: w["x0"])
+
+    def is_aligned(self, word: Dict) -> bool:
+        return self.amount_edge is not None and \
+            abs(word["x1"] - self.amount_edge) <= self.line_height * ALIGN_TOLERANCE
+
+    def lines(self) -> List[Tuple[float, str]]:
+        """(center height, text) of each printed line, top to bottom."""
+        lines: List[Dict] = []
+        for word in sorted(self.words, key=_center):
+            if lines and abs(_center(word) - lines[-1]["center"]) <= self.line_height * ROW_TOLERANCE:
+                lines[-1]["words"].append(word)
+            else:
+                lines.append({"center": _center(word), "words": [word]})
+        return [(line["center"], ' '.join(w["text"] for w in sorted(line["words"], key=lambda w: w["x0"])))
+                for line in lines]
+
+
+def layout_total(grid: SpatialGrid) -> Optional[str]:
+    """The amount on the best-ranked total row, as "CAD 12.34", or None if there is no clear one."""
+    candidates = []
+    for anchor in grid.words:
+        if _token(anchor) not in ("TOTAL", "DUE"):
+            continue
+        row = grid.row(anchor)
+        labels = {_token(word) for word in row if _amount(word) is None}
+        if labels & NOT_TOTAL:
+            continue
+        rank = next((rank for label, rank in TOTAL_RANKS if label <= labels), None)
+        amounts = [word for word in row if word["x0"] >= anchor["x1"] - 1 and _amount(word) is not None]
+        if rank is None or not amounts:
+            continue
+        amount = amounts[-1]  # rightmost: the price column, not a quantity or unit price
+        # Misaligned amounts (e.g. a total printed in the middle of a slip) only count if nothing is aligned
+        candidates.append((not grid.is_aligned(amount), rank, _amount(amount)))
+    if not candidates:
+        return None
+    best = min(candidates)[:2]
+    values = {value for misaligned, rank, value in candidates if (misaligned, rank) == best}
+    if len(values) != 1:
+        return None
+    return f"CAD {values.pop():.2f}"
+
+
+def layout_date(grid: SpatialGrid, parse_date: Callable[[str], Optional[str]]) -> Optional[str]:
+    """
+    The transaction date: a date printed with a time, else one in the header.
+    parse_date reads a date from one line of text (the caller's extractor, so
+    the format matches its text chain). None if several dates tie.
+    """
+    header_bottom = grid.top + (grid.bottom - grid.top) * HEADER_FRACTION
+    candidates = []
+    for center, text in grid.lines():
+        date = parse_date(text)
+        if date:
+            candidates.append((-2 * bool(TIME_RE.search(text)) - (center <= header_bottom), date))
+    if not candidates:
+        return None
+    best = min(score for score, _ in candidates)
+    dates = {date for score, date in candidates if score == best}
+    return dates.pop() if len(dates) == 1 else None
+
+
+def extract_layout_fields(words: Optional[List[Dict]],
+                          parse_date: Callable[[str], Optional[str]]) -> Dict[str, Optional[str]]:
+    """
+    Total and date of one receipt from its word boxes (as from
+    words_from_annotations); a field is None where the caller should use its
+    text extractors.
+    """
+    fields = {"total_amount": None, "date": None}
+    if not LAYOUT_EXTRACTION or not words:
+        return fields
+    if len(words) <= MAX_LAYOUT_WORDS:
+        grid = SpatialGrid(words)
+        fields = {"total_amount": layout_total(grid), "date": layout_date(grid, parse_date)}
+    with _stats_lock:
+        for field, value in fields.items():
+            _stats[field]["layout" if value else "fallback"] += 1
+    return fields
+
+
+def layout_extraction_stats() -> Dict[str, Dict]:
+    with _stats_lock:
+        return {field: dict(counts) for field, counts in _stats.items()}
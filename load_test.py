@@ -0,0 +1,380 @@
+"""
+Load test
+=========
+
+Fires multipart uploads of the images in receipts/ at a scan endpoint and
+reports throughput, error rate and latency percentiles over time, to find
+the saturation point of an app and compare worker counts or pipeline
+settings before deploying.
+
+Load models:
+
+- open loop (--rps): requests arrive at the given rate whether or not
+  earlier ones have finished, like real users. Latency is measured from the
+  scheduled arrival, so a saturated server shows up as growing latency.
+- closed loop (--concurrency): N virtual users each send a request, wait
+  for the response (and --think seconds), and send the next.
+
+Both take a comma-separated list of levels that are held for --stage-seconds
+each, e.g. --rps 5,10,20,40 ramps up in four stages.
+
+Usage:
+    python load_test.py run --url http://localhost:8000/api/scan --rps 5,10,20,40
+    python load_test.py run --url http://localhost:8000/api/scan --concurrency 1,4,16 --stage-seconds 20
+
+A server with a fake OCR backend (no Vision calls or credentials needed):
+
+    gunicorn -w 4 -b :8000 "load_test:fake_ocr_app('app_simple')"
+    python load_test.py serve --app app --port 8000
+
+The fake backend takes LOAD_TEST_OCR_MS (default 300) +/- LOAD_TEST_OCR_JITTER_MS
+(default 100) per call and fails a LOAD_TEST_OCR_ERROR_RATE share of calls
+with a transient Vision error. Uploads get a few random bytes appended so
+every request is a distinct image; --repeat-images sends the files as they
+are, so the result cache and request coalescing take effect. Fake calls are
+counted in a throwaway OCR usage ledger per worker, never in OCR_USAGE_DB.
+"""
+
+import argparse
+import http.client
+import importlib
+import json
+import os
+import random
+import secrets
+import sys
+import tempfile
+import threading
+import time
+import urllib.parse
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+from types import SimpleNamespace
+from typing import Dict, List, Optional, Tuple
+
+from latency_stats import percentiles, TAIL_QUANTILES
+
+LOAD_TEST_OCR_MS = float(os.environ.get('LOAD_TEST_OCR_MS', 300))
+LOAD_TEST_OCR_JITTER_MS = float(os.environ.get('LOAD_TEST_OCR_JITTER_MS', 100))
+LOAD_TEST_OCR_ERROR_RATE = float(os.environ.get('LOAD_TEST_OCR_ERROR_RATE', 0))
+
+IMAGE_EXTENSIONS = ('.jpg', '.jpeg', '.png', '.webp')
+
+FAKE_RECEIPT = """COSTCO WHOLESALE
+Victoria #1234
+KIRKLAND WATER 5.99
+ORGANIC EGGS 8.49
+SUBTOTAL 14.48
+TAX 0.72
+**** TOTAL 15.20
+MASTERCARD $15.20
+2025/08/11 12:34:56"""
+
+
+def _fake_annotations(text: str) -> List[SimpleNamespace]:
+    """Full-text annotation followed by one word box per word, laid out line by line."""
+    def annotation(description, x0, y0, x1, y1):
+        vertices = [SimpleNamespace(x=x, y=y) for x, y in ((x0, y0), (x1, y0), (x1, y1), (x0, y1))]
+        return SimpleNamespace(description=description, bounding_poly=SimpleNamespace(vertices=vertices))
+
+    words = []
+    for row, line in enumerate(text.split('\n')):
+        x = 10
+        for word in line.split():
+            words.append(annotation(word, x, 10 + row * 24, x + 12 * len(word), 28 + row * 24))
+            x += 12 * len(word) + 10
+    width = max(word.bounding_poly.vertices[1].x for word in words)
+    return [annotation(text, 10, 10, width, 28 + row * 24)] + words
+
+
+class FakeVisionClient:
+    """Stands in for vision.ImageAnnotatorClient with a canned receipt and simulated latency."""
+
+    def __init__(self, *args, **kwargs):
+        pass
+
+    def text_detection(self, image=None, **kwargs):
+        time.sleep(max(0.0, random.gauss(LOAD_TEST_OCR_MS, LOAD_TEST_OCR_JITTER_MS / 2)) / 1000)
+        if LOAD_TEST_OCR_ERROR_RATE and random.random() < LOAD_TEST_OCR_ERROR_RATE:
+            from google.api_core import exceptions as google_exceptions
+            raise google_exceptions.ServiceUnavailable("Simulated Vision outage")
+        return SimpleNamespace(text_annotations=_fake_annotations(FAKE_RECEIPT), error=SimpleNamespace(message=""))
+
+
+def fake_ocr_app(module_name: str = 'app'):
+    """
+    The Flask app of `module_name` with Vision replaced by FakeVisionClient.
+    Usable as a gunicorn app factory: "load_test:fake_ocr_app('app_simple')".
+    """
+    from google.cloud import vision
+    vision.ImageAnnotatorClient = FakeVisionClient
+    # Nothing from a load test belongs in the scan store, a traffic capture or the real OCR usage ledger
+    os.environ.setdefault('SCAN_DB_PATH', '')
+    os.environ.setdefault('OCR_LOG_DIR', '')
+    os.environ['TRAFFIC_CAPTURE'] = ''
+    os.environ['OCR_USAGE_DB'] = os.path.join(tempfile.mkdtemp(prefix='load_test_'), 'ocr_usage.db')
+    return importlib.import_module(module_name).app
+
+
+def load_images(directory: str) -> List[Tuple[str, bytes]]:
+    images = []
+    for name in sorted(os.listdir(directory)):
+        if name.lower().endswith(IMAGE_EXTENSIONS):
+            with open(os.path.join(directory, name), 'rb') as f:
+                images.append((name, f.read()))
+    return images
+
+
+class ScanClient:
+    """Posts multipart uploads over one keep-alive connection per thread."""
+
+    def __init__(self, url: str, images: List[Tuple[str, bytes]], repeat_images: bool = False,
+                 headers: Optional[Dict[str, str]] = None, timeout: float = 120):
+        parsed = urllib.parse.urlsplit(url)
+        self.scheme = parsed.scheme
+        self.host = parsed.netloc
+        self.path = parsed.path or '/'
+        self.images = images
+        self.repeat_images = repeat_images
+        self.headers = headers or {}
+        self.timeout = timeout
+        self._local = threading.local()
+        self._counter = 0
+        self._lock = threading.Lock()
+
+    def _next_image(self) -> Tuple[str, bytes]:
+        with self._lock:
+            name, data = self.images[self._counter % len(self.images)]
+            self._counter += 1
+        if not self.repeat_images:
+            # Bytes after the end of the image are ignored by decoders but change its hash
+            data = data + secrets.token_bytes(16)
+        return name, data
+
+    def _connection(self) -> http.client.HTTPConnection:
+        connection = getattr(self._local, 'connection', None)
+        if connection is None:
+            cls = http.client.HTTPSConnection if self.scheme == 'https' else http.client.HTTPConnection
+            connection = self._local.connection = cls(self.host, timeout=self.timeout)
+        return connection
+
+    def send(self) -> int:
+        """One scan upload. Returns the HTTP status, or 0 if the connection failed."""
+        name, data = self._next_image()
+        boundary = secrets.token_hex(16)
+        body = (f'--{boundary}\r\nContent-Disposition: form-data; name="receipt_image"; filename="{name}"\r\n'
+                f'Content-Type: application/octet-stream\r\n\r\n').encode() + data + f'\r\n--{boundary}--\r\n'.encode()
+        headers = dict(self.headers, **{'Content-Type': f'multipart/form-data; boundary={boundary}'})
+        connection = self._connection()
+        try:
+            connection.request('POST', self.path, body=body, headers=headers)
+            response = connection.getresponse()
+            response.read()
+            return response.status
+        except (OSError, http.client.HTTPException):
+            connection.close()
+            self._local.connection = None
+            return 0
+
+
+class Recorder:
+    """Collects (finish time, latency, status) and summarizes them per window."""
+
+    def __init__(self):
+        self.results: List[Tuple[float, float, int, float]] = []
+        self._lock = threading.Lock()
+        self.in_flight = 0
+
+    def start(self) -> None:
+        with self._lock:
+            self.in_flight += 1
+
+    def add(self, finished: float, latency: float, status: int, level: float) -> None:
+        with self._lock:
+            self.in_flight -= 1
+            self.results.append((finished, latency, status, level))
+
+    def window(self, start: float, end: float) -> List[Tuple[float, float, int, float]]:
+        with self._lock:
+            return [result for result in self.results if start <= result[0] < end]
+
+
+def summarize(results: List[Tuple[float, float, int, float]], seconds: float) -> Dict:
+    errors = [result for result in results if result[2] != 200]
+    return {
+        "completed": len(results),
+        "throughput_rps": round((len(results) - len(errors)) / seconds, 2) if seconds else None,
+        "error_rate": round(len(errors) / len(results), 4) if results else None,
+        "status": dict(Counter(str(result[2]) for result in results)),
+        "latency_ms": percentiles([result[1] for result in results], TAIL_QUANTILES, scale=1000)
+    }
+
+
+def run_open_loop(client: ScanClient, recorder: Recorder, levels: List[float], stage_seconds: float,
+                  poisson: bool, max_in_flight: int, started: float) -> int:
+    """Send at each stage's rate regardless of responses. Returns how many arrivals were dropped."""
+    dropped = 0
+
+    def one(due: float, level: float) -> None:
+        status = client.send()
+        finished = time.perf_counter()
+        recorder.add(finished, finished - due, status, level)
+
+    with ThreadPoolExecutor(max_workers=max_in_flight) as pool:
+        due = started
+        for stage, rate in enumerate(levels):
+            stage_end = started + (stage + 1) * stage_seconds
+            while rate > 0:
+                due += random.expovariate(rate) if poisson else 1 / rate
+                if due >= stage_end:
+                    due = stage_end
+                    break
+                delay = due - time.perf_counter()
+                if delay > 0:
+                    time.sleep(delay)
+                if recorder.in_flight >= max_in_flight:
+                    dropped += 1  # the load generator itself is saturated
+                    continue
+                recorder.start()
+                pool.submit(one, due, rate)
+            if rate <= 0:
+                time.sleep(max(0.0, stage_end - time.perf_counter()))
+                due = stage_end
+    return dropped
+
+
+def run_closed_loop(client: ScanClient, recorder: Recorder, levels: List[float], stage_seconds: float,
+                    think: float, started: float) -> int:
+    """Virtual users in a send-wait loop; user i is active while the stage's level is above i."""
+    end = started + len(levels) * stage_seconds
+
+    def level_now() -> float:
+        stage = min(int((time.perf_counter() - started) / stage_seconds), len(levels) - 1)
+        return levels[stage]
+
+    def user(index: int) -> None:
+        while time.perf_counter() < end:
+            level = level_now()
+            if index >= level:
+                time.sleep(0.05)
+                continue
+            recorder.start()
+            sent = time.perf_counter()
+            status = client.send()
+            finished = time.perf_counter()
+            recorder.add(finished, finished - sent, status, level)
+            if think:
+                time.sleep(think)
+
+    threads = [threading.Thread(target=user, args=(index,), daemon=True) for index in range(int(max(levels)))]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return 0
+
+
+def _report_progress(recorder: Recorder, started: float, interval: float, done: threading.Event,
+                     windows: List[Dict], label: str) -> None:
+    print(f"{'t(s)':>6} {label:>7} {'rps':>7} {'err%':>6} {'p50':>8} {'p90':>8} {'p99':>8} {'inflight':>8}",
+          file=sys.stderr)
+    window_start = started
+    while True:
+        finished = done.wait(max(0.0, window_start + interval - time.perf_counter()))
+        window_end = time.perf_counter() if finished else window_start + interval
+        if window_end - window_start < interval / 4:  # too short a tail to say much
+            break
+        results = recorder.window(window_start, window_end)
+        summary = summarize(results, window_end - window_start)
+        level = max((result[3] for result in results), default=None)
+        latency = summary["latency_ms"]
+        windows.append({"t": round(window_end - started, 1), "level": level, "in_flight": recorder.in_flight,
+                        **summary})
+        print(f"{window_end - started:6.1f} {level if level is not None else '-':>7} "
+              f"{summary['throughput_rps']:7.2f} {100 * (summary['error_rate'] or 0):6.1f} "
+              f"{latency['p50'] or '-':>8} {latency['p90'] or '-':>8} {latency['p99'] or '-':>8} "
+              f"{recorder.in_flight:>8}", file=sys.stderr)
+        window_start = window_end
+        if finished:
+            break
+
+
+def _parse_levels(value: str) -> List[float]:
+    return [float(level) for level in value.split(',') if level.strip()]
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Load test a receipt scan endpoint")
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    run = commands.add_parser("run", help="send load and report throughput, errors and latency")
+    run.add_argument("--url", default="http://localhost:8000/api/scan", help="scan endpoint")
+    load = run.add_mutually_exclusive_group(required=True)
+    load.add_argument("--rps", type=_parse_levels, help="open loop: arrival rate per stage, e.g. 5,10,20")
+    load.add_argument("--concurrency", type=_parse_levels, help="closed loop: virtual users per stage, e.g. 1,4,16")
+    run.add_argument("--stage-seconds", type=float, default=30, help="how long each level is held")
+    run.add_argument("--interval", type=float, default=5, help="seconds per progress line")
+    run.add_argument("--images", default="receipts", help="directory of images to upload")
+    run.add_argument("--repeat-images", action="store_true", help="send identical bytes so caches can hit")
+    run.add_argument("--poisson", action="store_true", help="open loop: random (Poisson) instead of even arrivals")
+    run.add_argument("--max-in-flight", type=int, default=512, help="open loop: cap on outstanding requests")
+    run.add_argument("--think", type=float, default=0, help="closed loop: pause between a user's requests")
+    run.add_argument("--header", action="append", default=[], metavar="NAME:VALUE",
+                     help="extra request header, e.g. X-API-Key:... (repeatable)")
+    run.add_argument("--report", help="write the stage and interval summaries to this JSON file")
+
+    serve = commands.add_parser("serve", help="run an app with the fake OCR backend (development server)")
+    serve.add_argument("--app", default="app", help="app module to serve (default app)")
+    serve.add_argument("--port", type=int, default=8000)
+    args = parser.parse_args()
+
+    if args.command == "serve":
+        fake_ocr_app(args.app).run(host='0.0.0.0', port=args.port, threaded=True)
+        return
+
+    images = load_images(args.images) if os.path.isdir(args.images) else []
+    if not images:
+        print(f"No images found in {args.images}")
+        sys.exit(1)
+    headers = dict(header.split(':', 1) for header in args.header if ':' in header)
+    client = ScanClient(args.url, images, args.repeat_images, {k.strip(): v.strip() for k, v in headers.items()})
+    levels = args.rps or args.concurrency
+    recorder = Recorder()
+    windows: List[Dict] = []
+    done = threading.Event()
+    started = time.perf_counter()
+    progress = threading.Thread(target=_report_progress, daemon=True,
+                                args=(recorder, started, args.interval, done, windows, "target" if args.rps else "users"))
+    progress.start()
+    if args.rps:
+        dropped = run_open_loop(client, recorder, levels, args.stage_seconds, args.poisson,
+                                args.max_in_flight, started)
+    else:
+        dropped = run_closed_loop(client, recorder, levels, args.stage_seconds, args.think, started)
+    elapsed = time.perf_counter() - started
+    done.set()
+    progress.join()
+
+    stages = []
+    for stage, level in enumerate(levels):
+        # Requests are attributed to the stage they were sent in
+        stage_start = started + stage * args.stage_seconds
+        results = [result for result in recorder.results
+                   if stage_start <= result[0] - result[1] < stage_start + args.stage_seconds]
+        stages.append({"level": level, **summarize(results, args.stage_seconds)})
+    report = {
+        "url": args.url,
+        "mode": "open" if args.rps else "closed",
+        "duration_s": round(elapsed, 1),
+        "dropped_arrivals": dropped,
+        "overall": summarize(recorder.results, elapsed),
+        "stages": stages
+    }
+    if args.report:
+        with open(args.report, 'w') as f:
+            json.dump(dict(report, intervals=windows), f, indent=2)
+    print(json.dumps(report, indent=2))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,146 @@
+"""
+Merchant-specific extractors
+============================
+
+Once the store is known, the layout of its receipts is too, so the total can
+be read with one tight parser instead of the generic keyword/regex chain.
+Each extractor is registered for a store name (as returned by
+extract_store_name) and returns the total as "CAD 12.34", or None when the
+receipt does not match the expected layout - the caller then falls back to
+the generic chain. Names are compared ignoring case, spaces and punctuation,
+so "PETRO CANADA" and "Petro-Canada" find the same extractor.
+
+Adding a layout only needs a new decorated function:
+
+    @register_extractor("Some Store")
+    def some_store_total(lines):
+        ...
+
+Per-extractor call counts, hit rate and timing are kept for /api/metrics.
+With MERCHANT_SHADOW_RATE > 0, that fraction of hits is also run through the
+generic chain and agreement is counted, as an accuracy signal for new
+extractors.
+"""
+
+import os
+import random
+import re
+import threading
+import time
+from typing import Callable, Dict, List, Optional
+
+SHADOW_RATE = float(os.environ.get('MERCHANT_SHADOW_RATE', 0.0))
+
+# Keyed by store_key(name); the stats by the registered name
+_extractors: Dict[str, Callable[[List[str]], Optional[str]]] = {}
+_names: Dict[str, str] = {}
+_stats: Dict[str, Dict] = {}
+_stats_lock = threading.Lock()
+
+AMOUNT = r'\$?\s?(\d{1,6}(?:,\d{3})*\.\d{2})'
+AMOUNT_RE = re.compile(AMOUNT)
+COSTCO_TOTAL_RE = re.compile(r'^\W*TOTAL\s+' + AMOUNT + r'\s*-?$', re.IGNORECASE)
+PETRO_TOTAL_RE = re.compile(r'^\W*TOTAL(?:\s+SALE)?\W*' + AMOUNT + r'\b', re.IGNORECASE)
+
+
+def store_key(store_name: str) -> str:
+    """'PETRO CANADA' -> 'petrocanada': the form store names are looked up in."""
+    return re.sub(r'[^a-z0-9]', '', store_name.lower())
+
+
+def register_extractor(store_name: str):
+    """Register a total extractor for a store name."""
+    def decorator(fn):
+        _extractors[store_key(store_name)] = fn
+        _names[store_key(store_name)] = store_name
+        _stats[store_name] = {"calls": 0, "hits": 0, "fallbacks": 0, "errors": 0,
+                              "total_ms": 0.0, "shadow_checks": 0, "shadow_agreements": 0}
+        return fn
+    return decorator
+
+
+def _format(amount: str) -> str:
+    return f"CAD {float(amount.replace(',', '')):.2f}"
+
+
+@register_extractor("Costco")
+def costco_total(lines: List[str]) -> Optional[str]:
+    # "**** TOTAL 192.86" - the starred line, never SUBTOTAL or the tax lines
+    for line in reversed(lines):
+        match = COSTCO_TOTAL_RE.match(line.strip())
+        if match:
+            return _format(match.group(1))
+    return None
+
+
+@register_extractor("BC Ferries")
+def bc_ferries_total(lines: List[str]) -> Optional[str]:
+    # "Total Prepaid" with the amount on the same line or the one after it
+    for i, line in enumerate(lines):
+        if 'total prepaid' in line.lower():
+            for candidate in lines[i:i + 2]:
+                match = AMOUNT_RE.search(candidate)
+                if match:
+                    return _format(match.group(1))
+    return None
+
+
+@register_extractor("Petro-Canada")
+def petro_canada_total(lines: List[str]) -> Optional[str]:
+    # Pump receipts print "TOTAL" (or "Total Sale") followed by the amount;
+    # fuel volume and price-per-litre lines carry three decimals and are skipped
+    for line in lines:
+        match = PETRO_TOTAL_RE.match(line.strip())
+        if match:
+            return _format(match.group(1))
+    return None
+
+
+def extract_merchant_total(store_name: Optional[str], text: str,
+                           generic: Optional[Callable[[str], Optional[str]]] = None) -> Optional[str]:
+    """
+    Run the registered extractor for store_name. Returns None if there is no
+    extractor for the store or it could not read the total.
+    """
+    key = store_key(store_name) if store_name else None
+    extractor = _extractors.get(key) if key else None
+    if extractor is None or not text:
+        return None
+
+    start = time.perf_counter()
+    try:
+        total = extractor([line for line in text.split('\n') if line.strip()])
+        failed = False
+    except Exception:
+        total = None
+        failed = True
+    elapsed_ms = (time.perf_counter() - start) * 1000
+
+    shadow = None
+    if total and generic and SHADOW_RATE and random.random() < SHADOW_RATE:
+        shadow = generic(text) == total
+
+    with _stats_lock:
+        stats = _stats[_names[key]]
+        stats["calls"] += 1
+        stats["total_ms"] += elapsed_ms
+        if failed:
+            stats["errors"] += 1
+        if total:
+            stats["hits"] += 1
+        else:
+            stats["fallbacks"] += 1
+        if shadow is not None:
+            stats["shadow_checks"] += 1
+            stats["shadow_agreements"] += int(shadow)
+    return total
+
+
+def merchant_extractor_stats() -> Dict[str, Dict]:
+    with _stats_lock:
+        return {
+            store: dict(stats,
+                        total_ms=round(stats["total_ms"], 3),
+                        avg_ms=round(stats["total_ms"] / stats["calls"], 3) if stats["calls"] else None)
+            for store, stats in _stats.items()
+        }
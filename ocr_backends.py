@@ -0,0 +1,496 @@
+"""
+OCR backends
+============
+
+Text detection behind one interface, so scans are not tied to Google Cloud
+Vision:
+
+    vision      Google Cloud Vision (the default)
+    tesseract   local Tesseract through pytesseract, when both are installed
+    recorded    Vision responses recorded in a capture directory
+                (OCR_RECORDED_DIR), for offline development and fixtures
+
+Every backend returns Vision-style text annotations (the full text, then one
+annotation per word with its box), so segmentation and extraction work the
+same whatever produced the text.
+
+OCR_BACKENDS lists the backends to use, in order of preference (default
+"vision"). OcrRouter picks one per scan by policy:
+
+    primary     the first backend, falling back to the next when it fails
+                (OCR_POLICY, default)
+    cheapest    lowest OCR_COST_<NAME> per image first (OCR_BULK_POLICY,
+                used for bulk scans)
+
+A backend that raises (outage, quota, missing credentials) is put to the
+back of the order for OCR_BACKEND_COOLDOWN seconds, so an outage costs one
+failed call rather than one per scan. An image-level error (OcrError, e.g.
+no recording for the image) just moves on to the next backend.
+
+Every call is counted against the daily OCR budgets (ocr_budget.py). Near a
+budget the router tries the free backends first and skips billable ones
+the governor does not admit; BudgetExceeded is raised when no other backend
+could read the image.
+
+Per-backend calls, errors, fallbacks, latency and how often the extractors
+found every field are in OcrRouter.stats(). To compare backends on an image
+corpus:
+
+    python ocr_backends.py bench receipts/ [--backends vision,tesseract]
+                           [--reference vision] [--record fixtures/]
+
+--record writes the reference backend's responses to a capture directory
+that the recorded backend can serve, e.g. for working without credentials:
+OCR_BACKENDS=recorded OCR_RECORDED_DIR=fixtures/.
+"""
+
+import abc
+import difflib
+import io
+import logging
+import os
+import threading
+import time
+from collections import deque
+from types import SimpleNamespace
+from typing import Callable, Dict, List, Optional
+
+from latency_stats import percentiles
+from ocr_budget import BudgetExceeded, SpendGovernor, open_spend_governor, NORMAL
+from scan_tracing import tracer
+from traffic_capture import iter_responses, annotations_from_json
+
+logger = logging.getLogger(__name__)
+
+OCR_BACKENDS = os.environ.get('OCR_BACKENDS', 'vision')
+OCR_POLICY = os.environ.get('OCR_POLICY', 'primary')
+OCR_BULK_POLICY = os.environ.get('OCR_BULK_POLICY', 'cheapest')
+OCR_BACKEND_COOLDOWN = float(os.environ.get('OCR_BACKEND_COOLDOWN', 30))
+OCR_RECORDED_DIR = os.environ.get('OCR_RECORDED_DIR', 'ocr_fixtures')
+TESSERACT_LANG = os.environ.get('TESSERACT_LANG', 'eng')
+
+PRIMARY = 'primary'
+CHEAPEST = 'cheapest'
+POLICIES = (PRIMARY, CHEAPEST)
+
+# USD per image; Vision TEXT_DETECTION list price after the free tier
+DEFAULT_COSTS = {"vision": 0.0015, "tesseract": 0.0, "recorded": 0.0}
+
+
+def backend_cost(name: str) -> float:
+    """USD per image of a backend (OCR_COST_<NAME>); 0 for a free one."""
+    return float(os.environ.get(f'OCR_COST_{name.upper()}', DEFAULT_COSTS.get(name, 0.0)))
+
+
+class OcrError(Exception):
+    """The backend could not read this image; another backend may."""
+
+
+class OcrResult:
+    """The text annotations of one image and the backend that produced them."""
+
+    def __init__(self, backend: str, annotations: List, ms: float, fallbacks: int = 0):
+        self.backend = backend
+        self.annotations = annotations
+        self.ms = ms
+        self.fallbacks = fallbacks
+
+    @property
+    def text(self) -> str:
+        return self.annotations[0].description if self.annotations else ""
+
+
+def make_annotation(text: str, left: float, top: float, right: float, bottom: float) -> SimpleNamespace:
+    """An object shaped like Vision's EntityAnnotation, with a rectangular box."""
+    vertices = [SimpleNamespace(x=x, y=y) for x, y in ((left, top), (right, top), (right, bottom), (left, bottom))]
+    return SimpleNamespace(description=text, bounding_poly=SimpleNamespace(vertices=vertices))
+
+
+class OcrBackend(abc.ABC):
+    """Base class: detect() returns Vision-style text annotations for image bytes."""
+
+    name = "backend"
+
+    def __init__(self, cost: Optional[float] = None):
+        self.cost = backend_cost(self.name) if cost is None else cost
+
+    def available(self) -> bool:
+        return True
+
+    @abc.abstractmethod
+    def detect(self, image_bytes: bytes, scope=None) -> List:
+        """Annotations for the image; raises OcrError when this backend cannot read it."""
+
+
+class VisionBackend(OcrBackend):
+    """
+    Google Cloud Vision through a shared client. `call(client, image, scope)`
+    makes the request; the apps pass their retrying, cancellable version.
+    """
+
+    name = "vision"
+
+    def __init__(self, get_client: Callable[[], object], call: Optional[Callable] = None,
+                 cost: Optional[float] = None):
+        super().__init__(cost)
+        self.get_client = get_client
+        self.call = call or (lambda client, image, scope: client.text_detection(image=image))
+
+    def detect(self, image_bytes: bytes, scope=None) -> List:
+        from google.cloud import vision
+        response = self.call(self.get_client(), vision.Image(content=image_bytes), scope)
+        if response.error.message:
+            raise OcrError(f"Google Cloud Vision API error: {response.error.message}")
+        return list(response.text_annotations)
+
+
+class TesseractBackend(OcrBackend):
+    """Local Tesseract. Needs pytesseract, Pillow and the tesseract binary."""
+
+    name = "tesseract"
+
+    def __init__(self, lang: str = TESSERACT_LANG, cost: Optional[float] = None):
+        super().__init__(cost)
+        self.lang = lang
+        self._available: Optional[bool] = None
+
+    def available(self) -> bool:
+        if self._available is None:
+            try:
+                import pytesseract
+                from PIL import Image  # noqa: F401
+                pytesseract.get_tesseract_version()
+                self._available = True
+            except Exception:
+                self._available = False
+        return self._available
+
+    def detect(self, image_bytes: bytes, scope=None) -> List:
+        import pytesseract
+        from PIL import Image, ImageOps
+
+        try:
+            image = ImageOps.exif_transpose(Image.open(io.BytesIO(image_bytes))).convert('L')
+        except Exception as e:
+            raise OcrError(f"Could not decode image: {str(e)}")
+        remaining = scope.remaining() if scope else None
+        try:
+            data = pytesseract.image_to_data(image, lang=self.lang, output_type=pytesseract.Output.DICT,
+                                             timeout=remaining or 0)
+        except RuntimeError:
+            # pytesseract kills the process at the timeout, which is the scan deadline
+            if scope:
+                scope.check("ocr")
+            raise
+        return _annotations_from_tesseract(data)
+
+
+def _annotations_from_tesseract(data: Dict[str, List]) -> List:
+    """Tesseract's word table as [full text, word, word, ...], lines kept in reading order."""
+    words = []
+    lines: Dict[tuple, List[str]] = {}
+    for i, text in enumerate(data["text"]):
+        text = text.strip()
+        if not text or float(data["conf"][i]) < 0:
+            continue
+        left, top = data["left"][i], data["top"][i]
+        words.append(make_annotation(text, left, top, left + data["width"][i], top + data["height"][i]))
+        lines.setdefault((data["block_num"][i], data["par_num"][i], data["line_num"][i]), []).append(text)
+    if not words:
+        return []
+    full_text = '\n'.join(' '.join(line) for line in lines.values()) + '\n'
+    xs = [vertex.x for word in words for vertex in word.bounding_poly.vertices]
+    ys = [vertex.y for word in words for vertex in word.bounding_poly.vertices]
+    return [make_annotation(full_text, min(xs), min(ys), max(xs), max(ys))] + words
+
+
+class RecordedBackend(OcrBackend):
+    """
+    Vision responses from a capture directory (responses.jsonl, as written by
+    TRAFFIC_CAPTURE or "bench --record"), looked up by image hash.
+    """
+
+    name = "recorded"
+
+    def __init__(self, directory: str = OCR_RECORDED_DIR, cost: Optional[float] = None):
+        super().__init__(cost)
+        self.directory = directory
+        self._responses: Optional[Dict[str, List]] = None
+        self._lock = threading.Lock()
+
+    def _load(self) -> Dict[str, List]:
+        with self._lock:
+            if self._responses is None:
+                self._responses = {record["image_hash"]: record["annotations"]
+                                   for record in iter_responses(self.directory)}
+            return self._responses
+
+    def available(self) -> bool:
+        return bool(self._load())
+
+    def detect(self, image_bytes: bytes, scope=None) -> List:
+        from scan_coalescing import image_hash
+        records = self._load().get(image_hash(image_bytes))
+        if records is None:
+            raise OcrError(f"No recorded OCR response for this image in {self.directory}")
+        return annotations_from_json(records)
+
+
+class BackendStats:
+    """Calls, failures and latency of one backend over a recent window."""
+
+    def __init__(self, window: int = 1000):
+        self.counts = {"calls": 0, "served": 0, "errors": 0, "image_errors": 0, "over_budget": 0,
+                       "fallback_served": 0, "extracted": 0, "complete": 0}
+        self.latencies = deque(maxlen=window)
+        self.last_error: Optional[str] = None
+        self.down_until = 0.0
+
+
+class OcrRouter:
+    """
+    Picks a backend for each image by policy, falls back on failure, counts
+    calls against the governor's budgets and keeps per-backend stats.
+    """
+
+    def __init__(self, backends: List[OcrBackend], policy: str = OCR_POLICY,
+                 cooldown: float = OCR_BACKEND_COOLDOWN, governor: Optional[SpendGovernor] = None):
+        if not backends:
+            raise ValueError("OcrRouter needs at least one backend")
+        self.backends = backends
+        self.policy = policy if policy in POLICIES else PRIMARY
+        self.cooldown = cooldown
+        self.governor = governor
+        self._lock = threading.Lock()
+        self._stats = {backend.name: BackendStats() for backend in backends}
+
+    def order(self, policy: Optional[str] = None) -> List[OcrBackend]:
+        """The backends to try, best first; cooling-down ones go last rather than away."""
+        policy = policy if policy in POLICIES else self.policy
+        backends = [backend for backend in self.backends if backend.available()] or list(self.backends)
+        if policy == CHEAPEST:
+            backends.sort(key=lambda backend: backend.cost)  # stable, so ties keep OCR_BACKENDS order
+        now = time.monotonic()
+        with self._lock:
+            return sorted(backends, key=lambda backend: self._stats[backend.name].down_until > now)
+
+    def detect(self, image_bytes: bytes, scope=None, policy: Optional[str] = None,
+               tenant: Optional[str] = None, priority: Optional[str] = None) -> OcrResult:
+        """
+        Text annotations from the first backend that succeeds. Raises the last
+        backend's error if all fail, or BudgetExceeded if a billable backend
+        was skipped for the tenant's budget; ScanCancelled is never retried
+        elsewhere.
+        """
+        from scan_cancellation import ScanCancelled
+
+        governor = self.governor
+        # Near the budget, free backends go first whatever the policy
+        pressed = governor is not None and any(backend.cost <= 0 for backend in self.backends) and \
+            governor.level(tenant) != NORMAL
+        if pressed:
+            policy = CHEAPEST
+        error: Optional[Exception] = None
+        over_budget: Optional[BudgetExceeded] = None
+        for tried, backend in enumerate(self.order(policy)):
+            stats = self._stats[backend.name]
+            billable = governor is not None and backend.cost > 0
+            if billable:
+                try:
+                    governor.admit(tenant, backend.name, backend.cost, priority)
+                except BudgetExceeded as e:
+                    with self._lock:
+                        stats.counts["over_budget"] += 1
+                    over_budget = e
+                    continue
+            started = time.perf_counter()
+            with tracer.span(f"ocr.{backend.name}", **{"ocr.backend": backend.name, "ocr.fallback": tried}) as span:
+                try:
+                    annotations = backend.detect(image_bytes, scope)
+                except ScanCancelled:
+                    raise
+                except OcrError as e:
+                    span.record_error(e)
+                    with self._lock:
+                        stats.counts["calls"] += 1
+                        stats.counts["image_errors"] += 1
+                        stats.last_error = str(e)
+                    error = e
+                    continue
+                except Exception as e:
+                    span.record_error(e)
+                    if billable:
+                        governor.refund(tenant, backend.name, backend.cost)
+                    with self._lock:
+                        stats.counts["calls"] += 1
+                        stats.counts["errors"] += 1
+                        stats.last_error = f"{type(e).__name__}: {str(e)}"
+                        stats.down_until = time.monotonic() + self.cooldown
+                    logger.warning(f"OCR backend {backend.name} failed, trying the next one: {str(e)}")
+                    error = e
+                    continue
+            ms = (time.perf_counter() - started) * 1000
+            with self._lock:
+                stats.counts["calls"] += 1
+                stats.counts["served"] += 1
+                stats.counts["fallback_served"] += bool(tried)
+                stats.latencies.append(ms)
+                stats.down_until = 0.0
+            if governor and not billable:
+                governor.record(tenant, backend.name, backend.cost)
+                if pressed or over_budget:
+                    governor.note(tenant, "local")
+            return OcrResult(backend.name, annotations, ms, tried)
+        if over_budget:
+            governor.note(tenant, "deferred" if over_budget.deferred else "refused")
+            raise over_budget
+        raise error
+
+    def record_fields(self, backend: str, fields: Dict[str, Optional[str]]) -> None:
+        """Count whether the extractors found every field in a backend's text (a proxy for its accuracy)."""
+        with self._lock:
+            stats = self._stats.get(backend)
+            if stats:
+                stats.counts["extracted"] += 1
+                stats.counts["complete"] += all(fields.values())
+
+    def stats(self) -> Dict:
+        now = time.monotonic()
+        with self._lock:
+            return {
+                "policy": self.policy,
+                "backends": {
+                    backend.name: {
+                        "cost": backend.cost,
+                        "cooling_down": stats.down_until > now,
+                        **stats.counts,
+                        "complete_rate": round(stats.counts["complete"] / stats.counts["extracted"], 3)
+                        if stats.counts["extracted"] else None,
+                        "latency_ms": percentiles(stats.latencies),
+                        "last_error": stats.last_error
+                    }
+                    for backend in self.backends
+                    for stats in [self._stats[backend.name]]
+                }
+            }
+
+
+def build_backends(names: str = OCR_BACKENDS, get_vision_client: Optional[Callable] = None,
+                   vision_call: Optional[Callable] = None) -> List[OcrBackend]:
+    """The backends named in a comma-separated list (OCR_BACKENDS); unknown names are skipped."""
+    backends = []
+    for name in [name.strip().lower() for name in names.split(',') if name.strip()]:
+        if name == VisionBackend.name:
+            if get_vision_client is None:
+                from google.cloud import vision
+                get_vision_client = vision.ImageAnnotatorClient
+            backends.append(VisionBackend(get_vision_client, vision_call))
+        elif name == TesseractBackend.name:
+            backends.append(TesseractBackend())
+        elif name == RecordedBackend.name:
+            backends.append(RecordedBackend())
+        else:
+            logger.warning(f"Unknown OCR backend {name!r} in OCR_BACKENDS, skipped")
+    return backends
+
+
+def open_ocr_router(get_vision_client: Optional[Callable] = None, vision_call: Optional[Callable] = None,
+                    names: str = OCR_BACKENDS, governor: Optional[SpendGovernor] = None) -> OcrRouter:
+    """
+    The router configured by OCR_BACKENDS and OCR_POLICY (Vision alone if
+    none are valid), counting calls with the process's spend governor.
+    """
+    backends = build_backends(names, get_vision_client, vision_call) or \
+        build_backends('vision', get_vision_client, vision_call)
+    return OcrRouter(backends, governor=governor or open_spend_governor())
+
+
+def _text_similarity(text: str, reference: str) -> float:
+    return difflib.SequenceMatcher(None, text.lower().split(), reference.lower().split(), autojunk=False).ratio()
+
+
+def bench(directory: str, backends: List[OcrBackend], reference: str, extract: Callable[[str], Dict],
+          record_dir: Optional[str] = None, governor: Optional[SpendGovernor] = None) -> Dict:
+    """
+    Run every backend over the images in `directory`: latency, errors, and
+    agreement of text and extracted fields with the reference backend.
+    Billable calls are counted (not limited) as tenant "bench".
+    """
+    from scan_coalescing import image_hash
+
+    paths = sorted(os.path.join(directory, name) for name in os.listdir(directory)
+                   if name.lower().endswith(('.jpg', '.jpeg', '.png', '.webp')))
+    capture = None
+    if record_dir:
+        from traffic_capture import TrafficCapture
+        capture = TrafficCapture(record_dir, mode='meta')
+    results: Dict[str, Dict[str, Dict]] = {backend.name: {} for backend in backends}
+    for path in paths:
+        with open(path, 'rb') as f:
+            image_bytes = f.read()
+        for backend in backends:
+            started = time.perf_counter()
+            try:
+                annotations = backend.detect(image_bytes)
+            except Exception as e:
+                results[backend.name][path] = {"error": f"{type(e).__name__}: {str(e)}"}
+                continue
+            ms = (time.perf_counter() - started) * 1000
+            if governor and backend.cost > 0:
+                governor.record("bench", backend.name, backend.cost)
+            text = annotations[0].description if annotations else ""
+            results[backend.name][path] = {"ms": ms, "text": text, "fields": extract(text)}
+            if capture and backend.name == reference:
+                capture.record_ocr(image_hash(image_bytes), image_bytes, annotations, ms)
+    if capture:
+        capture.close()
+
+    report = {"images": len(paths), "reference": reference, "backends": {}}
+    for backend in backends:
+        scans = results[backend.name]
+        ok = {path: scan for path, scan in scans.items() if "error" not in scan}
+        summary = {
+            "cost_per_image": backend.cost,
+            "errors": len(scans) - len(ok),
+            "latency_ms": percentiles([scan["ms"] for scan in ok.values()]),
+            "complete_rate": round(sum(all(scan["fields"].values()) for scan in ok.values()) / len(ok), 3)
+            if ok else None
+        }
+        if backend.name != reference and reference in results:
+            compared = [(scan, results[reference][path]) for path, scan in ok.items()
+                        if "error" not in results[reference].get(path, {"error": True})]
+            if compared:
+                summary["text_similarity"] = round(sum(_text_similarity(scan["text"], ref["text"])
+                                                       for scan, ref in compared) / len(compared), 3)
+                summary["field_agreement"] = {
+                    field: round(sum(scan["fields"][field] == ref["fields"][field]
+                                     for scan, ref in compared) / len(compared), 3)
+                    for field in compared[0][1]["fields"]
+                }
+        summary["images"] = {os.path.basename(path): scan.get("fields", scan) for path, scan in scans.items()}
+        report["backends"][backend.name] = summary
+    return report
+
+
+if __name__ == "__main__":
+    import argparse
+    import json
+
+    parser = argparse.ArgumentParser(description="Compare OCR backends on a directory of receipt images")
+    commands = parser.add_subparsers(dest="command", required=True)
+    bench_parser = commands.add_parser("bench", help="latency and agreement of each backend on an image corpus")
+    bench_parser.add_argument("directory", help="directory of receipt images, e.g. receipts/")
+    bench_parser.add_argument("--backends", default="vision,tesseract", help="comma-separated backends to run")
+    bench_parser.add_argument("--reference", default="vision", help="backend the others are compared with")
+    bench_parser.add_argument("--record", metavar="DIR", help="save the reference backend's responses for the recorded backend")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO, format="%(levelname)s %(message)s")
+    from scan_receipt_gcp import extract_fields
+
+    selected = [backend for backend in build_backends(args.backends) if backend.available()]
+    skipped = set(name.strip() for name in args.backends.split(',')) - set(backend.name for backend in selected)
+    if skipped:
+        logger.info(f"Not available here, skipped: {', '.join(sorted(skipped))}")
+    print(json.dumps(bench(args.directory, selected, args.reference, extract_fields, args.record,
+                           open_spend_governor()), indent=2))
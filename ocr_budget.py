@@ -0,0 +1,339 @@
+"""
+OCR spend governor
+==================
+
+Counts OCR calls per UTC day, tenant and backend in a ledger shared by every
+entry point (app.py, app_minimal.py, app_simple.py, the Streamlit app and
+scan_receipt_gcp.py), and holds the billable ones (backends with a cost,
+i.e. Vision) to daily budgets:
+
+    OCR_DAILY_BUDGET          billable calls per day across all tenants
+                              (default 0, no limit)
+    OCR_TENANT_DAILY_BUDGET   billable calls per day for each tenant (default
+                              0, no limit); an API key's "ocr_daily_budget"
+                              setting overrides it
+    OCR_BUDGET_SOFT_FRACTION  share of a budget after which scans degrade
+                              (default 0.8)
+    OCR_USAGE_DB              SQLite ledger (default ocr_usage.db); processes
+                              pointing at the same file share their counts.
+                              Empty keeps the counts in this process.
+
+A billable call is reserved in the ledger before it is made, in the same
+transaction as the budget check, so concurrent workers cannot overshoot a
+budget. A call that fails before Vision answers is given back.
+
+Each tenant is at one of three levels, the worst of the daily and its own
+budget:
+
+    normal      under the soft fraction
+    soft        free backends (tesseract, recorded) are tried first, bulk
+                scans never use a billable backend (they are deferred when no
+                free one can read the image), uploads are asked for smaller
+                images and app.py answers images it scanned before from the
+                scan store
+    exhausted   no billable calls until 00:00 UTC; scans are answered from
+                the caches and free backends, or refused
+
+A refused or deferred scan raises BudgetExceeded, which carries the seconds
+until the budgets reset for Retry-After. usage() reports calls, estimated
+cost, levels and degraded scans for the usage endpoints.
+"""
+
+import logging
+import os
+import sqlite3
+import threading
+from datetime import date, datetime, timedelta, timezone
+from typing import Dict, Optional
+
+from tenant_scheduler import load_api_keys, ANONYMOUS_TENANT, BULK
+
+logger = logging.getLogger(__name__)
+
+OCR_DAILY_BUDGET = int(os.environ.get('OCR_DAILY_BUDGET', 0))
+OCR_TENANT_DAILY_BUDGET = int(os.environ.get('OCR_TENANT_DAILY_BUDGET', 0))
+OCR_BUDGET_SOFT_FRACTION = float(os.environ.get('OCR_BUDGET_SOFT_FRACTION', 0.8))
+OCR_USAGE_DB = os.environ.get('OCR_USAGE_DB', 'ocr_usage.db')
+
+NORMAL = "normal"
+SOFT = "soft"
+EXHAUSTED = "exhausted"
+LEVELS = (NORMAL, SOFT, EXHAUSTED)
+
+# Ways a scan was answered more cheaply, counted per tenant and day
+DEGRADED_MODES = ("local", "history", "deferred", "refused")
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS ocr_calls (
+    day TEXT NOT NULL,
+    tenant TEXT NOT NULL,
+    backend TEXT NOT NULL,
+    billable INTEGER NOT NULL,
+    calls INTEGER NOT NULL,
+    cost REAL NOT NULL,
+    PRIMARY KEY (day, tenant, backend)
+);
+CREATE TABLE IF NOT EXISTS ocr_degraded (
+    day TEXT NOT NULL,
+    tenant TEXT NOT NULL,
+    mode TEXT NOT NULL,
+    count INTEGER NOT NULL,
+    PRIMARY KEY (day, tenant, mode)
+);
+"""
+
+
+class BudgetExceeded(Exception):
+    """A billable OCR call was not allowed; retry_after is the number of seconds until the budgets reset."""
+
+    def __init__(self, message: str, retry_after: int, deferred: bool = False):
+        super().__init__(message)
+        self.retry_after = retry_after
+        self.deferred = deferred
+
+
+def _today() -> str:
+    return datetime.now(timezone.utc).date().isoformat()
+
+
+def seconds_until_reset() -> int:
+    """Seconds until the next UTC day, when the daily budgets start again."""
+    now = datetime.now(timezone.utc)
+    tomorrow = datetime.combine(now.date() + timedelta(days=1), datetime.min.time(), tzinfo=timezone.utc)
+    return int((tomorrow - now).total_seconds()) + 1
+
+
+def _level(used: int, budget: int, soft_fraction: float) -> str:
+    if not budget:
+        return NORMAL
+    if used >= budget:
+        return EXHAUSTED
+    if used >= budget * soft_fraction:
+        return SOFT
+    return NORMAL
+
+
+def _worst(*levels: str) -> str:
+    return max(levels, key=LEVELS.index)
+
+
+class UsageLedger:
+    """OCR call counts in SQLite, shared by the processes that open the same file."""
+
+    def __init__(self, path: str = OCR_USAGE_DB):
+        self.path = path or ':memory:'
+        self._lock = threading.Lock()
+        self._conn: Optional[sqlite3.Connection] = None
+        self._pid = None
+
+    def _connect(self) -> sqlite3.Connection:
+        # Reopened after a fork, so workers forked from a preloaded app never share a connection
+        if self._conn is None or self._pid != os.getpid():
+            conn = sqlite3.connect(self.path, timeout=30, check_same_thread=False)
+            if self.path != ':memory:':
+                conn.execute('PRAGMA journal_mode=WAL')
+                conn.execute('PRAGMA synchronous=NORMAL')
+            with conn:
+                conn.executescript(SCHEMA)
+            self._conn, self._pid = conn, os.getpid()
+        return self._conn
+
+    def billable_calls(self, conn: sqlite3.Connection, day: str, tenant: str):
+        """(all tenants, this tenant) billable calls on a day."""
+        return conn.execute("""
+            SELECT COALESCE(SUM(calls), 0), COALESCE(SUM(CASE WHEN tenant = ? THEN calls END), 0)
+            FROM ocr_calls WHERE day = ? AND billable = 1
+        """, (tenant, day)).fetchone()
+
+    def add_calls(self, conn: sqlite3.Connection, day: str, tenant: str, backend: str,
+                  calls: int, cost: float) -> None:
+        conn.execute("""
+            INSERT INTO ocr_calls (day, tenant, backend, billable, calls, cost) VALUES (?, ?, ?, ?, ?, ?)
+            ON CONFLICT (day, tenant, backend) DO UPDATE SET
+                calls = calls + excluded.calls,
+                cost = cost + excluded.cost
+        """, (day, tenant, backend, int(cost > 0), calls, cost))
+
+    def add_degraded(self, conn: sqlite3.Connection, day: str, tenant: str, mode: str) -> None:
+        conn.execute("""
+            INSERT INTO ocr_degraded (day, tenant, mode, count) VALUES (?, ?, ?, 1)
+            ON CONFLICT (day, tenant, mode) DO UPDATE SET count = count + 1
+        """, (day, tenant, mode))
+
+    def transaction(self, check):
+        """Run check(conn) under the ledger's write lock, committing what it adds unless it raises."""
+        with self._lock:
+            conn = self._connect()
+            with conn:
+                # Take the write lock before reading the counts so no other process reserves in between
+                conn.execute("BEGIN IMMEDIATE")
+                return check(conn)
+
+    def query(self, read):
+        """Run read(conn) under the ledger's lock, without a transaction."""
+        with self._lock:
+            return read(self._connect())
+
+    def rows(self, table: str, columns: str, since: str, tenant: Optional[str] = None):
+        where, args = ("day >= ?", (since,)) if tenant is None else ("day >= ? AND tenant = ?", (since, tenant))
+        return self.query(lambda conn: conn.execute(f"SELECT {columns} FROM {table} WHERE {where}", args).fetchall())
+
+
+class SpendGovernor:
+    """Daily OCR budgets per tenant and overall, enforced against a UsageLedger."""
+
+    def __init__(self, ledger: UsageLedger, daily_budget: int = OCR_DAILY_BUDGET,
+                 tenant_budget: int = OCR_TENANT_DAILY_BUDGET, tenant_budgets: Optional[Dict[str, int]] = None,
+                 soft_fraction: float = OCR_BUDGET_SOFT_FRACTION):
+        self.ledger = ledger
+        self.daily_budget = daily_budget
+        self.tenant_budget = tenant_budget
+        self.tenant_budgets = tenant_budgets or {}
+        self.soft_fraction = soft_fraction
+
+    @property
+    def budgeted(self) -> bool:
+        return bool(self.daily_budget or self.tenant_budget or any(self.tenant_budgets.values()))
+
+    def budget_for(self, tenant: str) -> int:
+        return int(self.tenant_budgets.get(tenant, self.tenant_budget) or 0)
+
+    def _levels(self, total: int, used: int, tenant: str) -> str:
+        return _worst(_level(total, self.daily_budget, self.soft_fraction),
+                      _level(used, self.budget_for(tenant), self.soft_fraction))
+
+    def level(self, tenant: Optional[str] = None) -> str:
+        """The tenant's level today (the daily budget's alone without a tenant)."""
+        if not self.budgeted:
+            return NORMAL
+        try:
+            total, used = self.ledger.query(lambda conn: self.ledger.billable_calls(conn, _today(), tenant or ''))
+        except sqlite3.Error as e:
+            logger.warning(f"OCR usage ledger unavailable: {str(e)}")
+            return NORMAL
+        return self._levels(total, used, tenant) if tenant else _level(total, self.daily_budget, self.soft_fraction)
+
+    def admit(self, tenant: Optional[str], backend: str, cost: float, priority: Optional[str] = None) -> None:
+        """
+        Reserve one call to a billable backend, or raise BudgetExceeded.
+        Free backends are not limited (see record). The ledger failing never
+        blocks a scan; the call just goes uncounted.
+        """
+        if cost <= 0:
+            return
+        tenant = tenant or ANONYMOUS_TENANT["tenant"]
+        day = _today()
+
+        def reserve(conn):
+            if self.budgeted:
+                level = self._levels(*self.ledger.billable_calls(conn, day, tenant), tenant)
+                if level == EXHAUSTED:
+                    raise BudgetExceeded("The daily OCR budget is used up. Scans resume at 00:00 UTC.",
+                                         seconds_until_reset())
+                if level == SOFT and priority == BULK:
+                    raise BudgetExceeded("The daily OCR budget is nearly used up, so bulk scans are deferred "
+                                         "until 00:00 UTC.", seconds_until_reset(), deferred=True)
+            self.ledger.add_calls(conn, day, tenant, backend, 1, cost)
+
+        try:
+            self.ledger.transaction(reserve)
+        except sqlite3.Error as e:
+            logger.warning(f"OCR usage ledger unavailable, call not counted: {str(e)}")
+
+    def refund(self, tenant: Optional[str], backend: str, cost: float) -> None:
+        """Give back a reserved call that failed before the backend answered."""
+        if cost > 0:
+            self._write(lambda conn: self.ledger.add_calls(conn, _today(), tenant or ANONYMOUS_TENANT["tenant"],
+                                                           backend, -1, -cost))
+
+    def record(self, tenant: Optional[str], backend: str, cost: float = 0.0) -> None:
+        """Count a call that needs no reservation (a free backend, or a benchmark run)."""
+        self._write(lambda conn: self.ledger.add_calls(conn, _today(), tenant or ANONYMOUS_TENANT["tenant"],
+                                                       backend, 1, cost))
+
+    def note(self, tenant: Optional[str], mode: str) -> None:
+        """Count a scan answered in one of DEGRADED_MODES."""
+        self._write(lambda conn: self.ledger.add_degraded(conn, _today(), tenant or ANONYMOUS_TENANT["tenant"], mode))
+
+    def _write(self, change) -> None:
+        try:
+            self.ledger.transaction(change)
+        except sqlite3.Error as e:
+            logger.warning(f"OCR usage ledger unavailable: {str(e)}")
+
+    def usage(self, tenant: Optional[str] = None, days: int = 1) -> Dict:
+        """
+        Calls, estimated cost, budget and level per tenant for today, the
+        totals, and daily totals for the last `days` days. With a tenant,
+        only that tenant's figures.
+        """
+        today = _today()
+        since = (date.fromisoformat(today) - timedelta(days=max(days, 1) - 1)).isoformat()
+        calls = self.ledger.rows("ocr_calls", "day, tenant, backend, billable, calls, cost", since, tenant)
+        degraded = self.ledger.rows("ocr_degraded", "day, tenant, mode, count", since, tenant)
+
+        tenants: Dict[str, Dict] = {}
+        history: Dict[str, Dict] = {}
+
+        def entry(name):
+            return tenants.setdefault(name, {"billable_calls": 0, "estimated_cost": 0.0, "backends": {},
+                                             "degraded": {}})
+
+        for day, name, backend, billable, count, cost in calls:
+            totals = history.setdefault(day, {"day": day, "billable_calls": 0, "estimated_cost": 0.0})
+            totals["billable_calls"] += count if billable else 0
+            totals["estimated_cost"] += cost
+            if day == today:
+                current = entry(name)
+                current["billable_calls"] += count if billable else 0
+                current["estimated_cost"] += cost
+                current["backends"][backend] = count
+        for day, name, mode, count in degraded:
+            if day == today:
+                entry(name)["degraded"][mode] = count
+
+        total_calls = history.get(today, {}).get("billable_calls", 0)
+        total_level = _level(total_calls, self.daily_budget, self.soft_fraction)
+        for name, current in tenants.items():
+            current["estimated_cost"] = round(current["estimated_cost"], 4)
+            current["budget"] = self.budget_for(name) or None
+            # Where the tenant stands, counting the daily budget too (whose calls are all here without a tenant)
+            current["level"] = self.level(name) if tenant else \
+                _worst(total_level, _level(current["billable_calls"], self.budget_for(name), self.soft_fraction))
+        report = {
+            "day": today,
+            "resets_in_seconds": seconds_until_reset(),
+            "soft_fraction": self.soft_fraction,
+            "tenants": tenants
+        }
+        if tenant is None:
+            report["total"] = {
+                "billable_calls": total_calls,
+                "estimated_cost": round(history.get(today, {}).get("estimated_cost", 0.0), 4),
+                "budget": self.daily_budget or None,
+                "level": total_level
+            }
+        else:
+            report["level"] = self.level(tenant)
+        if days > 1:
+            report["history"] = [{**totals, "estimated_cost": round(totals["estimated_cost"], 4)}
+                                 for _, totals in sorted(history.items())]
+        return report
+
+
+_governor: Optional[SpendGovernor] = None
+_governor_lock = threading.Lock()
+
+
+def open_spend_governor() -> SpendGovernor:
+    """
+    This process's governor, configured from the environment and the API
+    keys' "ocr_daily_budget" settings (one ledger connection per process).
+    """
+    global _governor
+    with _governor_lock:
+        if _governor is None:
+            budgets = {settings["tenant"]: int(settings["ocr_daily_budget"])
+                       for settings in load_api_keys().values() if settings.get("ocr_daily_budget")}
+            _governor = SpendGovernor(UsageLedger(OCR_USAGE_DB), tenant_budgets=budgets)
+        return _governor
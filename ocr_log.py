@@ -0,0 +1,493 @@
+"""
+OCR text log
+============
+
+Append-only segment files holding the full OCR text of every scanned
+receipt, plus a fixed-width offset index and an on-disk hash table over it
+keyed by image hash. Re-extraction,
+search indexing and benchmarks stream texts sequentially from the
+memory-mapped segments instead of reading one row (or one file) per receipt,
+and any single receipt can still be looked up directly by image hash.
+
+Layout of OCR_LOG_DIR (default ocr_log; set it empty to disable):
+
+    segment-00000.log   blocks of records, new segment every OCR_LOG_SEGMENT_BYTES
+    index.bin           one entry per record, in append order
+    keys.bin            open-addressing hash table from (image hash, receipt index)
+                        to the position of its latest index entry
+
+Block:  magic "OCRB" | flags (1 = zstd) | raw length | stored length | payload
+Record: image hash (32 raw bytes) | receipt index | text length | UTF-8 text
+Index:  image hash | receipt index | segment | block offset | text offset | text length
+Keys:   magic "OCRK" | capacity | keys | index entries covered | slots (position + 1, 0 = empty)
+
+Records are buffered into blocks of about OCR_LOG_BLOCK_BYTES and each block
+is compressed with zstd when the zstandard package is installed (and
+OCR_LOG_COMPRESSION is not "none"). A block and its index entries are
+written under an exclusive file lock, so several app processes can share one
+log. Re-logging an image appends a new record; lookups and scans return the
+latest one.
+
+Lookups probe the mapped keys.bin and index.bin directly, so opening the log
+costs nothing per record and every process shares the same pages. The table
+is kept at most half full; growing it writes a new file and marks the old
+one retired, which tells readers in other processes to map it again.
+"""
+
+import atexit
+import logging
+import mmap
+import os
+import struct
+import sys
+import threading
+import time
+from typing import Dict, Iterator, List, Optional, Tuple
+
+try:
+    import fcntl
+except ImportError:  # Windows: single writer process only
+    fcntl = None
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+logger = logging.getLogger(__name__)
+
+OCR_LOG_DIR = os.environ.get('OCR_LOG_DIR', 'ocr_log')
+OCR_LOG_COMPRESSION = os.environ.get('OCR_LOG_COMPRESSION', 'zstd').lower()
+OCR_LOG_BLOCK_BYTES = int(os.environ.get('OCR_LOG_BLOCK_BYTES', 256 * 1024))
+OCR_LOG_SEGMENT_BYTES = int(os.environ.get('OCR_LOG_SEGMENT_BYTES', 256 * 1024 * 1024))
+
+BLOCK_MAGIC = b'OCRB'
+BLOCK_HEADER = struct.Struct('<4sBII')    # magic, flags, raw length, stored length
+RECORD_HEADER = struct.Struct('<32sHI')   # image hash, receipt index, text length
+INDEX_ENTRY = struct.Struct('<32sHIQII')  # image hash, receipt index, segment, block offset, text offset, text length
+FLAG_ZSTD = 1
+
+KEYS_HEADER = struct.Struct('<4sIIQ')     # magic, capacity, keys, index entries covered
+KEYS_SLOT = struct.Struct('<I')           # index entry position + 1, 0 for an empty slot
+KEYS_MAGIC = b'OCRK'
+KEYS_RETIRED = b'OCRX'
+KEYS_MIN_CAPACITY = 1024
+
+INDEX_FILE = 'index.bin'
+KEYS_FILE = 'keys.bin'
+
+
+def _segment_name(segment: int) -> str:
+    return f'segment-{segment:05d}.log'
+
+
+def _home_slot(digest: bytes, index: int, capacity: int) -> int:
+    # The image hash is a SHA-256, so its leading bytes are already uniform
+    return (int.from_bytes(digest[:8], 'little') + index * 0x9E3779B9) & (capacity - 1)
+
+
+class OcrLog:
+    """Append-only OCR text log with a memory-mapped offset index."""
+
+    def __init__(self, directory: str = OCR_LOG_DIR, compression: str = OCR_LOG_COMPRESSION,
+                 block_bytes: int = OCR_LOG_BLOCK_BYTES, segment_bytes: int = OCR_LOG_SEGMENT_BYTES):
+        self.directory = directory
+        self.block_bytes = block_bytes
+        self.segment_bytes = segment_bytes
+        if compression == 'zstd' and zstandard is None:
+            logger.info("zstandard not installed, OCR log blocks are stored uncompressed")
+        self.compress = compression == 'zstd' and zstandard is not None
+        os.makedirs(directory, exist_ok=True)
+        self._lock = threading.Lock()
+        self._pending: List[Tuple[bytes, int, bytes]] = []
+        self._pending_bytes = 0
+        self._maps: Dict[int, mmap.mmap] = {}
+        self._block_cache: Tuple[Optional[Tuple[int, int]], Optional[bytes]] = (None, None)
+        self._index_map: Optional[mmap.mmap] = None
+        self._indexed = 0
+        self._key_map: Optional[mmap.mmap] = None
+        self._index_path = os.path.join(directory, INDEX_FILE)
+        self._keys_path = os.path.join(directory, KEYS_FILE)
+        with self._exclusive():
+            self._repair()
+            self._update_keys()
+
+    def append(self, image_hash: str, texts: List[str]) -> None:
+        """Log the OCR text of each receipt (by position) found in one image."""
+        digest = bytes.fromhex(image_hash)
+        with self._lock:
+            for index, text in enumerate(texts):
+                data = (text or '').encode('utf-8')
+                self._pending.append((digest, index, data))
+                self._pending_bytes += RECORD_HEADER.size + len(data)
+            if self._pending_bytes >= self.block_bytes:
+                self._flush_locked()
+
+    def flush(self) -> None:
+        """Write buffered records out as a block."""
+        with self._lock:
+            self._flush_locked()
+
+    def _flush_locked(self) -> None:
+        if not self._pending:
+            return
+        payload = bytearray()
+        offsets = []
+        for digest, index, data in self._pending:
+            payload += RECORD_HEADER.pack(digest, index, len(data))
+            offsets.append((digest, index, len(payload), len(data)))
+            payload += data
+        flags = 0
+        stored = bytes(payload)
+        if self.compress:
+            stored = zstandard.ZstdCompressor(level=3).compress(stored)
+            flags = FLAG_ZSTD
+        with self._exclusive():
+            segment = self._writable_segment(BLOCK_HEADER.size + len(stored))
+            with open(os.path.join(self.directory, _segment_name(segment)), 'ab') as f:
+                block_offset = f.tell()
+                f.write(BLOCK_HEADER.pack(BLOCK_MAGIC, flags, len(payload), len(stored)))
+                f.write(stored)
+            # Index entries are written only after their block is complete, so a
+            # crash never leaves an entry pointing at a partial block
+            with open(self._index_path, 'ab') as f:
+                f.write(b''.join(
+                    INDEX_ENTRY.pack(digest, index, segment, block_offset, offset, length)
+                    for digest, index, offset, length in offsets
+                ))
+            self._update_keys()
+        self._pending = []
+        self._pending_bytes = 0
+
+    def _writable_segment(self, size: int) -> int:
+        segments = self._segments()
+        if not segments:
+            return 0
+        last = segments[-1]
+        current = os.path.getsize(os.path.join(self.directory, _segment_name(last)))
+        if current and current + size > self.segment_bytes:
+            return last + 1
+        return last
+
+    def _exclusive(self):
+        return _FileLock(os.path.join(self.directory, '.lock'))
+
+    def _repair(self) -> None:
+        """Drop a torn index entry and any block written after the last indexed one."""
+        if not os.path.exists(self._index_path):
+            open(self._index_path, 'ab').close()
+        size = os.path.getsize(self._index_path)
+        whole = size - size % INDEX_ENTRY.size
+        if whole != size:
+            os.truncate(self._index_path, whole)
+        segments = self._segments()
+        if not segments:
+            return
+        end = 0
+        if whole:
+            with open(self._index_path, 'rb') as f:
+                f.seek(whole - INDEX_ENTRY.size)
+                _, _, segment, block_offset, _, _ = INDEX_ENTRY.unpack(f.read(INDEX_ENTRY.size))
+            if segment == segments[-1]:
+                with open(os.path.join(self.directory, _segment_name(segment)), 'rb') as f:
+                    f.seek(block_offset)
+                    _, _, _, stored_len = BLOCK_HEADER.unpack(f.read(BLOCK_HEADER.size))
+                end = block_offset + BLOCK_HEADER.size + stored_len
+        path = os.path.join(self.directory, _segment_name(segments[-1]))
+        if os.path.getsize(path) > end:
+            logger.warning(f"Truncating unindexed tail of {path} at {end}")
+            os.truncate(path, end)
+
+    def _segments(self) -> List[int]:
+        return sorted(
+            int(name[8:13]) for name in os.listdir(self.directory)
+            if name.startswith('segment-') and name.endswith('.log')
+        )
+
+    def _map_index(self) -> None:
+        """Map index entries appended since the last call (by any process)."""
+        count = os.path.getsize(self._index_path) // INDEX_ENTRY.size
+        if count == self._indexed:
+            return
+        if count:
+            # The old map is dropped rather than closed: a scan may still be reading it
+            with open(self._index_path, 'rb') as f:
+                self._index_map = mmap.mmap(f.fileno(), count * INDEX_ENTRY.size, access=mmap.ACCESS_READ)
+        else:
+            self._index_map = None
+        self._indexed = count
+
+    def _entry(self, position: int) -> Tuple[bytes, int, int, int, int, int]:
+        if position >= self._indexed:
+            self._map_index()
+        return INDEX_ENTRY.unpack_from(self._index_map, position * INDEX_ENTRY.size)
+
+    def _probe(self, table: mmap.mmap, digest: bytes, index: int) -> Tuple[int, int]:
+        """(slot, index entry position) of a key; the position is -1 and the slot free when it is missing."""
+        _, capacity, _, _ = KEYS_HEADER.unpack_from(table, 0)
+        slot = _home_slot(digest, index, capacity)
+        while True:
+            value = KEYS_SLOT.unpack_from(table, KEYS_HEADER.size + slot * KEYS_SLOT.size)[0]
+            if not value:
+                return slot, -1
+            entry = self._entry(value - 1)
+            if entry[0] == digest and entry[1] == index:
+                return slot, value - 1
+            slot = (slot + 1) & (capacity - 1)
+
+    def _keys_map(self) -> mmap.mmap:
+        """The key table, mapped again when a writer has replaced it (caller holds _lock)."""
+        if self._key_map is None or self._key_map[:4] == KEYS_RETIRED:
+            with open(self._keys_path, 'rb') as f:
+                self._key_map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        return self._key_map
+
+    def _lookup(self, digest: bytes, index: int) -> Optional[int]:
+        """Position of the latest index entry for a receipt, or None (caller holds _lock)."""
+        position = self._probe(self._keys_map(), digest, index)[1]
+        return position if position >= 0 else None
+
+    def _update_keys(self) -> None:
+        """Add index entries the key table does not cover yet (caller holds the file lock)."""
+        self._map_index()
+        count = self._indexed
+        table = None
+        if os.path.exists(self._keys_path):
+            with open(self._keys_path, 'r+b') as f:
+                if os.fstat(f.fileno()).st_size >= KEYS_HEADER.size:
+                    table = mmap.mmap(f.fileno(), 0)
+        if table is not None:
+            magic, capacity, _, covered = KEYS_HEADER.unpack_from(table, 0)
+            if (magic != KEYS_MAGIC or len(table) != KEYS_HEADER.size + capacity * KEYS_SLOT.size
+                    or covered > count):
+                # Torn, or ahead of an index that _repair() cut back: rebuild from the index
+                table = self._replace_keys(table, KEYS_MIN_CAPACITY, 0, [])
+        else:
+            table = self._replace_keys(None, KEYS_MIN_CAPACITY, 0, [])
+        _, capacity, keys, covered = KEYS_HEADER.unpack_from(table, 0)
+        if covered == count:
+            table.close()
+            return
+        if (keys + count - covered) * 2 > capacity:
+            while (keys + count - covered) * 2 > capacity:
+                capacity *= 2
+            positions = [value - 1 for (value,) in KEYS_SLOT.iter_unpack(table[KEYS_HEADER.size:]) if value]
+            table = self._replace_keys(table, capacity, covered, positions)
+        for position in range(covered, count):
+            slot, previous = self._probe(table, *self._entry(position)[:2])
+            KEYS_SLOT.pack_into(table, KEYS_HEADER.size + slot * KEYS_SLOT.size, position + 1)
+            if previous < 0:
+                keys += 1
+        # The header goes last: a crash before it only makes the next open redo these entries
+        KEYS_HEADER.pack_into(table, 0, KEYS_MAGIC, capacity, keys, count)
+        table.close()
+
+    def _replace_keys(self, old: Optional[mmap.mmap], capacity: int, covered: int,
+                      positions: List[int]) -> mmap.mmap:
+        """Swap in a new key table holding positions, retiring the old one."""
+        temp = self._keys_path + '.tmp'
+        with open(temp, 'w+b') as f:
+            f.truncate(KEYS_HEADER.size + capacity * KEYS_SLOT.size)
+            table = mmap.mmap(f.fileno(), 0)
+        KEYS_HEADER.pack_into(table, 0, KEYS_MAGIC, capacity, len(positions), covered)
+        for position in positions:
+            slot, _ = self._probe(table, *self._entry(position)[:2])
+            KEYS_SLOT.pack_into(table, KEYS_HEADER.size + slot * KEYS_SLOT.size, position + 1)
+        if old is not None:
+            # Readers elsewhere still map the old file; this tells them to map the new one
+            old[:4] = KEYS_RETIRED
+            old.close()
+        if self._key_map is not None:
+            self._key_map.close()
+            self._key_map = None
+        os.replace(temp, self._keys_path)
+        return table
+
+    def _segment_map(self, segment: int, needed: int) -> mmap.mmap:
+        current = self._maps.get(segment)
+        if current is None or len(current) < needed:
+            # The shorter map is dropped, not closed: text views handed out by get()
+            # and scan() may still point into it, and it is unmapped once they are gone
+            with open(os.path.join(self.directory, _segment_name(segment)), 'rb') as f:
+                current = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            self._maps[segment] = current
+        return current
+
+    def _block_payload(self, segment: int, block_offset: int):
+        """Return (payload buffer, block end) for the block at block_offset."""
+        data = self._segment_map(segment, block_offset + BLOCK_HEADER.size)
+        magic, flags, raw_len, stored_len = BLOCK_HEADER.unpack_from(data, block_offset)
+        if magic != BLOCK_MAGIC:
+            raise ValueError(f"Corrupt OCR log block at {_segment_name(segment)}:{block_offset}")
+        start = block_offset + BLOCK_HEADER.size
+        end = start + stored_len
+        data = self._segment_map(segment, end)
+        if not flags & FLAG_ZSTD:
+            return memoryview(data)[start:end], end
+        if zstandard is None:
+            raise RuntimeError("OCR log contains zstd blocks; install zstandard to read them")
+        if self._block_cache[0] == (segment, block_offset):
+            return self._block_cache[1], end
+        payload = memoryview(zstandard.ZstdDecompressor().decompress(data[start:end], max_output_size=raw_len))
+        self._block_cache = ((segment, block_offset), payload)
+        return payload, end
+
+    def get(self, image_hash: str, receipt_index: int = 0) -> Optional[str]:
+        """Latest logged text for one receipt of an image, or None."""
+        key = (bytes.fromhex(image_hash), receipt_index)
+        with self._lock:
+            for digest, index, data in reversed(self._pending):
+                if (digest, index) == key:
+                    return data.decode('utf-8')
+            position = self._lookup(*key)
+            if position is None:
+                return None
+            _, _, segment, block_offset, offset, length = self._entry(position)
+            payload, _ = self._block_payload(segment, block_offset)
+            return bytes(payload[offset:offset + length]).decode('utf-8')
+
+    def scan(self, latest_only: bool = True) -> Iterator[Tuple[str, int, memoryview]]:
+        """
+        Stream (image hash, receipt index, text bytes) in log order. The text is
+        a memoryview into the mapped segment (or the decompressed block), so
+        nothing is copied until the caller decodes it. With latest_only,
+        records superseded by a later log of the same image are skipped.
+        """
+        self.flush()
+        for segment in self._segments():
+            block_offset = 0
+            size = os.path.getsize(os.path.join(self.directory, _segment_name(segment)))
+            while block_offset + BLOCK_HEADER.size <= size:
+                payload, block_end = self._block_payload(segment, block_offset)
+                position = 0
+                while position < len(payload):
+                    digest, index, length = RECORD_HEADER.unpack_from(payload, position)
+                    position += RECORD_HEADER.size
+                    if latest_only:
+                        with self._lock:
+                            latest = self._lookup(digest, index)
+                            entry = self._entry(latest) if latest is not None else None
+                        if entry is None or (entry[2], entry[3], entry[4]) != (segment, block_offset, position):
+                            position += length
+                            continue
+                    yield digest.hex(), index, payload[position:position + length]
+                    position += length
+                block_offset = block_end
+
+    def iter_batches(self, batch_size: int = 500) -> Iterator[List[Dict]]:
+        """Yield the latest text of every logged receipt, batch_size at a time."""
+        batch = []
+        for image_hash, index, text in self.scan():
+            batch.append({"image_hash": image_hash, "receipt_index": index,
+                          "ocr_text": str(text, 'utf-8')})
+            if len(batch) >= batch_size:
+                yield batch
+                batch = []
+        if batch:
+            yield batch
+
+    def stats(self) -> Dict:
+        with self._lock:
+            self._map_index()
+            segments = self._segments()
+            return {
+                "directory": self.directory,
+                "segments": len(segments),
+                "bytes": sum(os.path.getsize(os.path.join(self.directory, _segment_name(s))) for s in segments),
+                "records": self._indexed,
+                "receipts": KEYS_HEADER.unpack_from(self._keys_map(), 0)[2],
+                "pending": len(self._pending),
+                "compression": "zstd" if self.compress else "none"
+            }
+
+    def close(self) -> None:
+        self.flush()
+        for data in list(self._maps.values()) + [self._index_map, self._key_map]:
+            if data is None:
+                continue
+            try:
+                data.close()
+            except BufferError:
+                pass  # a text view from scan() is still alive; the map goes with it
+        self._maps.clear()
+        self._block_cache = (None, None)
+        self._index_map = None
+        self._indexed = 0
+        self._key_map = None
+
+
+class _FileLock:
+    """Exclusive advisory lock on a file shared by every process writing the log."""
+
+    def __init__(self, path: str):
+        self.path = path
+        self.handle = None
+
+    def __enter__(self):
+        self.handle = open(self.path, 'a')
+        if fcntl:
+            fcntl.flock(self.handle, fcntl.LOCK_EX)
+        return self
+
+    def __exit__(self, *exc):
+        if fcntl:
+            fcntl.flock(self.handle, fcntl.LOCK_UN)
+        self.handle.close()
+
+
+def open_ocr_log() -> Optional[OcrLog]:
+    """Open the configured log (flushed at exit), or return None when it is disabled."""
+    if not OCR_LOG_DIR:
+        return None
+    log = OcrLog(OCR_LOG_DIR)
+    atexit.register(log.flush)
+    return log
+
+
+def main():
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Inspect, fill and benchmark the OCR text log")
+    parser.add_argument("--dir", default=OCR_LOG_DIR or "ocr_log", help="log directory")
+    sub = parser.add_subparsers(dest="command", required=True)
+    sub.add_parser("stats", help="show segment, record and size counts")
+    get = sub.add_parser("get", help="print the logged text of one receipt")
+    get.add_argument("image_hash")
+    get.add_argument("--receipt", type=int, default=0, help="receipt index within the image")
+    fill = sub.add_parser("import", help="append every OCR text from a scan store database")
+    fill.add_argument("--db", default="scans.db")
+    sub.add_parser("scan", help="stream the whole log and report throughput")
+    args = parser.parse_args()
+
+    log = OcrLog(args.dir)
+    if args.command == "stats":
+        print(log.stats())
+    elif args.command == "get":
+        text = log.get(args.image_hash, args.receipt)
+        if text is None:
+            print("Not found")
+            sys.exit(1)
+        print(text)
+    elif args.command == "import":
+        from scan_store import ScanStore
+
+        count = 0
+        for image_hash, texts in ScanStore(args.db).iter_texts_by_image():
+            log.append(image_hash, texts)
+            count += len(texts)
+        log.close()
+        print(f"Imported {count} receipt texts into {args.dir}")
+    elif args.command == "scan":
+        start = time.perf_counter()
+        records = 0
+        size = 0
+        for _, _, text in log.scan():
+            records += 1
+            size += len(text)
+        elapsed = time.perf_counter() - start
+        print(f"{records} receipts, {size / 1e6:.1f} MB of text in {elapsed:.2f}s "
+              f"({records / elapsed if elapsed else 0:.0f} receipts/s, {size / 1e6 / elapsed if elapsed else 0:.0f} MB/s)")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,124 @@
+"""
+Receipt segmentation
+====================
+
+Splits the word annotations of a single Google Cloud Vision response into
+separate receipt regions, so a photo of several receipts laid side by side
+(or stacked) can be served by one OCR call.
+
+The split is a recursive XY-cut over the word bounding boxes: a region is
+cut along the widest empty vertical (then horizontal) band, and a cut is only
+kept when every resulting part still looks like a receipt on its own. This
+stops a single receipt from being split between its item column and its
+price column.
+"""
+
+from typing import Dict, List, Optional
+
+# A gap must be at least this many median word heights wide to be a cut
+MIN_GAP_FACTOR = 3.0
+# Minimum content for a region to count as a receipt on its own
+MIN_REGION_WORDS = 8
+MIN_REGION_ALPHA_WORDS = 3
+
+
+def words_from_annotations(annotations) -> List[Dict]:
+    """Convert Vision word annotations (``text_annotations[1:]``) into word boxes."""
+    words = []
+    for annotation in annotations:
+        vertices = annotation.bounding_poly.vertices
+        if not vertices:
+            continue
+        xs = [v.x for v in vertices]
+        ys = [v.y for v in vertices]
+        words.append({
+            "text": annotation.description,
+            "x0": min(xs),
+            "y0": min(ys),
+            "x1": max(xs),
+            "y1": max(ys)
+        })
+    return words
+
+
+def _median(values: List[float]) -> float:
+    values = sorted(values)
+    if not values:
+        return 0.0
+    mid = len(values) // 2
+    if len(values) % 2:
+        return float(values[mid])
+    return (values[mid - 1] + values[mid]) / 2.0
+
+
+def _looks_like_receipt(words: List[Dict]) -> bool:
+    if len(words) < MIN_REGION_WORDS:
+        return False
+    alpha_words = [w for w in words if sum(c.isalpha() for c in w["text"]) >= 3]
+    has_amount = any(any(c.isdigit() for c in w["text"]) and ('.' in w["text"] or ',' in w["text"])
+                     for w in words)
+    return len(alpha_words) >= MIN_REGION_ALPHA_WORDS and has_amount
+
+
+def _widest_gap(words: List[Dict], lo: str, hi: str) -> Optional[tuple]:
+    """Return (gap_size, cut_position) of the widest empty band along one axis."""
+    intervals = sorted((w[lo], w[hi]) for w in words)
+    best = None
+    reach = intervals[0][1]
+    for start, end in intervals[1:]:
+        if start > reach:
+            gap = start - reach
+            if best is None or gap > best[0]:
+                best = (gap, (start + reach) / 2.0)
+        reach = max(reach, end)
+    return best
+
+
+def _split(words: List[Dict], min_gap: float) -> List[List[Dict]]:
+    for lo, hi in (("x0", "x1"), ("y0", "y1")):
+        gap = _widest_gap(words, lo, hi)
+        if gap is None or gap[0] < min_gap:
+            continue
+        cut = gap[1]
+        first = [w for w in words if w[hi] <= cut]
+        second = [w for w in words if w[lo] >= cut]
+        if _looks_like_receipt(first) and _looks_like_receipt(second):
+            return _split(first, min_gap) + _split(second, min_gap)
+    return [words]
+
+
+def segment_words(words: List[Dict]) -> List[List[Dict]]:
+    """Group word boxes into receipt regions, ordered left-to-right then top-to-bottom."""
+    if not words:
+        return []
+    median_height = _median([w["y1"] - w["y0"] for w in words]) or 1.0
+    regions = _split(words, MIN_GAP_FACTOR * median_height)
+    return sorted(regions, key=lambda r: (min(w["x0"] for w in r), min(w["y0"] for w in r)))
+
+
+def region_text(words: List[Dict]) -> str:
+    """Rebuild reading-order text for a region by grouping words into lines."""
+    if not words:
+        return ""
+    median_height = _median([w["y1"] - w["y0"] for w in words]) or 1.0
+    lines = []
+    for word in sorted(words, key=lambda w: (w["y0"] + w["y1"]) / 2.0):
+        center = (word["y0"] + word["y1"]) / 2.0
+        if lines and abs(center - lines[-1]["center"]) <= median_height / 2.0:
+            lines[-1]["words"].append(word)
+        else:
+            lines.append({"center": center, "words": [word]})
+    return '\n'.join(
+        ' '.join(w["text"] for w in sorted(line["words"], key=lambda w: w["x0"]))
+        for line in lines
+    )
+
+
+def region_bounds(words: List[Dict]) -> Dict[str, int]:
+    """Bounding box of a region in image pixel coordinates."""
+    return {
+        "x0": min(w["x0"] for w in words),
+        "y0": min(w["y0"] for w in words),
+        "x1": max(w["x1"] for w in words),
+        "y1": max(w["y1"] for w in words)
+    }
@@ -0,0 +1,170 @@
+"""
+Re-extract stored scans
+=======================
+
+Replays the current store/total/date extractors over the OCR text saved in
+the scan store, writes changed fields back and produces a diff report. No
+Vision calls are made, so rule changes can be rolled out across the whole
+history in minutes.
+
+Usage:
+    python reextract.py [--db scans.db] [--workers N] [--batch-size 500]
+                        [--extractors app] [--report reextract_report.jsonl] [--dry-run]
+                        [--ocr-log DIR]
+
+With --ocr-log the texts are streamed from the OCR text log (ocr_log.py)
+instead of the database, which only supplies the current fields.
+
+The extractors module must provide extract_receipt_fields(text) (app.py does)
+or extract_store_name / extract_total_amount / extract_date.
+"""
+
+import argparse
+import importlib
+import json
+import os
+import sys
+import time
+from collections import Counter, deque
+from concurrent.futures import ProcessPoolExecutor
+from typing import Dict, Iterator, List, Tuple
+
+from scan_store import ScanStore, SCAN_DB_PATH, FIELDS
+from ocr_log import OcrLog
+
+_extract = None
+
+
+def _init_worker(module_name: str) -> None:
+    """Load the extractors once per worker process."""
+    global _extract
+    import ocr_log
+    import scan_store
+    import warmup
+
+    # Workers only extract; keep the imported app from opening its own scan store and log
+    # or warming up a Vision client
+    scan_store.SCAN_DB_PATH = ''
+    ocr_log.OCR_LOG_DIR = ''
+    warmup.WARMUP_ENABLED = False
+    module = importlib.import_module(module_name)
+    if hasattr(module, 'extract_receipt_fields'):
+        _extract = module.extract_receipt_fields
+    else:
+        from extraction_limits import bound_text
+
+        def _extract(text):
+            text = bound_text(text)
+            return {
+                "store_name": module.extract_store_name(text),
+                "total_amount": module.extract_total_amount(text),
+                "date": module.extract_date(text)
+            }
+
+
+def _reextract_batch(batch: List[Dict]) -> List[Tuple[Dict, Dict]]:
+    """Run the extractors over a batch. Returns (scan, new fields) for changed scans."""
+    changed = []
+    for scan in batch:
+        fields = _extract(scan["ocr_text"])
+        new = {field: fields.get(field) for field in FIELDS}
+        if new != scan["fields"]:
+            changed.append(({"id": scan["id"], "image_hash": scan["image_hash"], "fields": scan["fields"]}, new))
+    return changed
+
+
+def _log_batches(store: ScanStore, log: OcrLog, batch_size: int) -> Iterator[List[Dict]]:
+    """Batches of logged texts joined with the scan id and fields from the store."""
+    for batch in log.iter_batches(batch_size):
+        known = store.fields_by_key([(item["image_hash"], item["receipt_index"]) for item in batch])
+        scans = []
+        for item in batch:
+            for scan_id, fields in known.get((item["image_hash"], item["receipt_index"]), []):
+                scans.append({"id": scan_id, "image_hash": item["image_hash"],
+                              "ocr_text": item["ocr_text"], "fields": fields})
+        if scans:
+            yield scans
+
+
+def reextract(store: ScanStore, module_name: str = "app", workers: int = None, batch_size: int = 500,
+              report_path: str = None, dry_run: bool = False, on_change=None,
+              ocr_log: OcrLog = None) -> Dict:
+    """
+    Re-extract every stored scan in parallel, reading the texts from ocr_log
+    when one is given. on_change(scan, new_fields) is called for each changed
+    scan before it is written back.
+    """
+    start = time.perf_counter()
+    workers = workers or os.cpu_count() or 1
+    scanned = 0
+    changed_scans = 0
+    field_changes = Counter()
+    report = open(report_path, 'w') if report_path else None
+
+    def apply(changed):
+        nonlocal changed_scans
+        for scan, new in changed:
+            for field in FIELDS:
+                if scan["fields"][field] != new[field]:
+                    field_changes[field] += 1
+                    if report:
+                        report.write(json.dumps({
+                            "id": scan["id"], "image_hash": scan["image_hash"], "field": field,
+                            "old": scan["fields"][field], "new": new[field]
+                        }) + '\n')
+            if on_change:
+                on_change(scan, new)
+        if changed and not dry_run:
+            store.update_fields([(scan["id"], new) for scan, new in changed])
+        changed_scans += len(changed)
+
+    try:
+        with ProcessPoolExecutor(max_workers=workers, initializer=_init_worker, initargs=(module_name,)) as pool:
+            # Keep a bounded number of batches in flight so memory stays flat however large the store is
+            in_flight = deque()
+            batches = _log_batches(store, ocr_log, batch_size) if ocr_log else store.iter_batches(batch_size)
+            for batch in batches:
+                scanned += len(batch)
+                in_flight.append(pool.submit(_reextract_batch, batch))
+                if len(in_flight) >= workers * 2:
+                    apply(in_flight.popleft().result())
+            while in_flight:
+                apply(in_flight.popleft().result())
+    finally:
+        if report:
+            report.close()
+
+    elapsed = time.perf_counter() - start
+    return {
+        "scanned": scanned,
+        "changed": changed_scans,
+        "field_changes": dict(field_changes),
+        "dry_run": dry_run,
+        "elapsed_seconds": round(elapsed, 2),
+        "receipts_per_second": round(scanned / elapsed, 1) if elapsed else None
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Re-extract stored scans with the current extractors")
+    parser.add_argument("--db", default=SCAN_DB_PATH or "scans.db", help="scan store database")
+    parser.add_argument("--workers", type=int, default=os.cpu_count(), help="worker processes")
+    parser.add_argument("--batch-size", type=int, default=500, help="scans per worker task")
+    parser.add_argument("--extractors", default="app", help="module providing the extractors")
+    parser.add_argument("--report", default="reextract_report.jsonl", help="JSON Lines diff report")
+    parser.add_argument("--dry-run", action="store_true", help="report changes without writing them")
+    parser.add_argument("--ocr-log", help="read the texts from this OCR text log directory")
+    args = parser.parse_args()
+
+    if not os.path.exists(args.db):
+        print(f"Scan store not found: {args.db}")
+        sys.exit(1)
+
+    summary = reextract(ScanStore(args.db), args.extractors, args.workers, args.batch_size,
+                        args.report, args.dry_run, ocr_log=OcrLog(args.ocr_log) if args.ocr_log else None)
+    print(json.dumps(summary, indent=2))
+    print(f"Diff report written to {args.report}")
+
+
+if __name__ == "__main__":
+    main()
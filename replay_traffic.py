@@ -0,0 +1,240 @@
+"""
+Traffic replay
+==============
+
+Re-drives a capture made with TRAFFIC_CAPTURE (see traffic_capture.py)
+against an app variant, with the original arrival times at 1x or
+accelerated speed, and reports latency, queueing and throughput. OCR is
+answered from the recorded Vision responses with the recorded latency, so
+no Vision calls are made and runs are repeatable.
+
+Usage:
+    python replay_traffic.py run CAPTURE_DIR [--app app | --url URL] [--speed 1]
+                             [--clients 64] [--limit N] [--api-key TENANT=KEY ...]
+                             [--results replay_results.jsonl]
+    python replay_traffic.py serve CAPTURE_DIR [--app app] [--port 8080] [--speed 1]
+
+"run --app" imports the app module in-process with the recorded OCR backend
+and the settings from the environment (e.g. OCR_CONCURRENCY), so a
+config change is tested by running it twice with different values. "serve"
+starts an app with the recorded backend for "run --url", e.g. to test the
+gunicorn worker count.
+
+At --speed N arrivals and OCR latencies are both N times faster, which keeps
+the load shape; the report also gives latencies scaled back to 1x. Latency
+is measured from each request's scheduled arrival, so a backlog on the
+replay side is not hidden. Queue wait and OCR time come from the
+Server-Timing header of app.py responses.
+
+Captures made without images (TRAFFIC_CAPTURE=meta) send filler bytes of
+the recorded size, so the in-process run turns the image prescreen off.
+Recorded OCR calls made by "run --app" and "serve" are counted in a
+throwaway OCR usage ledger, never in OCR_USAGE_DB.
+"""
+
+import argparse
+import importlib
+import io
+import json
+import os
+import re
+import secrets
+import sys
+import tempfile
+import threading
+import time
+import urllib.error
+import urllib.request
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, Dict, List, Optional, Tuple
+
+from latency_stats import percentiles, TAIL_QUANTILES
+from traffic_capture import load_requests, replay_payload, install_recorded_vision, image_path
+
+_server_timing_regex = re.compile(r"(\w+);dur=([\d.]+)")
+
+
+def _prepare_environment(capture_dir: str) -> None:
+    """
+    Settings for an app run by the replay: nothing persisted or re-captured,
+    no budget spent, prescreen off for filler images.
+    """
+    os.environ['TRAFFIC_CAPTURE'] = ''
+    os.environ['OCR_USAGE_DB'] = os.path.join(tempfile.mkdtemp(prefix='replay_'), 'ocr_usage.db')
+    os.environ.setdefault('SCAN_DB_PATH', '')
+    os.environ.setdefault('OCR_LOG_DIR', '')
+    if not any(os.scandir(os.path.join(capture_dir, 'images'))):
+        os.environ.setdefault('PRESCREEN_ENABLED', 'false')
+
+
+def _load_app(module_name: str, capture_dir: str, speed: float):
+    _prepare_environment(capture_dir)
+    install_recorded_vision(capture_dir, speed)
+    return importlib.import_module(module_name).app
+
+
+def _request_parts(record: Dict, capture_dir: str, api_keys: Dict[str, str]) -> Tuple[bytes, str, Dict]:
+    filename = f"replay{record.get('filename_ext') or '.jpg'}"
+    headers = {}
+    if record.get("priority"):
+        headers['X-Scan-Priority'] = record["priority"]
+    if record.get("tenant") in api_keys:
+        headers['X-API-Key'] = api_keys[record["tenant"]]
+    return replay_payload(capture_dir, record), filename, headers
+
+
+def in_process_sender(app, capture_dir: str, api_keys: Dict[str, str]) -> Callable:
+    local = threading.local()
+
+    def send(record: Dict) -> Tuple[int, str]:
+        if not hasattr(local, 'client'):
+            local.client = app.test_client()
+        payload, filename, headers = _request_parts(record, capture_dir, api_keys)
+        response = local.client.post('/api/scan', data={'receipt_image': (io.BytesIO(payload), filename)},
+                                     headers=headers)
+        return response.status_code, response.headers.get('Server-Timing', '')
+    return send
+
+
+def http_sender(url: str, capture_dir: str, api_keys: Dict[str, str]) -> Callable:
+    def send(record: Dict) -> Tuple[int, str]:
+        payload, filename, headers = _request_parts(record, capture_dir, api_keys)
+        boundary = secrets.token_hex(16)
+        body = (f'--{boundary}\r\nContent-Disposition: form-data; name="receipt_image"; filename="{filename}"\r\n'
+                f'Content-Type: application/octet-stream\r\n\r\n').encode() + payload + f'\r\n--{boundary}--\r\n'.encode()
+        headers['Content-Type'] = f'multipart/form-data; boundary={boundary}'
+        request = urllib.request.Request(url, data=body, headers=headers, method='POST')
+        try:
+            with urllib.request.urlopen(request, timeout=300) as response:
+                response.read()
+                return response.status, response.headers.get('Server-Timing', '')
+        except urllib.error.HTTPError as e:
+            return e.code, e.headers.get('Server-Timing', '')
+        except OSError:
+            return 0, ''  # connection refused or reset: counted as status 0
+    return send
+
+
+def replay(records: List[Dict], send: Callable, speed: float = 1.0, clients: int = 64) -> List[Dict]:
+    """Send every record at its (scaled) arrival offset. Returns one result per record."""
+    results: List[Optional[Dict]] = [None] * len(records)
+    first = records[0]["arrived_at"]
+    started = time.perf_counter()
+
+    def run(index: int, record: Dict, due: float) -> None:
+        sent = time.perf_counter()
+        status, server_timing = send(record)
+        done = time.perf_counter()
+        timings = {name: float(value) for name, value in _server_timing_regex.findall(server_timing)}
+        results[index] = {
+            "arrived_at": record["arrived_at"],
+            "offset_s": round(due - started, 4),
+            "status": status,
+            "client_lag_ms": round((sent - due) * 1000, 2),
+            "latency_ms": round((done - due) * 1000, 2),
+            "queue_wait_ms": timings.get("queue"),
+            "ocr_ms": timings.get("ocr"),
+            "recorded_latency_ms": record.get("latency_ms"),
+            "recorded_status": record.get("status")
+        }
+
+    with ThreadPoolExecutor(max_workers=clients) as pool:
+        for index, record in enumerate(records):
+            due = started + (record["arrived_at"] - first) / speed
+            delay = due - time.perf_counter()
+            if delay > 0:
+                time.sleep(delay)
+            pool.submit(run, index, record, due)
+    return results
+
+
+def summarize(results: List[Dict], speed: float) -> Dict:
+    finished = max(result["offset_s"] + result["latency_ms"] / 1000 for result in results)
+    ok = [result for result in results if result["status"] == 200]
+    latencies = [result["latency_ms"] for result in results]
+    return {
+        "requests": len(results),
+        "speed": speed,
+        "duration_s": round(finished, 2),
+        "throughput_rps": round(len(ok) / finished, 2) if finished else None,
+        "throughput_rps_at_1x": round(len(ok) / finished / speed, 2) if finished else None,
+        "status": dict(Counter(str(result["status"]) for result in results)),
+        "recorded_status": dict(Counter(str(result["recorded_status"]) for result in results)),
+        "latency_ms": percentiles(latencies, TAIL_QUANTILES),
+        "latency_ms_at_1x": percentiles([latency * speed for latency in latencies], TAIL_QUANTILES),
+        "recorded_latency_ms": percentiles([result["recorded_latency_ms"] for result in results], TAIL_QUANTILES),
+        "queue_wait_ms": percentiles([result["queue_wait_ms"] for result in results], TAIL_QUANTILES),
+        "ocr_ms": percentiles([result["ocr_ms"] for result in results], TAIL_QUANTILES),
+        "client_lag_ms": percentiles([result["client_lag_ms"] for result in results], TAIL_QUANTILES)
+    }
+
+
+def _parse_api_keys(pairs: List[str]) -> Dict[str, str]:
+    keys = {}
+    for pair in pairs:
+        tenant, _, key = pair.partition('=')
+        if not key:
+            print(f"--api-key must be TENANT=KEY, got {pair!r}")
+            sys.exit(1)
+        keys[tenant] = key
+    return keys
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Replay captured scan traffic against an app variant")
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    run = commands.add_parser("run", help="replay a capture and report latency, queueing and throughput")
+    run.add_argument("capture_dir", help="directory written with TRAFFIC_CAPTURE")
+    target = run.add_mutually_exclusive_group()
+    target.add_argument("--app", default="app", help="app module to replay against in-process (default app)")
+    target.add_argument("--url", help="scan endpoint of a running server, e.g. one started with 'serve'")
+    run.add_argument("--speed", type=float, default=1.0, help="replay N times faster than recorded")
+    run.add_argument("--clients", type=int, default=64, help="maximum requests in flight")
+    run.add_argument("--limit", type=int, help="replay only the first N requests")
+    run.add_argument("--api-key", action="append", default=[], metavar="TENANT=KEY",
+                     help="API key to send for a captured tenant (repeatable)")
+    run.add_argument("--results", help="also write per-request results to this JSON Lines file")
+
+    serve = commands.add_parser("serve", help="run an app with the recorded OCR backend")
+    serve.add_argument("capture_dir", help="directory written with TRAFFIC_CAPTURE")
+    serve.add_argument("--app", default="app", help="app module to serve (default app)")
+    serve.add_argument("--port", type=int, default=8080)
+    serve.add_argument("--speed", type=float, default=1.0, help="divide recorded OCR latencies by N")
+    args = parser.parse_args()
+
+    if not os.path.isdir(os.path.join(args.capture_dir, 'images')):
+        print(f"Not a traffic capture: {args.capture_dir}")
+        sys.exit(1)
+
+    if args.command == "serve":
+        _load_app(args.app, args.capture_dir, args.speed).run(host='0.0.0.0', port=args.port, threaded=True)
+        return
+
+    records = [record for record in load_requests(args.capture_dir) if record.get("image_hash")]
+    if args.limit:
+        records = records[:args.limit]
+    if not records:
+        print("No replayable requests in the capture (only requests that uploaded an image are replayed).")
+        sys.exit(1)
+    api_keys = _parse_api_keys(args.api_key)
+    if args.url:
+        send = http_sender(args.url, args.capture_dir, api_keys)
+    else:
+        send = in_process_sender(_load_app(args.app, args.capture_dir, args.speed), args.capture_dir, api_keys)
+
+    span = records[-1]["arrived_at"] - records[0]["arrived_at"]
+    captured_images = sum(os.path.exists(image_path(args.capture_dir, record["image_hash"])) for record in records)
+    print(f"Replaying {len(records)} requests over {span / args.speed:.1f}s "
+          f"({captured_images} with captured images) against {args.url or args.app}", file=sys.stderr)
+    results = replay(records, send, args.speed, args.clients)
+    if args.results:
+        with open(args.results, 'w') as f:
+            for result in results:
+                f.write(json.dumps(result) + '\n')
+    print(json.dumps(summarize(results, args.speed), indent=2))
+
+
+if __name__ == "__main__":
+    main()
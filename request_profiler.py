@@ -0,0 +1,291 @@
+"""
+Request profiling
+=================
+
+Profiles individual requests to the Flask apps so a slow scan can be pinned
+on the upload read, client/credential setup, the Vision RPC or the
+extraction regexes.
+
+A request is profiled when:
+
+- it carries an X-Profile header ("sample" or "cprofile") together with
+  X-Admin-Token matching ADMIN_TOKEN, or
+- it is picked by PROFILE_SAMPLE_RATE (default 0, i.e. never).
+
+Profiling modes:
+
+- "sample" (default, PROFILE_MODE): a background thread samples the
+  request thread's stack every PROFILE_INTERVAL_MS. It gives
+  flamegraph-ready collapsed stacks at low cost.
+- "cprofile": deterministic per-function call counts and times for that
+  thread.
+
+The last PROFILE_MAX_STORED profiles are kept in memory, keyed by request id
+(also returned in the X-Request-ID response header). They are served by the
+admin endpoints registered by install_profiler():
+
+    GET /api/admin/profiles                     list of stored profiles
+    GET /api/admin/profiles/<request_id>        one profile (?format=collapsed for stacks)
+    GET /api/admin/profiles/report              hot functions over all stored profiles
+                                                (?format=collapsed to merge their stacks)
+
+When no request is being profiled the only per-request cost is one random()
+call, plus a header lookup.
+"""
+
+import cProfile
+import os
+import pstats
+import random
+import re
+import sys
+import threading
+import time
+import uuid
+from collections import Counter, OrderedDict
+from typing import Dict, List, Optional
+
+from flask import Flask, Response, g, jsonify, request
+
+PROFILE_SAMPLE_RATE = float(os.environ.get('PROFILE_SAMPLE_RATE', 0))
+PROFILE_MODE = os.environ.get('PROFILE_MODE', 'sample')
+PROFILE_INTERVAL_MS = float(os.environ.get('PROFILE_INTERVAL_MS', 2))
+PROFILE_MAX_STORED = int(os.environ.get('PROFILE_MAX_STORED', 100))
+ADMIN_TOKEN = os.environ.get('ADMIN_TOKEN', '')
+
+MODES = ('sample', 'cprofile')
+
+_request_id_regex = re.compile(r"^[\w.-]{1,64}$")
+
+
+def _frame_name(code) -> str:
+    return f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})".replace(';', ':')
+
+
+class StackSampler:
+    """One background thread sampling the stacks of the threads registered with it."""
+
+    def __init__(self, interval: float = PROFILE_INTERVAL_MS / 1000):
+        self.interval = interval
+        self._targets: Dict[int, Counter] = {}
+        self._lock = threading.Lock()
+        self._wake = threading.Event()
+        self._thread = None
+
+    def start(self, thread_id: int) -> Counter:
+        stacks = Counter()
+        with self._lock:
+            self._targets[thread_id] = stacks
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name="stack-sampler", daemon=True)
+                self._thread.start()
+        self._wake.set()
+        return stacks
+
+    def stop(self, thread_id: int) -> None:
+        with self._lock:
+            self._targets.pop(thread_id, None)
+
+    def _run(self) -> None:
+        while True:
+            # Sample under the lock so stop() guarantees no later writes to a stack counter
+            with self._lock:
+                if self._targets:
+                    frames = sys._current_frames()
+                    for thread_id, stacks in self._targets.items():
+                        frame = frames.get(thread_id)
+                        names = []
+                        while frame is not None:
+                            names.append(_frame_name(frame.f_code))
+                            frame = frame.f_back
+                        if names:
+                            stacks[';'.join(reversed(names))] += 1
+                    idle = False
+                else:
+                    idle = True
+                    self._wake.clear()
+            if idle:
+                # Sleep until a profiled request starts
+                self._wake.wait()
+            else:
+                time.sleep(self.interval)
+
+
+class ProfileStore:
+    """The most recent request profiles, by request id."""
+
+    def __init__(self, max_profiles: int = PROFILE_MAX_STORED):
+        self.max_profiles = max_profiles
+        self._profiles: "OrderedDict[str, Dict]" = OrderedDict()
+        self._lock = threading.Lock()
+
+    def add(self, profile: Dict) -> None:
+        with self._lock:
+            self._profiles[profile["request_id"]] = profile
+            while len(self._profiles) > self.max_profiles:
+                self._profiles.popitem(last=False)
+
+    def get(self, request_id: str) -> Optional[Dict]:
+        with self._lock:
+            return self._profiles.get(request_id)
+
+    def all(self) -> List[Dict]:
+        with self._lock:
+            return list(self._profiles.values())
+
+
+def _functions_from_cprofile(profiler: cProfile.Profile) -> Dict[str, Dict]:
+    functions = {}
+    for (filename, line, name), (_, calls, tottime, cumtime, _) in pstats.Stats(profiler).stats.items():
+        key = f"{name} ({os.path.basename(filename)}:{line})"
+        functions[key] = {"calls": calls, "self_ms": tottime * 1000, "total_ms": cumtime * 1000}
+    return functions
+
+
+def _functions_from_stacks(stacks: Counter, interval_ms: float) -> Dict[str, Dict]:
+    """Self and total time per function, estimated from stack samples."""
+    functions: Dict[str, Dict] = {}
+    for stack, count in stacks.items():
+        frames = stack.split(';')
+        for position, name in enumerate(frames):
+            entry = functions.setdefault(name, {"samples": 0, "self_ms": 0.0, "total_ms": 0.0})
+            if name not in frames[:position]:  # count recursive frames once
+                entry["samples"] += count
+                entry["total_ms"] += count * interval_ms
+        functions[frames[-1]]["self_ms"] += count * interval_ms
+    return functions
+
+
+def hot_functions(functions: Dict[str, Dict], top: int = 30) -> List[Dict]:
+    rows = [{"function": name, **{k: round(v, 3) if isinstance(v, float) else v for k, v in stats.items()}}
+            for name, stats in functions.items()]
+    rows.sort(key=lambda row: row["self_ms"], reverse=True)
+    return rows[:top]
+
+
+def collapsed(stacks: Counter) -> str:
+    """Brendan Gregg's collapsed stack format ("frame;frame;frame count" per line)."""
+    return ''.join(f"{stack} {count}\n" for stack, count in stacks.most_common())
+
+
+def install_profiler(app: Flask, sample_rate: float = PROFILE_SAMPLE_RATE, mode: str = PROFILE_MODE,
+                     admin_token: str = ADMIN_TOKEN) -> ProfileStore:
+    """Add request profiling and the /api/admin/profiles endpoints to a Flask app."""
+    store = ProfileStore()
+    sampler = StackSampler()
+
+    def is_admin() -> bool:
+        return bool(admin_token) and request.headers.get('X-Admin-Token') == admin_token
+
+    @app.before_request
+    def start_profile():
+        incoming = request.headers.get('X-Request-ID', '')
+        g.request_id = incoming if _request_id_regex.match(incoming) else uuid.uuid4().hex
+        requested = request.headers.get('X-Profile')
+        if requested and is_admin():
+            chosen = requested if requested in MODES else mode
+        elif sample_rate and random.random() < sample_rate:
+            chosen = mode
+        else:
+            return
+        g.profile = {"mode": chosen, "started": time.perf_counter(), "thread": threading.get_ident()}
+        if chosen == 'cprofile':
+            g.profile["profiler"] = cProfile.Profile()
+            g.profile["profiler"].enable()
+        else:
+            g.profile["stacks"] = sampler.start(g.profile["thread"])
+
+    def finish_profile(status: Optional[int]) -> None:
+        state = g.pop('profile', None)
+        if state is None:
+            return
+        duration_ms = (time.perf_counter() - state["started"]) * 1000
+        if state["mode"] == 'cprofile':
+            state["profiler"].disable()
+            functions = _functions_from_cprofile(state["profiler"])
+            stacks = Counter()
+        else:
+            sampler.stop(state["thread"])
+            stacks = state["stacks"]
+            # Spread the measured duration over the samples actually taken
+            functions = _functions_from_stacks(stacks, duration_ms / max(sum(stacks.values()), 1))
+        store.add({
+            "request_id": g.request_id,
+            "method": request.method,
+            "path": request.path,
+            "status": status,
+            "mode": state["mode"],
+            "started_at": time.time() - duration_ms / 1000,
+            "duration_ms": round(duration_ms, 2),
+            "functions": functions,
+            "stacks": stacks
+        })
+
+    @app.after_request
+    def end_profile(response):
+        finish_profile(response.status_code)
+        if 'request_id' in g:
+            response.headers['X-Request-ID'] = g.request_id
+        return response
+
+    @app.teardown_request
+    def end_profile_on_error(error):
+        # after_request is skipped when the view raised
+        finish_profile(500 if error else None)
+
+    def admin_only():
+        if not is_admin():
+            return jsonify({"success": False, "error": "Not found."}), 404
+        return None
+
+    def list_profiles():
+        denied = admin_only()
+        if denied:
+            return denied
+        return jsonify({"success": True, "profiles": [
+            {key: profile[key] for key in ("request_id", "method", "path", "status", "mode", "started_at", "duration_ms")}
+            for profile in reversed(store.all())
+        ]})
+
+    def profile_report():
+        denied = admin_only()
+        if denied:
+            return denied
+        profiles = store.all()
+        if request.args.get('format') == 'collapsed':
+            merged = Counter()
+            for profile in profiles:
+                merged.update(profile["stacks"])
+            return Response(collapsed(merged), mimetype='text/plain')
+        merged_functions: Dict[str, Dict] = {}
+        for profile in profiles:
+            for name, stats in profile["functions"].items():
+                entry = merged_functions.setdefault(name, {})
+                for key, value in stats.items():
+                    entry[key] = entry.get(key, 0) + value
+        return jsonify({
+            "success": True,
+            "profiles": len(profiles),
+            "hot_functions": hot_functions(merged_functions, int(request.args.get('top', 30)))
+        })
+
+    def get_profile(request_id):
+        denied = admin_only()
+        if denied:
+            return denied
+        profile = store.get(request_id)
+        if profile is None:
+            return jsonify({"success": False, "error": "No profile stored for this request id."}), 404
+        if request.args.get('format') == 'collapsed':
+            return Response(collapsed(profile["stacks"]), mimetype='text/plain')
+        summary = {key: value for key, value in profile.items() if key not in ("functions", "stacks")}
+        return jsonify({
+            "success": True,
+            **summary,
+            "hot_functions": hot_functions(profile["functions"], int(request.args.get('top', 30)))
+        })
+
+    app.add_url_rule('/api/admin/profiles', 'list_profiles', list_profiles)
+    app.add_url_rule('/api/admin/profiles/report', 'profile_report', profile_report)
+    app.add_url_rule('/api/admin/profiles/<request_id>', 'get_profile', get_profile)
+    return store
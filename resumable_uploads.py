@@ -0,0 +1,319 @@
+"""
+Resumable uploads
+=================
+
+Chunked upload sessions for large photos and archives over unreliable
+connections. A client creates an upload with the total size, PUTs chunks at
+byte offsets, asks for the current offset after a dropped connection and
+resumes from there, then finalizes the upload to start the scan.
+
+Chunks are spooled straight to UPLOAD_SPOOL_DIR/<id>.part, so a request
+only holds a worker for one chunk. The bytes already on disk are the source
+of truth for the offset: any app process can serve the next chunk, and an
+interrupted chunk simply leaves a shorter file to resume from. The metadata
+sits next to it in <id>.json. Uploads that have not been touched for
+UPLOAD_TTL seconds are removed.
+
+While an upload is scanned, its spool file's mtime is refreshed as a
+heartbeat. If the process scanning it dies (a worker restart), the heartbeat
+stops. Once it is UPLOAD_SCAN_STALE_SECONDS old, finalize may claim the
+upload again, and an archive scan continues after the results already
+written.
+"""
+
+import json
+import logging
+import os
+import re
+import secrets
+import threading
+import time
+from typing import BinaryIO, Dict, List, Optional
+
+from upload_settings import MAX_UPLOAD_BYTES
+
+try:
+    import fcntl
+except ImportError:  # Windows: one writer process only
+    fcntl = None
+
+logger = logging.getLogger(__name__)
+
+UPLOAD_SPOOL_DIR = os.environ.get('UPLOAD_SPOOL_DIR', 'upload_spool')
+UPLOAD_TTL = int(os.environ.get('UPLOAD_TTL', 24 * 3600))
+UPLOAD_CHUNK_BYTES = int(os.environ.get('UPLOAD_CHUNK_BYTES', 1024 * 1024))
+UPLOAD_MAX_ARCHIVE_BYTES = int(os.environ.get('UPLOAD_MAX_ARCHIVE_BYTES', 2 * 1024 * 1024 * 1024))
+UPLOAD_SCAN_STALE_SECONDS = float(os.environ.get('UPLOAD_SCAN_STALE_SECONDS', 300))
+
+_upload_id_regex = re.compile(r"^[A-Za-z0-9_-]{16,64}$")
+
+
+class UploadError(Exception):
+    """A request the upload protocol rejects; carries the HTTP status to answer with."""
+
+    def __init__(self, message: str, status: int = 400, offset: Optional[int] = None):
+        super().__init__(message)
+        self.status = status
+        self.offset = offset
+
+
+class UploadStore:
+    """Upload sessions spooled to one directory."""
+
+    def __init__(self, directory: str = UPLOAD_SPOOL_DIR, ttl: int = UPLOAD_TTL):
+        self.directory = directory
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        os.makedirs(directory, exist_ok=True)
+
+    def _path(self, upload_id: str, suffix: str) -> str:
+        return os.path.join(self.directory, f"{upload_id}{suffix}")
+
+    def create(self, tenant: str, filename: str, size: int, kind: str) -> Dict:
+        """Start an upload of `size` bytes. kind is 'image' or 'archive'."""
+        limit = MAX_UPLOAD_BYTES if kind == 'image' else UPLOAD_MAX_ARCHIVE_BYTES
+        if size <= 0:
+            raise UploadError("Upload size must be a positive number of bytes.")
+        if size > limit:
+            raise UploadError(f"Upload too large. Maximum size is {limit // (1024 * 1024)}MB.", 413)
+        self.expire()
+        upload_id = secrets.token_urlsafe(18)
+        meta = {
+            "upload_id": upload_id,
+            "tenant": tenant,
+            "filename": filename,
+            "kind": kind,
+            "size": size,
+            "status": "uploading",
+            "created_at": time.time()
+        }
+        open(self._path(upload_id, '.part'), 'wb').close()
+        self._save(meta)
+        return self.describe(meta)
+
+    def _save(self, meta: Dict) -> None:
+        path = self._path(meta["upload_id"], '.json')
+        with open(path + '.tmp', 'w') as f:
+            json.dump(meta, f)
+        os.replace(path + '.tmp', path)
+
+    def get(self, upload_id: str, tenant: str) -> Dict:
+        """Metadata of one of the tenant's uploads; other tenants' uploads are not found."""
+        if not _upload_id_regex.match(upload_id or ''):
+            raise UploadError("Upload not found.", 404)
+        try:
+            with open(self._path(upload_id, '.json')) as f:
+                meta = json.load(f)
+        except (FileNotFoundError, ValueError):
+            raise UploadError("Upload not found.", 404)
+        if meta["tenant"] != tenant:
+            raise UploadError("Upload not found.", 404)
+        return meta
+
+    def offset(self, upload_id: str) -> int:
+        try:
+            return os.path.getsize(self._path(upload_id, '.part'))
+        except FileNotFoundError:
+            return 0
+
+    def describe(self, meta: Dict) -> Dict:
+        """Public view of an upload's progress."""
+        # The spooled bytes are removed once scanned
+        offset = self.offset(meta["upload_id"]) if meta["status"] == "uploading" else meta["size"]
+        return {
+            "upload_id": meta["upload_id"],
+            "filename": meta["filename"],
+            "kind": meta["kind"],
+            "size": meta["size"],
+            "offset": offset,
+            "complete": offset == meta["size"],
+            "status": meta["status"],
+            # A scan whose process died; finalize again to resume it
+            "stalled": meta["status"] == "scanning" and self._stalled(meta["upload_id"]),
+            "chunk_bytes": UPLOAD_CHUNK_BYTES,
+            "expires_at": int(self._touched(meta["upload_id"]) + self.ttl)
+        }
+
+    def write_chunk(self, meta: Dict, offset: int, stream: BinaryIO, length: Optional[int]) -> int:
+        """
+        Append a chunk that starts at `offset`. The offset must equal the bytes
+        already received, so a retried or out-of-order chunk is rejected with
+        409 and the current offset rather than corrupting the file. Returns the
+        new offset.
+        """
+        if meta["status"] != "uploading":
+            raise UploadError("Upload was already finalized.", 409)
+        with self._locked(meta["upload_id"]) as f:
+            # Re-read under the lock: a finalize may have claimed the upload meanwhile
+            if self.get(meta["upload_id"], meta["tenant"])["status"] != "uploading":
+                raise UploadError("Upload was already finalized.", 409)
+            current = f.seek(0, os.SEEK_END)
+            if offset != current:
+                raise UploadError(f"Offset mismatch: the server has {current} bytes.", 409, current)
+            remaining = meta["size"] - current
+            if length is not None and length > remaining:
+                raise UploadError("Chunk goes past the declared upload size.", 413, current)
+            written = 0
+            while True:
+                piece = stream.read(min(64 * 1024, remaining - written + 1))
+                if not piece:
+                    break
+                written += len(piece)
+                if written > remaining:
+                    f.truncate(current)
+                    raise UploadError("Chunk goes past the declared upload size.", 413, current)
+                f.write(piece)
+        return current + written
+
+    def _locked(self, upload_id: str):
+        """Open the spool file, exclusively locked across threads and processes."""
+        return _LockedFile(self._path(upload_id, '.part'), self._lock)
+
+    def mark(self, meta: Dict, status: str, **fields) -> Dict:
+        meta = dict(meta, status=status, **fields)
+        self._save(meta)
+        return meta
+
+    def claim_for_scan(self, meta: Dict) -> Dict:
+        """
+        Move a complete upload to 'scanning' once, even if finalize is sent
+        twice. A stalled scan (see heartbeat) can be claimed again; the
+        returned metadata then counts it under 'resumed'.
+        """
+        if not self._claimable(meta):
+            raise UploadError("Upload was already finalized.", 409)
+        with self._locked(meta["upload_id"]):
+            meta = self.get(meta["upload_id"], meta["tenant"])
+            if not self._claimable(meta):
+                raise UploadError("Upload was already finalized.", 409)
+            offset = self.offset(meta["upload_id"])
+            if offset != meta["size"]:
+                raise UploadError(f"Upload is incomplete: {offset} of {meta['size']} bytes received.", 409, offset)
+            # A fresh heartbeat, so a concurrent finalize cannot claim it as well
+            os.utime(self.part_path(meta["upload_id"]))
+            if meta["status"] == "scanning":
+                logger.warning(f"Resuming stalled scan of upload {meta['upload_id']}")
+                return self.mark(meta, "scanning", resumed=meta.get("resumed", 0) + 1)
+            return self.mark(meta, "scanning")
+
+    def _claimable(self, meta: Dict) -> bool:
+        return meta["status"] == "uploading" or (meta["status"] == "scanning" and self._stalled(meta["upload_id"]))
+
+    def _stalled(self, upload_id: str) -> bool:
+        try:
+            return time.time() - os.path.getmtime(self.part_path(upload_id)) > UPLOAD_SCAN_STALE_SECONDS
+        except FileNotFoundError:
+            return False  # scanned, or deleted
+
+    def heartbeat(self, upload_id: str) -> '_Heartbeat':
+        """Context manager marking the upload's scan as alive for as long as it runs."""
+        return _Heartbeat(self.part_path(upload_id), UPLOAD_SCAN_STALE_SECONDS / 5)
+
+    def part_path(self, upload_id: str) -> str:
+        return self._path(upload_id, '.part')
+
+    def results_path(self, upload_id: str) -> str:
+        return self._path(upload_id, '.results.jsonl')
+
+    def settled_results(self, upload_id: str) -> List[Dict]:
+        """Results written by an earlier scan of the archive, cutting off a line its crash left torn."""
+        try:
+            f = open(self.results_path(upload_id), 'r+b')
+        except FileNotFoundError:
+            return []
+        with f:
+            data = f.read()
+            end = data.rfind(b'\n') + 1
+            if end != len(data):
+                f.truncate(end)
+        return [json.loads(line) for line in data[:end].splitlines() if line.strip()]
+
+    def read_results(self, upload_id: str) -> List[Dict]:
+        try:
+            with open(self.results_path(upload_id)) as f:
+                # A line without its newline is still being written, or was torn by a crash
+                return [json.loads(line) for line in f if line.endswith('\n') and line.strip()]
+        except FileNotFoundError:
+            return []
+
+    def delete(self, upload_id: str) -> None:
+        for suffix in ('.part', '.json', '.results.jsonl'):
+            try:
+                os.remove(self._path(upload_id, suffix))
+            except FileNotFoundError:
+                pass
+
+    def _touched(self, upload_id: str) -> float:
+        times = []
+        for suffix in ('.part', '.json', '.results.jsonl'):
+            try:
+                times.append(os.path.getmtime(self._path(upload_id, suffix)))
+            except FileNotFoundError:
+                pass
+        return max(times) if times else 0.0
+
+    def expire(self) -> int:
+        """Remove uploads untouched for longer than the TTL. Returns how many were removed."""
+        cutoff = time.time() - self.ttl
+        removed = 0
+        for name in os.listdir(self.directory):
+            if not name.endswith('.json'):
+                continue
+            upload_id = name[:-len('.json')]
+            if self._touched(upload_id) < cutoff:
+                self.delete(upload_id)
+                removed += 1
+        return removed
+
+
+class _Heartbeat:
+    """Context manager touching a file every `interval` seconds from a background thread."""
+
+    def __init__(self, path: str, interval: float):
+        self.path = path
+        self.interval = interval
+        self._stop = threading.Event()
+
+    def __enter__(self):
+        threading.Thread(target=self._run, name="upload-heartbeat", daemon=True).start()
+        return self
+
+    def _run(self) -> None:
+        while not self._stop.wait(self.interval):
+            try:
+                os.utime(self.path)
+            except FileNotFoundError:
+                return  # the upload was deleted
+
+    def __exit__(self, *exc):
+        self._stop.set()
+
+
+class _LockedFile:
+    """
+    Context manager yielding the spool file opened for update under an flock
+    (each open file gets its own lock, so this also serializes threads).
+    Without fcntl the store-wide thread lock is used instead.
+    """
+
+    def __init__(self, path: str, lock: threading.Lock):
+        self.path = path
+        self.lock = None if fcntl else lock
+        self.handle = None
+
+    def __enter__(self):
+        try:
+            self.handle = open(self.path, 'r+b')
+        except FileNotFoundError:
+            raise UploadError("Upload not found.", 404)
+        if fcntl:
+            fcntl.flock(self.handle, fcntl.LOCK_EX)
+        else:
+            self.lock.acquire()
+        return self.handle
+
+    def __exit__(self, *exc):
+        # Closing the file releases the flock
+        self.handle.close()
+        if self.lock:
+            self.lock.release()
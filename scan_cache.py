@@ -0,0 +1,80 @@
+"""
+Scan caches
+===========
+
+Small in-process TTL caches used by the REST API:
+
+- results keyed by image hash, so a client can revalidate or fetch a previous
+  scan with just the hash (ETag / If-None-Match) instead of re-uploading;
+- responses keyed by the client's Idempotency-Key header, so a retried
+  request gets the original response back instead of a second scan.
+
+Entries expire after a TTL and the oldest entries are evicted once the cache
+is full. Caches are per worker process.
+"""
+
+import os
+import threading
+import time
+from collections import OrderedDict
+from typing import Any, Dict, Optional
+
+RESULT_CACHE_TTL = int(os.environ.get('RESULT_CACHE_TTL_SECONDS', 24 * 60 * 60))
+IDEMPOTENCY_TTL = int(os.environ.get('IDEMPOTENCY_TTL_SECONDS', 24 * 60 * 60))
+MAX_CACHE_ENTRIES = int(os.environ.get('SCAN_CACHE_MAX_ENTRIES', 1000))
+
+
+class TTLCache:
+    """Thread-safe LRU cache whose entries expire after ttl seconds."""
+
+    def __init__(self, ttl: int, max_entries: int = MAX_CACHE_ENTRIES):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()
+        self._hits = 0
+        self._misses = 0
+
+    def get(self, key: str) -> Optional[Any]:
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and entry[0] < time.monotonic():
+                del self._entries[key]
+                entry = None
+            if entry is None:
+                self._misses += 1
+                return None
+            self._hits += 1
+            self._entries.move_to_end(key)
+            return entry[1]
+
+    def set(self, key: str, value: Any) -> None:
+        with self._lock:
+            self._entries[key] = (time.monotonic() + self.ttl, value)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def stats(self) -> Dict[str, int]:
+        with self._lock:
+            return {"size": len(self._entries), "hits": self._hits, "misses": self._misses}
+
+
+def make_etag(image_hash: str) -> str:
+    return f'"{image_hash}"'
+
+
+def etag_matches(header: Optional[str], image_hash: str) -> bool:
+    """Check an If-None-Match header value against an image hash."""
+    if not header:
+        return False
+    tags = [tag.strip() for tag in header.split(',')]
+    return '*' in tags or any(tag.replace('W/', '', 1).strip('"') == image_hash for tag in tags)
+
+
+def parse_if_none_match(header: Optional[str]) -> Optional[str]:
+    """Return the first entity tag of an If-None-Match header without quotes."""
+    if not header:
+        return None
+    tag = header.split(',')[0].strip().replace('W/', '', 1).strip('"')
+    return tag or None
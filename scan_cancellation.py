@@ -0,0 +1,176 @@
+"""
+Scan cancellation
+=================
+
+Stops work on scans nobody is waiting for any more. Each /api/scan request
+gets a CancelScope holding its deadline (SCAN_DEADLINE_SECONDS, or less if
+the client sends X-Scan-Timeout in seconds) and a probe of the client
+connection. The scan path checks the scope:
+
+- while queued for an OCR slot, so an abandoned request gives up its place
+- before the Vision call and between retry attempts
+- while the Vision call is in flight: the gRPC call is cancelled, which
+  frees the worker and stops the request at Google's end. Clients without a
+  gRPC transport (REST, test fakes, recorded backends) cannot be stopped, so
+  their call runs to the end in the request's own thread, still holding its
+  OCR slot, and is bounded by the scope's deadline where the client takes a
+  timeout
+- while waiting for a scan it was coalesced onto
+- before extraction and persistence
+
+Disconnects are detected by peeking at the request socket, which gunicorn
+and the Werkzeug server put in the WSGI environ. Behind a proxy this works
+when the proxy closes the upstream connection on client abort (nginx does
+by default). A scan that other requests are coalesced onto keeps running
+for them.
+"""
+
+import os
+import socket
+import ssl
+import threading
+import time
+from collections import Counter
+from typing import Callable, Dict, Optional
+
+SCAN_DEADLINE_SECONDS = float(os.environ.get('SCAN_DEADLINE_SECONDS', 110))  # under gunicorn's --timeout 120
+CANCEL_POLL_SECONDS = float(os.environ.get('CANCEL_POLL_SECONDS', 0.1))
+
+DISCONNECT = 'disconnect'
+DEADLINE = 'deadline'
+
+
+class ScanCancelled(Exception):
+    """The scan was abandoned at `stage` because of `reason` (DISCONNECT or DEADLINE)."""
+
+    def __init__(self, reason: str, stage: str):
+        super().__init__(f"Scan cancelled during {stage}: "
+                         f"{'client disconnected' if reason == DISCONNECT else 'deadline exceeded'}")
+        self.reason = reason
+        self.stage = stage
+
+    @property
+    def status(self) -> int:
+        # 499 is nginx's "client closed request"; nobody receives it, it is for logs and metrics
+        return 499 if self.reason == DISCONNECT else 504
+
+
+def connection_probe(environ: Dict) -> Optional[Callable[[], bool]]:
+    """A function telling whether the client has closed the connection, or None if it cannot be told."""
+    sock = environ.get('gunicorn.socket') or environ.get('werkzeug.socket')
+    if sock is None or isinstance(sock, ssl.SSLSocket) or not hasattr(socket, 'MSG_DONTWAIT'):
+        return None
+
+    def gone() -> bool:
+        try:
+            # The request body has been read, so EOF here means the client went away
+            return sock.recv(1, socket.MSG_PEEK | socket.MSG_DONTWAIT) == b''
+        except (BlockingIOError, InterruptedError):
+            return False
+        except OSError:
+            return True  # reset by peer
+    return gone
+
+
+def request_deadline(header: Optional[str], default: float = SCAN_DEADLINE_SECONDS) -> float:
+    """Seconds the scan may take: the client's X-Scan-Timeout if given and shorter than the default."""
+    try:
+        requested = float(header) if header else None
+    except ValueError:
+        requested = None
+    return min(default, requested) if requested and requested > 0 else default
+
+
+class CancelScope:
+    """Deadline and disconnect state of one scan request."""
+
+    def __init__(self, timeout: Optional[float] = None, probe: Optional[Callable[[], bool]] = None):
+        self.deadline = time.monotonic() + timeout if timeout else None
+        self.probe = probe
+        # Set by the scan path: True while other requests share this scan's result
+        self.keep_going: Optional[Callable[[], bool]] = None
+        self.cancelled: Optional[str] = None
+
+    def remaining(self) -> Optional[float]:
+        return None if self.deadline is None else max(0.0, self.deadline - time.monotonic())
+
+    def reason(self) -> Optional[str]:
+        """DISCONNECT or DEADLINE once the scan should stop, else None."""
+        if self.cancelled:
+            return self.cancelled
+        if self.deadline is not None and time.monotonic() >= self.deadline:
+            reason = DEADLINE
+        elif self.probe is not None and self.probe():
+            reason = DISCONNECT
+        else:
+            return None
+        if self.keep_going is not None and self.keep_going():
+            return None
+        self.cancelled = reason
+        return reason
+
+    def check(self, stage: str) -> None:
+        reason = self.reason()
+        if reason:
+            raise ScanCancelled(reason, stage)
+
+
+def cancellable_text_detection(client, image, scope: Optional[CancelScope], timeout: Optional[float] = None):
+    """
+    client.text_detection(image), abandoned when the scope is cancelled. With a
+    real Vision client the call is sent as a gRPC future and cancelled; the
+    gRPC deadline is the scope's remaining time. Other clients are called
+    directly: handing them to another thread would only leave the call
+    running without an OCR slot accounting for it.
+    """
+    if scope is None:
+        return client.text_detection(image=image)
+    remaining = scope.remaining()
+    if timeout is None or (remaining is not None and remaining < timeout):
+        timeout = remaining
+    stub = getattr(getattr(client, 'transport', None), 'batch_annotate_images', None)
+    if stub is not None and hasattr(stub, 'future'):
+        return _grpc_text_detection(stub, image, scope, timeout)
+
+    if timeout and hasattr(client, 'transport'):
+        # A Vision client on another transport (REST) still takes a deadline
+        return client.text_detection(image=image, timeout=timeout)
+    return client.text_detection(image=image)
+
+
+def _grpc_text_detection(stub, image, scope: CancelScope, timeout: Optional[float]):
+    import grpc
+    from google.api_core import exceptions as google_exceptions
+    from google.cloud import vision
+
+    request = vision.BatchAnnotateImagesRequest(requests=[vision.AnnotateImageRequest(
+        image=image, features=[vision.Feature(type_=vision.Feature.Type.TEXT_DETECTION)])])
+    call = stub.future(request, timeout=timeout)
+    while True:
+        try:
+            return call.result(timeout=CANCEL_POLL_SECONDS).responses[0]
+        except grpc.FutureTimeoutError:
+            if scope.reason():
+                call.cancel()
+                raise ScanCancelled(scope.cancelled, "ocr")
+        except grpc.RpcError as e:
+            if e.code() == grpc.StatusCode.DEADLINE_EXCEEDED and scope.reason() == DEADLINE:
+                raise ScanCancelled(DEADLINE, "ocr")
+            raise google_exceptions.from_grpc_error(e)
+
+
+class CancellationStats:
+    """Counts of cancelled scans by reason and by the stage they were stopped at."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._counts: Dict[str, Counter] = {DISCONNECT: Counter(), DEADLINE: Counter()}
+
+    def record(self, cancelled: ScanCancelled) -> None:
+        with self._lock:
+            self._counts[cancelled.reason][cancelled.stage] += 1
+
+    def stats(self) -> Dict:
+        with self._lock:
+            return {reason: {"total": sum(stages.values()), "by_stage": dict(stages)}
+                    for reason, stages in self._counts.items()}
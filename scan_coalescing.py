@@ -0,0 +1,87 @@
+"""
+Scan request coalescing
+=======================
+
+Single-flight de-duplication of concurrent scans. When the same image bytes
+arrive several times at once (double-submits, client retries), only the first
+request runs OCR; the others wait on the same in-flight future and receive
+the same result. Coalescing only covers the window while a scan is running -
+once it finishes the key is released. A waiter can stop waiting (its client
+went away) without affecting the call or the other waiters.
+"""
+
+import hashlib
+import threading
+from concurrent.futures import Future, TimeoutError as FutureTimeoutError
+from typing import Any, Callable, Dict, Optional, Tuple
+
+WAIT_POLL_SECONDS = 0.1
+
+
+def image_hash(image_bytes: bytes) -> str:
+    """Content hash used to key scans of identical image bytes."""
+    return hashlib.sha256(image_bytes).hexdigest()
+
+
+class SingleFlight:
+    """Run at most one call per key at a time and share its result with concurrent callers."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._in_flight: Dict[str, Future] = {}
+        self._waiters: Dict[str, int] = {}
+        self._stats = {"executed": 0, "coalesced": 0, "errors": 0}
+
+    def do(self, key: str, fn: Callable[[], Any], check: Optional[Callable[[], None]] = None) -> Tuple[Any, bool]:
+        """
+        Return (result, shared) where shared is True if another caller did the
+        work. While waiting on another caller, `check` is called every
+        WAIT_POLL_SECONDS; an exception it raises abandons the wait.
+        """
+        with self._lock:
+            future = self._in_flight.get(key)
+            if future is not None:
+                self._stats["coalesced"] += 1
+                self._waiters[key] += 1
+                leader = False
+            else:
+                future = Future()
+                self._in_flight[key] = future
+                self._waiters[key] = 0
+                self._stats["executed"] += 1
+                leader = True
+
+        if not leader:
+            try:
+                while True:
+                    try:
+                        return future.result(timeout=WAIT_POLL_SECONDS if check else None), True
+                    except FutureTimeoutError:
+                        check()
+            finally:
+                with self._lock:
+                    if self._in_flight.get(key) is future:
+                        self._waiters[key] -= 1
+
+        try:
+            future.set_result(fn())
+        except BaseException as e:
+            with self._lock:
+                self._stats["errors"] += 1
+            future.set_exception(e)
+        finally:
+            with self._lock:
+                del self._in_flight[key]
+                del self._waiters[key]
+        return future.result(), False
+
+    def waiting(self, key: str) -> int:
+        """How many callers are waiting on the in-flight call for key."""
+        with self._lock:
+            return self._waiters.get(key, 0)
+
+    def stats(self) -> Dict[str, int]:
+        with self._lock:
+            stats = dict(self._stats)
+            stats["in_flight"] = len(self._in_flight)
+        return stats
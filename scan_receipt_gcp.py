@@ -1,7 +1,15 @@
 import os
+import threading
 from google.cloud import vision
 import re
 from typing import Dict, Optional
+from extraction_limits import bound_text
+from ocr_backends import open_ocr_router, OcrRouter, OCR_BACKENDS, OCR_BULK_POLICY
+from scan_tracing import tracer, KIND_CLIENT
+from tenant_scheduler import BULK
+
+# Tenant the CLI's OCR calls are counted under in the usage ledger (see ocr_budget.py)
+CLI_TENANT = "cli"
 
 # Set your Google Cloud credentials (you'll need to set this environment variable)
 # os.environ['GOOGLE_APPLICATION_CREDENTIALS'] = 'path/to/your/service-account-key.json'
@@ -55,7 +63,7 @@ def extract_total_amount(text: str) -> Optional[str]:
     # Regex for CAD amounts - more precise to avoid false matches
     cad_amount_regex = re.compile(r"(\$|CAD)\s?([\d,]+\.\d{2})")
     # Regex for numbers that look like totals - must end with .XX and not be part of larger number
-    number_regex = re.compile(r"(?<!\d)([\d,]+\.\d{2})(?!\d)")
+    number_regex = re.compile(r"(?<![\d,])([\d,]+\.\d{2})(?!\d)")
     for line in lines:
         # Skip lines that contain points/rewards to avoid false matches
         if 'point' in line.lower() or 'p(' in line.lower() or 'p=' in line.lower():
@@ -137,52 +145,117 @@ def extract_date(text: str) -> Optional[str]:
     
     return None
 
-def scan_receipt_gcp(image_path: str) -> Dict[str, Optional[str]]:
+def extract_fields(text: str) -> Dict[str, Optional[str]]:
+    # Extract fields (from length-capped text so garbage OCR cannot pin the CPU)
+    text = bound_text(text)
+    with tracer.span("extract.fields", **{"text.length": len(text)}):
+        return {
+            "store_name": extract_store_name(text),
+            "total_amount": extract_total_amount(text),
+            "date": extract_date(text)
+        }
+
+def _vision_text_detection(client, image, scope=None):
+    with tracer.span("vision.text_detection", KIND_CLIENT, **{"image.bytes": len(image.content)}):
+        return client.text_detection(image=image)
+
+def open_router(backends: str = OCR_BACKENDS) -> OcrRouter:
+    # OCR backends from OCR_BACKENDS; the Vision client is only created if Vision is used
+    clients = []
+    lock = threading.Lock()
+
+    def get_client():
+        with lock:
+            if not clients:
+                with tracer.span("vision.client"):
+                    clients.append(vision.ImageAnnotatorClient())
+            return clients[0]
+    return open_ocr_router(get_client, _vision_text_detection, backends)
+
+def detect_text(router: OcrRouter, content: bytes, policy: Optional[str] = None,
+                priority: Optional[str] = None) -> str:
+    # Perform text detection and return the full text (raises if every backend fails,
+    # or BudgetExceeded when the daily OCR budget does not allow the call)
+    return router.detect(content, policy=policy, tenant=CLI_TENANT, priority=priority).text
+
+def scan_receipt_gcp(image_path: str, backends: str = OCR_BACKENDS) -> Dict[str, Optional[str]]:
+    # One trace per scan, continuing the caller's TRACEPARENT if set
+    with tracer.span("scan.cli", traceparent=os.environ.get('TRACEPARENT'), **{"image.path": image_path}):
+        return _scan_receipt_gcp(image_path, backends)
+
+def _scan_receipt_gcp(image_path: str, backends: str = OCR_BACKENDS) -> Dict[str, Optional[str]]:
     try:
-        # Initialize the Google Cloud Vision client
-        print("Initializing Google Cloud Vision client...")
-        client = vision.ImageAnnotatorClient()
+        # Set up the OCR backends (Google Cloud Vision by default)
+        print(f"Initializing OCR backends: {backends}...")
+        router = open_router(backends)
         
         # Load the image
         print(f"Loading image: {image_path}")
-        with open(image_path, 'rb') as image_file:
-            content = image_file.read()
-        
-        image = vision.Image(content=content)
+        with tracer.span("image.read"):
+            with open(image_path, 'rb') as image_file:
+                content = image_file.read()
         
         # Perform text detection
         print("Performing text detection...")
-        response = client.text_detection(image=image)
-        texts = response.text_annotations
-        
-        if response.error.message:
-            raise Exception(f'{response.error.message}')
+        text = detect_text(router, content)
             
     except Exception as e:
         print(f"Error: {e}")
         return {"store_name": None, "total_amount": None, "date": None}
     
-    # Get the full text
-    if texts:
-        text = texts[0].description
-    else:
-        text = ""
-    
-    # Extract fields
-    store_name = extract_store_name(text)
-    total_amount = extract_total_amount(text)
-    date = extract_date(text)
-    
-    return {
-        "store_name": store_name,
-        "total_amount": total_amount,
-        "date": date
-    }
+    return extract_fields(text)
+
+def scan_archive(archive_path: str, workers: int, backends: str = OCR_BACKENDS) -> None:
+    # Scan every image in a .zip/.eml/.mbox file, streaming members (see archive_ingest.py);
+    # a bulk job, so the cheapest backend goes first (OCR_BULK_POLICY) and it is deferred near the budget
+    import json
+    from archive_ingest import iter_archive_images, scan_concurrently
+
+    router = open_router(backends)
+    scan = lambda content: extract_fields(detect_text(router, content, OCR_BULK_POLICY, BULK))
+    with open(archive_path, 'rb') as archive:
+        images = iter_archive_images(archive, os.path.basename(archive_path))
+        for name, result in scan_concurrently(images, scan, workers):
+            print(json.dumps({"name": name, **result}))
+
+def watch_folder(directory: str, workers: int, settle_seconds: float, on_done: str, poll: bool,
+                 backends: str = OCR_BACKENDS) -> None:
+    # Daemon mode: scan every image dropped into directory (see watch_folder.py)
+    import logging
+    import signal
+    from watch_folder import FolderWatcher
+
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s %(levelname)s %(message)s")
+    router = open_router(backends)  # one set of backends shared by all workers
+    # Images deferred by the OCR budget stay in the folder and are scanned once it resets
+    watcher = FolderWatcher(directory, lambda content, path: extract_fields(detect_text(router, content, OCR_BULK_POLICY, BULK)),
+                            workers=workers, settle_seconds=settle_seconds, on_done=on_done,
+                            use_inotify=not poll)
+    # Finish the scans in progress on Ctrl+C / SIGTERM
+    signal.signal(signal.SIGINT, lambda *args: watcher.stop())
+    signal.signal(signal.SIGTERM, lambda *args: watcher.stop())
+    watcher.run()
 
 if __name__ == "__main__":
+    import argparse
     import sys
-    if len(sys.argv) < 2:
-        print("Usage: python scan_receipt_gcp.py <image_path>")
+    parser = argparse.ArgumentParser(description="Scan a receipt image, or watch a folder for new ones")
+    parser.add_argument("image_path", nargs="?", help="receipt image, or a .zip/.eml/.mbox of receipts, to scan")
+    parser.add_argument("--watch", metavar="DIR", help="scan every image dropped into DIR until stopped")
+    parser.add_argument("--workers", type=int, default=4, help="concurrent scans in watch and archive mode")
+    parser.add_argument("--settle", type=float, default=2.0, help="seconds a file must stay unchanged before it is scanned")
+    parser.add_argument("--on-done", choices=["move", "tag", "keep"], default="move",
+                        help="move scanned files to processed/ (default), tag them with an xattr, or keep them")
+    parser.add_argument("--poll", action="store_true", help="poll the folder instead of using inotify")
+    parser.add_argument("--backends", default=OCR_BACKENDS,
+                        help="OCR backends in order of preference, e.g. vision,tesseract (default OCR_BACKENDS)")
+    args = parser.parse_args()
+    if args.watch:
+        watch_folder(args.watch, args.workers, args.settle, args.on_done, args.poll, args.backends)
+    elif args.image_path and args.image_path.lower().endswith(('.zip', '.eml', '.mbox')):
+        scan_archive(args.image_path, args.workers, args.backends)
+    elif args.image_path:
+        print(scan_receipt_gcp(args.image_path, args.backends))
+    else:
+        print("Usage: python scan_receipt_gcp.py <image_path> | --watch <dir>")
         sys.exit(1)
-    result = scan_receipt_gcp(sys.argv[1])
-    print(result)
@@ -0,0 +1,287 @@
+"""
+Scan store
+==========
+
+SQLite persistence of every successful scan: the full OCR text of each
+receipt plus the fields extracted from it. Keeping the OCR text means
+extraction rules can be improved and replayed over historical scans
+(see reextract.py) without calling Vision again.
+
+Scans are kept per tenant: the same image scanned by two tenants is two
+sets of rows, so each tenant's history and spend only ever contain its own
+scans. Scans without a tenant (CLI, imports) are stored under "".
+
+Every write also updates the spend rollups (spend_rollups.py) in the same
+transaction, so the aggregates follow re-scans and re-extractions.
+
+The database path comes from SCAN_DB_PATH (default scans.db); set it to an
+empty string to disable persistence.
+"""
+
+import os
+import sqlite3
+import threading
+from datetime import datetime, timezone
+from typing import Dict, Iterator, List, Optional, Tuple
+
+import spend_rollups
+from spend_rollups import normalise_date, normalise_total
+
+SCAN_DB_PATH = os.environ.get('SCAN_DB_PATH', 'scans.db')
+FIELDS = ("store_name", "total_amount", "date")
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS scans (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    image_hash TEXT NOT NULL,
+    receipt_index INTEGER NOT NULL DEFAULT 0,
+    tenant TEXT NOT NULL DEFAULT '',
+    created_at TEXT NOT NULL,
+    ocr_text TEXT NOT NULL,
+    store_name TEXT,
+    total_amount TEXT,
+    date TEXT,
+    extracted_at TEXT NOT NULL,
+    total_cents INTEGER,
+    spend_date TEXT,
+    UNIQUE (image_hash, tenant, receipt_index)
+);
+"""
+COLUMNS = ("id", "image_hash", "receipt_index", "tenant", "created_at", "ocr_text", "store_name",
+           "total_amount", "date", "extracted_at", "total_cents", "spend_date")
+
+INDEXES = """
+CREATE INDEX IF NOT EXISTS idx_scans_store_date ON scans (tenant, store_name, spend_date);
+CREATE INDEX IF NOT EXISTS idx_scans_spend_date ON scans (tenant, spend_date);
+"""
+
+
+def _now() -> str:
+    return datetime.now(timezone.utc).isoformat(timespec='seconds')
+
+
+class ScanStore:
+    """Thread-safe access to the scans table (one SQLite connection per thread)."""
+
+    def __init__(self, path: str = SCAN_DB_PATH):
+        self.path = path
+        self._local = threading.local()
+        conn = self._connect()
+        with conn:
+            conn.executescript(SCHEMA)
+            self._migrate(conn)
+            conn.executescript(INDEXES)
+
+    def _migrate(self, conn: sqlite3.Connection) -> None:
+        """Add the normalised spend columns and per-tenant rollup tables to an older database."""
+        columns = {row[1] for row in conn.execute("PRAGMA table_info(scans)")}
+        rollup_columns = {row[1] for row in conn.execute("PRAGMA table_info(rollup_store_month)")}
+        has_rollups = 'tenant' in rollup_columns
+        if rollup_columns and not has_rollups:
+            # Rollups from before they were split by tenant: rebuilt below
+            conn.execute("DROP TABLE rollup_store_month")
+            conn.execute("DROP TABLE IF EXISTS rollup_date")
+        if 'total_cents' not in columns:
+            conn.execute("ALTER TABLE scans ADD COLUMN total_cents INTEGER")
+            conn.execute("ALTER TABLE scans ADD COLUMN spend_date TEXT")
+            rows = conn.execute("SELECT id, total_amount, date FROM scans").fetchall()
+            conn.executemany("UPDATE scans SET total_cents = ?, spend_date = ? WHERE id = ?",
+                             [(normalise_total(total), normalise_date(day), scan_id) for scan_id, total, day in rows])
+        if not self._keyed_by_tenant(conn):
+            # Scans from before rows were kept per tenant: copy them into the new table
+            tenant = "COALESCE(tenant, '')" if 'tenant' in columns else "''"
+            conn.execute("ALTER TABLE scans RENAME TO scans_untenanted")
+            conn.execute(SCHEMA)
+            conn.execute(f"""
+                INSERT INTO scans ({', '.join(COLUMNS)})
+                SELECT {', '.join(tenant if c == 'tenant' else c for c in COLUMNS)}
+                FROM scans_untenanted
+            """)
+            conn.execute("DROP TABLE scans_untenanted")
+        if not has_rollups:
+            conn.executescript(spend_rollups.SCHEMA)
+            spend_rollups.rebuild(conn)
+
+    @staticmethod
+    def _keyed_by_tenant(conn: sqlite3.Connection) -> bool:
+        for _, name, unique, *_ in conn.execute("PRAGMA index_list(scans)"):
+            if unique and 'tenant' in {row[2] for row in conn.execute(f"PRAGMA index_info({name})")}:
+                return True
+        return False
+
+    def _connect(self) -> sqlite3.Connection:
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=30)
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute('PRAGMA synchronous=NORMAL')
+            self._local.conn = conn
+        return conn
+
+    def record_scan(self, image_hash: str, receipts: List[Tuple[str, Dict]], tenant: Optional[str] = None) -> None:
+        """
+        Store (ocr_text, fields) for each receipt a tenant found in one image,
+        replacing that tenant's previous scan of it (including receipts a
+        re-scan no longer finds).
+        """
+        tenant = tenant or ''
+        now = _now()
+        rows = [
+            (image_hash, index, tenant, now, text, fields.get("store_name"),
+             fields.get("total_amount"), fields.get("date"), now,
+             normalise_total(fields.get("total_amount")), normalise_date(fields.get("date")))
+            for index, (text, fields) in enumerate(receipts)
+        ]
+        conn = self._connect()
+        with conn:
+            # Take the write lock before reading the previous fields so a concurrent
+            # re-scan of the same image cannot apply the same rollup delta twice
+            conn.execute("BEGIN IMMEDIATE")
+            previous = {
+                row[0]: dict(zip(FIELDS, row[1:]))
+                for row in conn.execute(f"""
+                    SELECT receipt_index, {', '.join(FIELDS)} FROM scans WHERE image_hash = ? AND tenant = ?
+                """, (image_hash, tenant))
+            }
+            conn.executemany("""
+                INSERT INTO scans (image_hash, receipt_index, tenant, created_at, ocr_text,
+                                   store_name, total_amount, date, extracted_at, total_cents, spend_date)
+                VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+                ON CONFLICT (image_hash, tenant, receipt_index) DO UPDATE SET
+                    ocr_text = excluded.ocr_text,
+                    store_name = excluded.store_name,
+                    total_amount = excluded.total_amount,
+                    date = excluded.date,
+                    extracted_at = excluded.extracted_at,
+                    total_cents = excluded.total_cents,
+                    spend_date = excluded.spend_date
+            """, rows)
+            conn.execute("DELETE FROM scans WHERE image_hash = ? AND tenant = ? AND receipt_index >= ?",
+                         (image_hash, tenant, len(receipts)))
+            for index, old_fields in previous.items():
+                if index >= len(receipts):
+                    spend_rollups.remove_receipt(conn, old_fields, tenant)
+            for index, (_, fields) in enumerate(receipts):
+                if index in previous:
+                    spend_rollups.remove_receipt(conn, previous[index], tenant)
+                spend_rollups.add_receipt(conn, fields, tenant)
+
+    def iter_batches(self, batch_size: int = 500) -> Iterator[List[Dict]]:
+        """Yield all scans in id order, batch_size rows at a time."""
+        last_id = 0
+        conn = self._connect()
+        while True:
+            rows = conn.execute(f"""
+                SELECT id, image_hash, ocr_text, {', '.join(FIELDS)}
+                FROM scans WHERE id > ? ORDER BY id LIMIT ?
+            """, (last_id, batch_size)).fetchall()
+            if not rows:
+                return
+            yield [
+                {"id": row[0], "image_hash": row[1], "ocr_text": row[2],
+                 "fields": dict(zip(FIELDS, row[3:]))}
+                for row in rows
+            ]
+            last_id = rows[-1][0]
+
+    def iter_texts_by_image(self) -> Iterator[Tuple[str, List[str]]]:
+        """Yield (image_hash, receipt texts in order) for every stored image, once however many tenants scanned it."""
+        current, texts = None, []
+        for image_hash, text, _ in self._connect().execute("""
+                SELECT image_hash, ocr_text, MIN(id) FROM scans
+                GROUP BY image_hash, receipt_index ORDER BY image_hash, receipt_index
+        """):
+            if image_hash != current and texts:
+                yield current, texts
+                texts = []
+            current = image_hash
+            texts.append(text)
+        if texts:
+            yield current, texts
+
+    def receipts_for_image(self, image_hash: str, tenant: Optional[str] = None) -> List[Tuple[str, Dict]]:
+        """(ocr_text, fields) of each receipt a tenant stored for an image, in order; empty if none."""
+        rows = self._connect().execute(f"""
+            SELECT ocr_text, {', '.join(FIELDS)} FROM scans
+            WHERE image_hash = ? AND tenant = ? ORDER BY receipt_index
+        """, (image_hash, tenant or '')).fetchall()
+        return [(row[0], dict(zip(FIELDS, row[1:]))) for row in rows]
+
+    def share_scan(self, image_hash: str, tenant: Optional[str] = None) -> bool:
+        """
+        Give a tenant its own rows for an image whose OCR result it received from
+        another tenant's scan (a coalesced request). Returns False when the tenant
+        already has rows for the image or nobody does.
+        """
+        if self.receipts_for_image(image_hash, tenant):
+            return False
+        row = self._connect().execute(
+            "SELECT tenant FROM scans WHERE image_hash = ? ORDER BY extracted_at DESC, id DESC LIMIT 1",
+            (image_hash,)).fetchone()
+        if row is None:
+            return False
+        self.record_scan(image_hash, self.receipts_for_image(image_hash, row[0]), tenant)
+        return True
+
+    def fields_by_key(self, keys: List[Tuple[str, int]]) -> Dict[Tuple[str, int], List[Tuple[int, Dict]]]:
+        """Map (image_hash, receipt_index) keys to (scan id, stored fields) of every tenant's scan."""
+        found = {}
+        conn = self._connect()
+        for start in range(0, len(keys), 400):
+            chunk = keys[start:start + 400]
+            where = ' OR '.join(['(image_hash = ? AND receipt_index = ?)'] * len(chunk))
+            params = [value for key in chunk for value in key]
+            for row in conn.execute(f"""
+                SELECT id, image_hash, receipt_index, {', '.join(FIELDS)} FROM scans WHERE {where}
+            """, params):
+                found.setdefault((row[1], row[2]), []).append((row[0], dict(zip(FIELDS, row[3:]))))
+        return found
+
+    def update_fields(self, updates: List[Tuple[int, Dict]]) -> None:
+        """Write re-extracted fields back for (scan id, fields) pairs."""
+        now = _now()
+        updates = list(dict(updates).items())  # last update per scan wins
+        conn = self._connect()
+        with conn:
+            conn.execute("BEGIN IMMEDIATE")
+            previous = {}
+            ids = [scan_id for scan_id, _ in updates]
+            for start in range(0, len(ids), 500):
+                chunk = ids[start:start + 500]
+                for row in conn.execute(
+                        f"SELECT id, tenant, {', '.join(FIELDS)} FROM scans WHERE id IN ({', '.join('?' * len(chunk))})",
+                        chunk):
+                    previous[row[0]] = (row[1], dict(zip(FIELDS, row[2:])))
+            conn.executemany("""
+                UPDATE scans SET store_name = ?, total_amount = ?, date = ?, extracted_at = ?,
+                                 total_cents = ?, spend_date = ?
+                WHERE id = ?
+            """, [(f.get("store_name"), f.get("total_amount"), f.get("date"), now,
+                   normalise_total(f.get("total_amount")), normalise_date(f.get("date")), scan_id)
+                  for scan_id, f in updates])
+            for scan_id, fields in updates:
+                if scan_id in previous:
+                    tenant, old_fields = previous[scan_id]
+                    spend_rollups.remove_receipt(conn, old_fields, tenant)
+                    spend_rollups.add_receipt(conn, fields, tenant)
+
+    def spend_stats(self, tenant: Optional[str], store: Optional[str] = None, month_from: Optional[str] = None,
+                    month_to: Optional[str] = None) -> Dict[str, List[Dict]]:
+        """One tenant's pre-aggregated spend by store x month and by date (see spend_rollups.read_stats)."""
+        return spend_rollups.read_stats(self._connect(), tenant, store, month_from, month_to)
+
+    def rebuild_rollups(self) -> None:
+        conn = self._connect()
+        with conn:
+            conn.execute("BEGIN IMMEDIATE")
+            spend_rollups.rebuild(conn)
+
+    def count(self) -> int:
+        return self._connect().execute("SELECT COUNT(*) FROM scans").fetchone()[0]
+
+
+def open_scan_store() -> Optional[ScanStore]:
+    """Open the configured store, or return None when persistence is disabled."""
+    if not SCAN_DB_PATH:
+        return None
+    return ScanStore(SCAN_DB_PATH)
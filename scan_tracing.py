@@ -0,0 +1,316 @@
+"""
+Scan tracing
+============
+
+Lightweight trace spans for every stage of a scan (request, upload read,
+prescreen, cache lookup, OCR queue, Vision client and RPC attempts, each
+extractor, persistence), exported in the OpenTelemetry OTLP/JSON format
+without needing the OpenTelemetry SDK.
+
+Configuration:
+
+    TRACE_EXPORTER        "" (off, default), "file" or "otlp"
+    TRACE_FILE            JSON Lines file for the file exporter (default traces.jsonl),
+                          one ExportTraceServiceRequest per line, readable by the
+                          collector's otlpjsonfile receiver
+    TRACE_OTLP_ENDPOINT   OTLP/HTTP JSON endpoint (default http://localhost:4318/v1/traces)
+    TRACE_SERVICE_NAME    service.name resource attribute (default receipt-scanner)
+
+Traces are correlated across the web page, API and CLI with the W3C
+traceparent header (or the TRACEPARENT environment variable for the CLI).
+Responses return the traceparent of the request span.
+
+When tracing is off, tracer.span() returns a shared no-op object, so
+instrumented code pays one attribute check per stage.
+"""
+
+import atexit
+import contextvars
+import json
+import logging
+import os
+import queue
+import re
+import secrets
+import threading
+import time
+import urllib.request
+from typing import Dict, List, Optional, Tuple
+
+logger = logging.getLogger(__name__)
+
+TRACE_EXPORTER = os.environ.get('TRACE_EXPORTER', '').lower()
+TRACE_FILE = os.environ.get('TRACE_FILE', 'traces.jsonl')
+TRACE_OTLP_ENDPOINT = os.environ.get('TRACE_OTLP_ENDPOINT', 'http://localhost:4318/v1/traces')
+TRACE_SERVICE_NAME = os.environ.get('TRACE_SERVICE_NAME', 'receipt-scanner')
+
+# OTLP enums
+KIND_INTERNAL = 1
+KIND_SERVER = 2
+KIND_CLIENT = 3
+STATUS_UNSET = 0
+STATUS_OK = 1
+STATUS_ERROR = 2
+
+_traceparent_regex = re.compile(r"^00-([0-9a-f]{32})-([0-9a-f]{16})-[0-9a-f]{2}$")
+_current_span = contextvars.ContextVar('current_span', default=None)
+
+
+def parse_traceparent(header: Optional[str]) -> Optional[Tuple[str, str]]:
+    """W3C traceparent -> (trace id, parent span id), or None if absent or malformed."""
+    match = _traceparent_regex.match((header or '').strip().lower())
+    if not match or match.group(1) == '0' * 32 or match.group(2) == '0' * 16:
+        return None
+    return match.group(1), match.group(2)
+
+
+def _otlp_value(value) -> Dict:
+    if isinstance(value, bool):
+        return {"boolValue": value}
+    if isinstance(value, int):
+        return {"intValue": str(value)}
+    if isinstance(value, float):
+        return {"doubleValue": value}
+    return {"stringValue": str(value)}
+
+
+def _otlp_attributes(attributes: Dict) -> List[Dict]:
+    return [{"key": key, "value": _otlp_value(value)} for key, value in attributes.items() if value is not None]
+
+
+class Span:
+    """One timed operation. Use through Tracer.span()."""
+
+    __slots__ = ('tracer', 'trace_id', 'span_id', 'parent_id', 'name', 'kind', 'start_ns', 'end_ns',
+                 'attributes', 'events', 'status', 'status_message', '_token')
+
+    def __init__(self, tracer: 'Tracer', name: str, kind: int, parent: Optional[Tuple[str, str]], attributes: Dict):
+        self.tracer = tracer
+        self.trace_id, self.parent_id = parent if parent else (secrets.token_hex(16), None)
+        self.span_id = secrets.token_hex(8)
+        self.name = name
+        self.kind = kind
+        self.attributes = attributes
+        self.events = []
+        self.status = STATUS_UNSET
+        self.status_message = None
+        self.start_ns = time.time_ns()
+        self.end_ns = None
+        self._token = None
+
+    def set_attribute(self, key: str, value) -> None:
+        self.attributes[key] = value
+
+    def set_attributes(self, **attributes) -> None:
+        self.attributes.update(attributes)
+
+    def add_event(self, name: str, **attributes) -> None:
+        self.events.append((time.time_ns(), name, attributes))
+
+    def record_error(self, error: BaseException) -> None:
+        self.status = STATUS_ERROR
+        self.status_message = str(error)
+        self.add_event("exception", **{"exception.type": type(error).__name__, "exception.message": str(error)})
+
+    @property
+    def traceparent(self) -> str:
+        return f"00-{self.trace_id}-{self.span_id}-01"
+
+    def end(self) -> None:
+        if self.end_ns is None:
+            self.end_ns = time.time_ns()
+            self.tracer.exporter.submit(self)
+
+    def __enter__(self):
+        self._token = _current_span.set(self)
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        if exc is not None:
+            self.record_error(exc)
+        try:
+            _current_span.reset(self._token)
+        except ValueError:
+            pass  # ended from another context (e.g. after a streamed response)
+        self.end()
+        return False
+
+    def to_otlp(self) -> Dict:
+        span = {
+            "traceId": self.trace_id,
+            "spanId": self.span_id,
+            "name": self.name,
+            "kind": self.kind,
+            "startTimeUnixNano": str(self.start_ns),
+            "endTimeUnixNano": str(self.end_ns),
+            "attributes": _otlp_attributes(self.attributes),
+            "events": [{"timeUnixNano": str(at), "name": name, "attributes": _otlp_attributes(attributes)}
+                       for at, name, attributes in self.events],
+            "status": {"code": self.status}
+        }
+        if self.parent_id:
+            span["parentSpanId"] = self.parent_id
+        if self.status_message:
+            span["status"]["message"] = self.status_message
+        return span
+
+
+class _NoopSpan:
+    """Stands in for a Span when tracing is off."""
+
+    traceparent = None
+
+    def set_attribute(self, key, value):
+        pass
+
+    def set_attributes(self, **attributes):
+        pass
+
+    def add_event(self, name, **attributes):
+        pass
+
+    def record_error(self, error):
+        pass
+
+    def end(self):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        return False
+
+
+NOOP_SPAN = _NoopSpan()
+
+
+class BatchExporter:
+    """Buffers finished spans and writes them out from a background thread."""
+
+    def __init__(self, kind: str, service_name: str = TRACE_SERVICE_NAME, path: str = TRACE_FILE,
+                 endpoint: str = TRACE_OTLP_ENDPOINT, max_batch: int = 512, interval: float = 2.0):
+        self.kind = kind
+        self.service_name = service_name
+        self.path = path
+        self.endpoint = endpoint
+        self.max_batch = max_batch
+        self.interval = interval
+        self._queue: "queue.Queue[Span]" = queue.Queue(maxsize=10000)
+        self._thread = threading.Thread(target=self._run, name="trace-exporter", daemon=True)
+        self._thread.start()
+        atexit.register(self.flush)
+
+    def submit(self, span: Span) -> None:
+        try:
+            self._queue.put_nowait(span)
+        except queue.Full:
+            pass  # never block a scan on tracing
+
+    def _drain(self) -> List[Span]:
+        spans = []
+        while len(spans) < self.max_batch:
+            try:
+                spans.append(self._queue.get_nowait())
+            except queue.Empty:
+                break
+        return spans
+
+    def _run(self) -> None:
+        while True:
+            time.sleep(self.interval)
+            self.flush()
+
+    def flush(self) -> None:
+        while True:
+            spans = self._drain()
+            if not spans:
+                return
+            try:
+                self._export(spans)
+            except Exception as e:
+                logger.warning(f"Could not export {len(spans)} trace spans: {str(e)}")
+                return
+
+    def _export(self, spans: List[Span]) -> None:
+        payload = json.dumps({"resourceSpans": [{
+            "resource": {"attributes": _otlp_attributes({"service.name": self.service_name})},
+            "scopeSpans": [{"scope": {"name": "receipt-scanner"}, "spans": [span.to_otlp() for span in spans]}]
+        }]})
+        if self.kind == 'file':
+            with open(self.path, 'a') as f:
+                f.write(payload + '\n')
+        else:
+            request = urllib.request.Request(self.endpoint, data=payload.encode(),
+                                             headers={"Content-Type": "application/json"}, method='POST')
+            urllib.request.urlopen(request, timeout=5).close()
+
+
+class Tracer:
+    def __init__(self, exporter: Optional[BatchExporter] = None):
+        self.exporter = exporter
+
+    @property
+    def enabled(self) -> bool:
+        return self.exporter is not None
+
+    def span(self, name: str, kind: int = KIND_INTERNAL, traceparent: Optional[str] = None, **attributes):
+        """
+        Context manager timing one stage as a child of the current span (or of
+        the given traceparent, or as a new trace).
+        """
+        if self.exporter is None:
+            return NOOP_SPAN
+        parent = parse_traceparent(traceparent) if traceparent else None
+        if parent is None:
+            current = _current_span.get()
+            parent = (current.trace_id, current.span_id) if current else None
+        return Span(self, name, kind, parent, attributes)
+
+    def current_traceparent(self) -> Optional[str]:
+        current = _current_span.get()
+        return current.traceparent if current else None
+
+
+def _tracer_from_env() -> Tracer:
+    if TRACE_EXPORTER in ('file', 'otlp'):
+        return Tracer(BatchExporter(TRACE_EXPORTER))
+    if TRACE_EXPORTER:
+        logger.warning(f"Unknown TRACE_EXPORTER {TRACE_EXPORTER!r}, tracing is off")
+    return Tracer()
+
+
+tracer = _tracer_from_env()
+
+
+def install_tracing(app, tracer: Tracer = tracer) -> None:
+    """Open a server span for every request to a Flask app, continuing an incoming traceparent."""
+    if not tracer.enabled:
+        return
+    from flask import g, request
+
+    @app.before_request
+    def start_request_span():
+        span = tracer.span(f"{request.method} {request.url_rule.rule if request.url_rule else request.path}",
+                           KIND_SERVER, request.headers.get('traceparent'),
+                           **{"http.method": request.method, "http.target": request.path,
+                              "http.request_content_length": request.content_length,
+                              "request.id": g.get('request_id')})
+        g.trace_span = span
+        span.__enter__()
+
+    @app.after_request
+    def tag_response(response):
+        span = g.get('trace_span')
+        if span is not None:
+            span.set_attribute("http.status_code", response.status_code)
+            if response.status_code >= 500:
+                span.status = STATUS_ERROR
+            response.headers['traceparent'] = span.traceparent
+        return response
+
+    @app.teardown_request
+    def end_request_span(error):
+        span = g.pop('trace_span', None)
+        if span is not None:
+            span.__exit__(type(error) if error else None, error, None)
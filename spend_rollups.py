@@ -0,0 +1,259 @@
+"""
+Spending rollups
+================
+
+Materialised spend aggregates kept next to the scans in the scan store:
+count, sum, min and max of the normalised receipt totals by tenant x store
+x month and by tenant x date, so each tenant only ever reads its own. The
+scan store applies a delta inside the same transaction as every insert,
+re-scan or re-extraction, so the rollups are always consistent with the
+scans and dashboard queries read a handful of pre-aggregated rows instead
+of every receipt.
+
+Totals are kept in integer cents. Receipts without a readable date are
+counted under the month "unknown" (and not by date); receipts without a
+store name under "Unknown"; scans without a tenant (the CLI, re-imports)
+under the tenant "".
+"""
+
+import re
+import sqlite3
+from datetime import date
+from typing import Dict, List, Optional, Tuple
+
+UNKNOWN_STORE = "Unknown"
+UNKNOWN_MONTH = "unknown"
+NO_TENANT = ""
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS rollup_store_month (
+    tenant TEXT NOT NULL,
+    store TEXT NOT NULL,
+    month TEXT NOT NULL,
+    count INTEGER NOT NULL,
+    total_cents INTEGER NOT NULL,
+    min_cents INTEGER,
+    max_cents INTEGER,
+    PRIMARY KEY (tenant, store, month)
+);
+CREATE TABLE IF NOT EXISTS rollup_date (
+    tenant TEXT NOT NULL,
+    spend_date TEXT NOT NULL,
+    count INTEGER NOT NULL,
+    total_cents INTEGER NOT NULL,
+    min_cents INTEGER,
+    max_cents INTEGER,
+    PRIMARY KEY (tenant, spend_date)
+);
+"""
+
+_amount_regex = re.compile(r"(\d+(?:\.\d{1,2})?)")
+_date_parts_regex = re.compile(r"(\d{1,4})[-/](\d{1,2})[-/](\d{1,4})")
+
+
+def normalise_total(total_amount: Optional[str]) -> Optional[int]:
+    """'CAD 1,234.56' -> 123456 (cents), or None when there is no amount."""
+    if not total_amount:
+        return None
+    match = _amount_regex.search(total_amount.replace(',', ''))
+    if not match:
+        return None
+    return int(round(float(match.group(1)) * 100))
+
+
+def normalise_date(value: Optional[str]) -> Optional[str]:
+    """Extracted dates (Y/M/D, M/D/Y, M/D/YY, with / or -) -> ISO YYYY-MM-DD."""
+    if not value:
+        return None
+    match = _date_parts_regex.search(value)
+    if not match:
+        return None
+    first, second, third = match.groups()
+    if len(first) == 4:
+        year, month, day = first, second, third
+    else:
+        month, day, year = first, second, third
+    year = int(year)
+    if year < 100:
+        year += 2000 if year <= 30 else 1900
+    try:
+        return date(year, int(month), int(day)).isoformat()
+    except ValueError:
+        return None
+
+
+def rollup_key(fields: Dict) -> Tuple[str, Optional[str], Optional[int]]:
+    """(store, ISO date, cents) used to aggregate one receipt's fields."""
+    return (fields.get("store_name") or UNKNOWN_STORE,
+            normalise_date(fields.get("date")),
+            normalise_total(fields.get("total_amount")))
+
+
+def _month(spend_date: Optional[str]) -> str:
+    return spend_date[:7] if spend_date else UNKNOWN_MONTH
+
+
+def add_receipt(conn: sqlite3.Connection, fields: Dict, tenant: Optional[str] = None) -> None:
+    """Count one receipt of a tenant in the rollups."""
+    store, spend_date, cents = rollup_key(fields)
+    if cents is None:
+        return
+    tenant = tenant or NO_TENANT
+    conn.execute("""
+        INSERT INTO rollup_store_month (tenant, store, month, count, total_cents, min_cents, max_cents)
+        VALUES (?, ?, ?, 1, ?, ?, ?)
+        ON CONFLICT (tenant, store, month) DO UPDATE SET
+            count = count + 1,
+            total_cents = total_cents + excluded.total_cents,
+            min_cents = MIN(COALESCE(min_cents, excluded.min_cents), excluded.min_cents),
+            max_cents = MAX(COALESCE(max_cents, excluded.max_cents), excluded.max_cents)
+    """, (tenant, store, _month(spend_date), cents, cents, cents))
+    if spend_date:
+        conn.execute("""
+            INSERT INTO rollup_date (tenant, spend_date, count, total_cents, min_cents, max_cents)
+            VALUES (?, ?, 1, ?, ?, ?)
+            ON CONFLICT (tenant, spend_date) DO UPDATE SET
+                count = count + 1,
+                total_cents = total_cents + excluded.total_cents,
+                min_cents = MIN(COALESCE(min_cents, excluded.min_cents), excluded.min_cents),
+                max_cents = MAX(COALESCE(max_cents, excluded.max_cents), excluded.max_cents)
+        """, (tenant, spend_date, cents, cents, cents))
+
+
+def remove_receipt(conn: sqlite3.Connection, fields: Dict, tenant: Optional[str] = None) -> None:
+    """
+    Take one receipt of a tenant back out of the rollups. Must be called after
+    the scan row itself has been changed: when the removed amount was a
+    group's min or max, that group's min/max is recomputed from the remaining
+    scans (an indexed query over one tenant's store-month or day).
+    """
+    store, spend_date, cents = rollup_key(fields)
+    if cents is None:
+        return
+    tenant = tenant or NO_TENANT
+    month = _month(spend_date)
+    row = conn.execute("""
+        SELECT count, min_cents, max_cents FROM rollup_store_month WHERE tenant = ? AND store = ? AND month = ?
+    """, (tenant, store, month)).fetchone()
+    if row:
+        if row[0] <= 1:
+            conn.execute("DELETE FROM rollup_store_month WHERE tenant = ? AND store = ? AND month = ?",
+                         (tenant, store, month))
+        else:
+            conn.execute("""
+                UPDATE rollup_store_month SET count = count - 1, total_cents = total_cents - ?
+                WHERE tenant = ? AND store = ? AND month = ?
+            """, (cents, tenant, store, month))
+            if cents in (row[1], row[2]):
+                low, high = _store_month_extremes(conn, tenant, store, spend_date)
+                conn.execute("""
+                    UPDATE rollup_store_month SET min_cents = ?, max_cents = ?
+                    WHERE tenant = ? AND store = ? AND month = ?
+                """, (low, high, tenant, store, month))
+    if not spend_date:
+        return
+    row = conn.execute("SELECT count, min_cents, max_cents FROM rollup_date WHERE tenant = ? AND spend_date = ?",
+                       (tenant, spend_date)).fetchone()
+    if row:
+        if row[0] <= 1:
+            conn.execute("DELETE FROM rollup_date WHERE tenant = ? AND spend_date = ?", (tenant, spend_date))
+        else:
+            conn.execute("""
+                UPDATE rollup_date SET count = count - 1, total_cents = total_cents - ?
+                WHERE tenant = ? AND spend_date = ?
+            """, (cents, tenant, spend_date))
+            if cents in (row[1], row[2]):
+                low, high = conn.execute(f"""
+                    SELECT MIN(total_cents), MAX(total_cents) FROM scans
+                    WHERE tenant = ? AND spend_date = ?
+                """, (tenant, spend_date)).fetchone()
+                conn.execute("UPDATE rollup_date SET min_cents = ?, max_cents = ? WHERE tenant = ? AND spend_date = ?",
+                             (low, high, tenant, spend_date))
+
+
+def _store_month_extremes(conn: sqlite3.Connection, tenant: str, store: str, spend_date: Optional[str]) -> Tuple:
+    store_clause = "(store_name IS NULL OR store_name = '')" if store == UNKNOWN_STORE else "store_name = ?"
+    params = [tenant] + ([] if store == UNKNOWN_STORE else [store])
+    if spend_date:
+        month = _month(spend_date)
+        date_clause = "spend_date >= ? AND spend_date < ?"
+        params += [month, month + "-99"]
+    else:
+        date_clause = "spend_date IS NULL"
+    return conn.execute(
+        f"SELECT MIN(total_cents), MAX(total_cents) FROM scans WHERE tenant = ? AND {store_clause} AND {date_clause}",
+        params
+    ).fetchone()
+
+
+def rebuild(conn: sqlite3.Connection) -> None:
+    """Recompute every rollup from the scans table."""
+    conn.execute("DELETE FROM rollup_store_month")
+    conn.execute("DELETE FROM rollup_date")
+    conn.execute(f"""
+        INSERT INTO rollup_store_month (tenant, store, month, count, total_cents, min_cents, max_cents)
+        SELECT tenant, COALESCE(NULLIF(store_name, ''), '{UNKNOWN_STORE}'),
+               COALESCE(SUBSTR(spend_date, 1, 7), '{UNKNOWN_MONTH}'),
+               COUNT(*), SUM(total_cents), MIN(total_cents), MAX(total_cents)
+        FROM scans WHERE total_cents IS NOT NULL GROUP BY 1, 2, 3
+    """)
+    conn.execute("""
+        INSERT INTO rollup_date (tenant, spend_date, count, total_cents, min_cents, max_cents)
+        SELECT tenant, spend_date, COUNT(*), SUM(total_cents), MIN(total_cents), MAX(total_cents)
+        FROM scans WHERE total_cents IS NOT NULL AND spend_date IS NOT NULL GROUP BY 1, 2
+    """)
+
+
+def _row(keys: Tuple[str, ...], row: Tuple) -> Dict:
+    result = dict(zip(keys, row[:len(keys)]))
+    count, total, low, high = row[len(keys):]
+    result.update({
+        "count": count,
+        "total": round(total / 100, 2),
+        "min": round(low / 100, 2) if low is not None else None,
+        "max": round(high / 100, 2) if high is not None else None,
+        "average": round(total / count / 100, 2) if count else None
+    })
+    return result
+
+
+def read_stats(conn: sqlite3.Connection, tenant: Optional[str], store: Optional[str] = None,
+               month_from: Optional[str] = None, month_to: Optional[str] = None) -> Dict[str, List[Dict]]:
+    """One tenant's rollup rows, optionally limited to one store and a month range (YYYY-MM, inclusive)."""
+    clauses, params = ["tenant = ?"], [tenant or NO_TENANT]
+    if store:
+        clauses.append("store = ?")
+        params.append(store)
+    if month_from:
+        clauses.append("month >= ?")
+        params.append(month_from)
+    if month_to:
+        clauses.append("month <= ?")
+        params.append(month_to)
+    if month_from or month_to:
+        clauses.append(f"month != '{UNKNOWN_MONTH}'")
+    where = f"WHERE {' AND '.join(clauses)}"
+    by_store_month = [
+        _row(("store", "month"), row) for row in conn.execute(f"""
+            SELECT store, month, count, total_cents, min_cents, max_cents
+            FROM rollup_store_month {where} ORDER BY month, store
+        """, params)
+    ]
+
+    by_date = []
+    if not store:
+        clauses, params = ["tenant = ?"], [tenant or NO_TENANT]
+        if month_from:
+            clauses.append("spend_date >= ?")
+            params.append(month_from)
+        if month_to:
+            clauses.append("spend_date < ?")
+            params.append(month_to + "-99")
+        where = f"WHERE {' AND '.join(clauses)}"
+        by_date = [
+            _row(("date",), row) for row in conn.execute(f"""
+                SELECT spend_date, count, total_cents, min_cents, max_cents
+                FROM rollup_date {where} ORDER BY spend_date
+            """, params)
+        ]
+    return {"by_store_month": by_store_month, "by_date": by_date}
@@ -19,6 +19,13 @@ from google.cloud import vision
 import re
 from typing import Dict, Optional
 from PIL import Image
+from merchant_extractors import extract_merchant_total
+from extraction_limits import bound_text
+from ocr_backends import open_ocr_router
+from ocr_budget import BudgetExceeded
+
+# Tenant this app's Vision calls are counted under in the OCR usage ledger (see ocr_budget.py)
+STREAMLIT_TENANT = "streamlit"
 
 # Set page config
 st.set_page_config(
@@ -81,7 +88,7 @@ def extract_total_amount(text: str) -> Optional[str]:
     for i, line in enumerate(lines):
         if 'total prepaid' in line.lower():
             # Try to get amount from same line
-            match = re.search(r'(\d+\.\d{2})', line)
+            match = re.search(r'(?<!\d)(\d+\.\d{2})', line)
             if match:
                 try:
                     amount = float(match.group(1))
@@ -90,7 +97,7 @@ def extract_total_amount(text: str) -> Optional[str]:
                     pass
             # Try next line if not found
             if i + 1 < len(lines):
-                match = re.search(r'(\d+\.\d{2})', lines[i+1])
+                match = re.search(r'(?<!\d)(\d+\.\d{2})', lines[i+1])
                 if match:
                     try:
                         amount = float(match.group(1))
@@ -100,7 +107,7 @@ def extract_total_amount(text: str) -> Optional[str]:
     # Specifically extract amount from 'Balance Due' or 'Credit' lines
     for line in lines:
         if 'balance due' in line.lower():
-            match = re.search(r'(\d+\.\d{2})', line)
+            match = re.search(r'(?<!\d)(\d+\.\d{2})', line)
             if match:
                 try:
                     amount = float(match.group(1))
@@ -109,7 +116,7 @@ def extract_total_amount(text: str) -> Optional[str]:
                     continue
     for line in lines:
         if 'credit' in line.lower():
-            match = re.search(r'(\d+\.\d{2})', line)
+            match = re.search(r'(?<!\d)(\d+\.\d{2})', line)
             if match:
                 try:
                     amount = float(match.group(1))
@@ -123,7 +130,7 @@ def extract_total_amount(text: str) -> Optional[str]:
         line_lower = line.lower()
         for kw in keywords:
             if kw in line_lower:
-                match = re.search(r'(\d+\.\d{2})', line)
+                match = re.search(r'(?<!\d)(\d+\.\d{2})', line)
                 if match:
                     try:
                         amount = float(match.group(1))
@@ -138,7 +145,7 @@ def extract_total_amount(text: str) -> Optional[str]:
         r'TOTAL.*?\$(\d+\.\d{2})',
         r'TOTAL.*?(\d+\.\d{2})',
         r'\$(\d+\.\d{2})',
-        r'(\d+\.\d{2})'
+        r'(?<!\d)(\d+\.\d{2})'
     ]
     amounts = []
     for pattern in patterns:
@@ -231,76 +238,79 @@ def extract_date(text: str) -> Optional[str]:
             continue
     return None
 
-def scan_receipt_from_image(image_bytes) -> Dict[str, Optional[str]]:
-    try:
-        # Try local file first, then environment variable, then Streamlit secrets
-        client = None
-        
-        # First priority: Local service account file
-        service_account_path = "service-account-key.json"
-        if os.path.exists(service_account_path):
-            try:
-                from google.oauth2 import service_account
-                
-                # Load service account from local file
-                credentials = service_account.Credentials.from_service_account_file(
-                    service_account_path
-                )
-                client = vision.ImageAnnotatorClient(credentials=credentials)
-            except Exception as e:
-                return {"error": f"Error loading local service account file: {str(e)}"}
-        
-        # Second priority: Environment variable
-        elif os.environ.get('GOOGLE_APPLICATION_CREDENTIALS'):
-            try:
-                client = vision.ImageAnnotatorClient()
-            except Exception as e:
-                return {"error": f"Error with environment variable credentials: {str(e)}"}
-        
-        # Third priority: Streamlit Cloud secrets
-        elif hasattr(st, 'secrets') and 'gcp_service_account' in st.secrets:
-            try:
-                from google.oauth2 import service_account
-                
-                # Create credentials from Streamlit secrets
-                gcp_service_account = st.secrets["gcp_service_account"]
-                
-                # Validate required fields
-                required_fields = ['type', 'project_id', 'private_key', 'client_email', 'token_uri']
-                missing_fields = [field for field in required_fields if field not in gcp_service_account]
-                
-                if missing_fields:
-                    return {"error": f"Invalid Streamlit secrets configuration: Service account info was not in the expected format, missing fields {', '.join(missing_fields)}."}
-                
-                credentials = service_account.Credentials.from_service_account_info(
-                    gcp_service_account
-                )
-                client = vision.ImageAnnotatorClient(credentials=credentials)
-            except Exception as e:
-                return {"error": f"Invalid Streamlit secrets configuration: {str(e)}"}
-        
-        else:
-            return {"error": "No Google Cloud credentials found. Please ensure service-account-key.json exists in the project directory or configure Streamlit secrets properly."}
+def get_vision_client():
+    """
+    A Vision client from the local service account file, then
+    GOOGLE_APPLICATION_CREDENTIALS, then Streamlit Cloud secrets.
+    Raises RuntimeError saying what is wrong with the credentials.
+    """
+    # First priority: Local service account file
+    service_account_path = "service-account-key.json"
+    if os.path.exists(service_account_path):
+        try:
+            from google.oauth2 import service_account
+            
+            # Load service account from local file
+            credentials = service_account.Credentials.from_service_account_file(
+                service_account_path
+            )
+            return vision.ImageAnnotatorClient(credentials=credentials)
+        except Exception as e:
+            raise RuntimeError(f"Error loading local service account file: {str(e)}")
+    
+    # Second priority: Environment variable
+    if os.environ.get('GOOGLE_APPLICATION_CREDENTIALS'):
+        try:
+            return vision.ImageAnnotatorClient()
+        except Exception as e:
+            raise RuntimeError(f"Error with environment variable credentials: {str(e)}")
+    
+    # Third priority: Streamlit Cloud secrets
+    if hasattr(st, 'secrets') and 'gcp_service_account' in st.secrets:
+        # Create credentials from Streamlit secrets
+        gcp_service_account = st.secrets["gcp_service_account"]
         
-        # Create image object
-        image = vision.Image(content=image_bytes)
+        # Validate required fields
+        required_fields = ['type', 'project_id', 'private_key', 'client_email', 'token_uri']
+        missing_fields = [field for field in required_fields if field not in gcp_service_account]
         
-        # Perform text detection
-        response = client.text_detection(image=image)
-        texts = response.text_annotations
+        if missing_fields:
+            raise RuntimeError(f"Invalid Streamlit secrets configuration: Service account info was not in the expected format, missing fields {', '.join(missing_fields)}.")
         
-        if response.error.message:
-            return {"error": f"Google Cloud Vision API error: {response.error.message}"}
+        try:
+            from google.oauth2 import service_account
+            
+            credentials = service_account.Credentials.from_service_account_info(
+                gcp_service_account
+            )
+            return vision.ImageAnnotatorClient(credentials=credentials)
+        except Exception as e:
+            raise RuntimeError(f"Invalid Streamlit secrets configuration: {str(e)}")
+    
+    raise RuntimeError("No Google Cloud credentials found. Please ensure service-account-key.json exists in the project directory or configure Streamlit secrets properly.")
+
+@st.cache_resource
+def get_ocr_router():
+    """One OCR router per server process, so backend stats and fallback cooldowns carry across scans."""
+    return open_ocr_router(get_vision_client)
+
+def scan_receipt_from_image(image_bytes) -> Dict[str, Optional[str]]:
+    try:
+        # Text detection through the configured OCR backends (OCR_BACKENDS),
+        # counted against the daily OCR budget
+        try:
+            ocr = get_ocr_router().detect(image_bytes, tenant=STREAMLIT_TENANT)
+        except BudgetExceeded as e:
+            return {"error": str(e)}
         
         # Get the full text
-        if texts:
-            text = texts[0].description
-        else:
-            text = ""
+        text = ocr.text
         
-        # Extract fields
+        # Extract fields - known merchants take their layout-specific parser first.
+        # The text is length-capped so garbage OCR cannot pin the CPU in the regexes.
+        text = bound_text(text)
         store_name = extract_store_name(text)
-        total_amount = extract_total_amount(text)
+        total_amount = extract_merchant_total(store_name, text, extract_total_amount) or extract_total_amount(text)
         date = extract_date(text)
         
         return {
@@ -312,7 +322,6 @@ def scan_receipt_from_image(image_bytes) -> Dict[str, Optional[str]]:
         
     except Exception as e:
         return {"error": str(e)}
-
 # Streamlit UI
 def main():
     st.title("🧾 Receipt Scanner AI Agent")
@@ -466,6 +475,13 @@ from google.cloud import vision
 import re
 from typing import Dict, Optional
 from PIL import Image
+from merchant_extractors import extract_merchant_total
+from extraction_limits import bound_text
+from ocr_backends import open_ocr_router
+from ocr_budget import BudgetExceeded
+
+# Tenant this app's Vision calls are counted under in the OCR usage ledger (see ocr_budget.py)
+STREAMLIT_TENANT = "streamlit"
 
 # Set page config
 st.set_page_config(
@@ -527,7 +543,7 @@ def extract_total_amount(text: str) -> Optional[str]:
     lines = [line for line in text.split('\n') if line.strip()]
     for line in lines:
         if 'balance due' in line.lower():
-            match = re.search(r'(\d+\.\d{2})', line)
+            match = re.search(r'(?<!\d)(\d+\.\d{2})', line)
             if match:
                 try:
                     amount = float(match.group(1))
@@ -536,7 +552,7 @@ def extract_total_amount(text: str) -> Optional[str]:
                     continue
     for line in lines:
         if 'credit' in line.lower():
-            match = re.search(r'(\d+\.\d{2})', line)
+            match = re.search(r'(?<!\d)(\d+\.\d{2})', line)
             if match:
                 try:
                     amount = float(match.group(1))
@@ -550,7 +566,7 @@ def extract_total_amount(text: str) -> Optional[str]:
         line_lower = line.lower()
         for kw in keywords:
             if kw in line_lower:
-                match = re.search(r'(\d+\.\d{2})', line)
+                match = re.search(r'(?<!\d)(\d+\.\d{2})', line)
                 if match:
                     try:
                         amount = float(match.group(1))
@@ -565,7 +581,7 @@ def extract_total_amount(text: str) -> Optional[str]:
         r'TOTAL.*?\$(\d+\.\d{2})',
         r'TOTAL.*?(\d+\.\d{2})',
         r'\$(\d+\.\d{2})',
-        r'(\d+\.\d{2})'
+        r'(?<!\d)(\d+\.\d{2})'
     ]
     amounts = []
     for pattern in patterns:
@@ -622,76 +638,79 @@ def extract_date(text: str) -> Optional[str]:
     
     return None
 
-def scan_receipt_from_image(image_bytes) -> Dict[str, Optional[str]]:
-    try:
-        # Try local file first, then environment variable, then Streamlit secrets
-        client = None
-        
-        # First priority: Local service account file
-        service_account_path = "service-account-key.json"
-        if os.path.exists(service_account_path):
-            try:
-                from google.oauth2 import service_account
-                
-                # Load service account from local file
-                credentials = service_account.Credentials.from_service_account_file(
-                    service_account_path
-                )
-                client = vision.ImageAnnotatorClient(credentials=credentials)
-            except Exception as e:
-                return {"error": f"Error loading local service account file: {str(e)}"}
-        
-        # Second priority: Environment variable
-        elif os.environ.get('GOOGLE_APPLICATION_CREDENTIALS'):
-            try:
-                client = vision.ImageAnnotatorClient()
-            except Exception as e:
-                return {"error": f"Error with environment variable credentials: {str(e)}"}
-        
-        # Third priority: Streamlit Cloud secrets
-        elif hasattr(st, 'secrets') and 'gcp_service_account' in st.secrets:
-            try:
-                from google.oauth2 import service_account
-                
-                # Create credentials from Streamlit secrets
-                gcp_service_account = st.secrets["gcp_service_account"]
-                
-                # Validate required fields
-                required_fields = ['type', 'project_id', 'private_key', 'client_email', 'token_uri']
-                missing_fields = [field for field in required_fields if field not in gcp_service_account]
-                
-                if missing_fields:
-                    return {"error": f"Invalid Streamlit secrets configuration: Service account info was not in the expected format, missing fields {', '.join(missing_fields)}."}
-                
-                credentials = service_account.Credentials.from_service_account_info(
-                    gcp_service_account
-                )
-                client = vision.ImageAnnotatorClient(credentials=credentials)
-            except Exception as e:
-                return {"error": f"Invalid Streamlit secrets configuration: {str(e)}"}
-        
-        else:
-            return {"error": "No Google Cloud credentials found. Please ensure service-account-key.json exists in the project directory or configure Streamlit secrets properly."}
+def get_vision_client():
+    """
+    A Vision client from the local service account file, then
+    GOOGLE_APPLICATION_CREDENTIALS, then Streamlit Cloud secrets.
+    Raises RuntimeError saying what is wrong with the credentials.
+    """
+    # First priority: Local service account file
+    service_account_path = "service-account-key.json"
+    if os.path.exists(service_account_path):
+        try:
+            from google.oauth2 import service_account
+            
+            # Load service account from local file
+            credentials = service_account.Credentials.from_service_account_file(
+                service_account_path
+            )
+            return vision.ImageAnnotatorClient(credentials=credentials)
+        except Exception as e:
+            raise RuntimeError(f"Error loading local service account file: {str(e)}")
+    
+    # Second priority: Environment variable
+    if os.environ.get('GOOGLE_APPLICATION_CREDENTIALS'):
+        try:
+            return vision.ImageAnnotatorClient()
+        except Exception as e:
+            raise RuntimeError(f"Error with environment variable credentials: {str(e)}")
+    
+    # Third priority: Streamlit Cloud secrets
+    if hasattr(st, 'secrets') and 'gcp_service_account' in st.secrets:
+        # Create credentials from Streamlit secrets
+        gcp_service_account = st.secrets["gcp_service_account"]
         
-        # Create image object
-        image = vision.Image(content=image_bytes)
+        # Validate required fields
+        required_fields = ['type', 'project_id', 'private_key', 'client_email', 'token_uri']
+        missing_fields = [field for field in required_fields if field not in gcp_service_account]
         
-        # Perform text detection
-        response = client.text_detection(image=image)
-        texts = response.text_annotations
+        if missing_fields:
+            raise RuntimeError(f"Invalid Streamlit secrets configuration: Service account info was not in the expected format, missing fields {', '.join(missing_fields)}.")
         
-        if response.error.message:
-            return {"error": f"Google Cloud Vision API error: {response.error.message}"}
+        try:
+            from google.oauth2 import service_account
+            
+            credentials = service_account.Credentials.from_service_account_info(
+                gcp_service_account
+            )
+            return vision.ImageAnnotatorClient(credentials=credentials)
+        except Exception as e:
+            raise RuntimeError(f"Invalid Streamlit secrets configuration: {str(e)}")
+    
+    raise RuntimeError("No Google Cloud credentials found. Please ensure service-account-key.json exists in the project directory or configure Streamlit secrets properly.")
+
+@st.cache_resource
+def get_ocr_router():
+    """One OCR router per server process, so backend stats and fallback cooldowns carry across scans."""
+    return open_ocr_router(get_vision_client)
+
+def scan_receipt_from_image(image_bytes) -> Dict[str, Optional[str]]:
+    try:
+        # Text detection through the configured OCR backends (OCR_BACKENDS),
+        # counted against the daily OCR budget
+        try:
+            ocr = get_ocr_router().detect(image_bytes, tenant=STREAMLIT_TENANT)
+        except BudgetExceeded as e:
+            return {"error": str(e)}
         
         # Get the full text
-        if texts:
-            text = texts[0].description
-        else:
-            text = ""
+        text = ocr.text
         
-        # Extract fields
+        # Extract fields - known merchants take their layout-specific parser first.
+        # The text is length-capped so garbage OCR cannot pin the CPU in the regexes.
+        text = bound_text(text)
         store_name = extract_store_name(text)
-        total_amount = extract_total_amount(text)
+        total_amount = extract_merchant_total(store_name, text, extract_total_amount) or extract_total_amount(text)
         date = extract_date(text)
         
         return {
@@ -703,7 +722,6 @@ def scan_receipt_from_image(image_bytes) -> Dict[str, Optional[str]]:
         
     except Exception as e:
         return {"error": str(e)}
-
 # Streamlit UI
 def main():
     st.title("🧾 Receipt Scanner AI Agent")
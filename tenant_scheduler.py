@@ -0,0 +1,291 @@
+"""
+Tenant scheduling
+=================
+
+API-key identification, per-tenant rate limiting and weighted fair sharing of
+OCR capacity for the REST API.
+
+Tenants are configured with the API_KEYS environment variable (or an
+api_keys.json file) as JSON mapping each key to its settings:
+
+    {"key-123": {"tenant": "acme", "weight": 2, "rate": 5, "burst": 20, "priority": "bulk"}}
+
+- weight: share of OCR capacity relative to other tenants with queued work
+- rate / burst: token-bucket limit in scans per second and bucket size
+- priority: default lane, "interactive" (default) or "bulk"
+
+A key without a "tenant" name is named after a hash of the key, never the
+key itself, since tenant names show up in logs, metrics and the usage ledger.
+
+When no keys are configured the API stays open and every caller is treated
+as the "anonymous" tenant. The apps serving the web page (app_minimal.py,
+app_simple.py) let callers without a key in as well: they share the settings
+of the "" entry, or the unlimited anonymous tenant if there is none.
+"""
+
+import hashlib
+import heapq
+import itertools
+import json
+import os
+import threading
+import time
+from collections import deque
+from typing import Callable, Dict, Mapping, Optional, Tuple
+
+from latency_stats import percentiles
+
+API_KEYS_FILE = "api_keys.json"
+ANONYMOUS_TENANT = {"tenant": "anonymous", "weight": 1.0, "rate": 0, "burst": 0}
+DEFAULT_TENANT_SETTINGS = {"weight": 1.0, "rate": 0, "burst": 0}  # rate 0 = unlimited
+
+OCR_CONCURRENCY = int(os.environ.get('OCR_CONCURRENCY', 4))
+OCR_INTERACTIVE_RESERVED = int(os.environ.get('OCR_INTERACTIVE_RESERVED', 1))
+OCR_QUEUE_TIMEOUT = float(os.environ.get('OCR_QUEUE_TIMEOUT_SECONDS', 30))
+
+# Priority lanes: interactive uploads from the web page / Streamlit, bulk imports and backfills
+INTERACTIVE = "interactive"
+BULK = "bulk"
+PRIORITIES = (INTERACTIVE, BULK)
+
+
+def load_api_keys() -> Dict[str, Dict]:
+    """Load the API key -> tenant settings mapping from API_KEYS or api_keys.json."""
+    raw = os.environ.get('API_KEYS')
+    if not raw and os.path.exists(API_KEYS_FILE):
+        with open(API_KEYS_FILE) as f:
+            raw = f.read()
+    if not raw:
+        return {}
+    keys = {}
+    for key, settings in json.loads(raw).items():
+        if isinstance(settings, str):
+            settings = {"tenant": settings}
+        tenant = dict(DEFAULT_TENANT_SETTINGS)
+        tenant.update(settings)
+        if not tenant.get("tenant"):
+            tenant["tenant"] = f"key-{hashlib.sha256(key.encode()).hexdigest()[:12]}"
+        keys[key] = tenant
+    return keys
+
+
+def tenant_for_request(api_keys: Dict[str, Dict], headers: Mapping[str, str],
+                       allow_keyless: bool = False) -> Optional[Dict]:
+    """
+    The tenant of the key in X-API-Key (or Authorization: Bearer). Returns
+    None for an unknown key, and for a missing one unless allow_keyless.
+    """
+    if not api_keys:
+        return ANONYMOUS_TENANT
+    key = headers.get('X-API-Key')
+    if not key and headers.get('Authorization', '').startswith('Bearer '):
+        key = headers['Authorization'][len('Bearer '):].strip()
+    if not key:
+        return api_keys.get('', ANONYMOUS_TENANT) if allow_keyless else None
+    return api_keys.get(key)
+
+
+class TokenBucket:
+    """Classic token bucket: `rate` tokens per second up to `burst`."""
+
+    def __init__(self, rate: float, burst: float):
+        self.rate = float(rate)
+        self.burst = float(max(burst, 1))
+        self._tokens = self.burst
+        self._updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def try_acquire(self) -> float:
+        """Take a token. Returns 0 on success, else seconds until one is available."""
+        with self._lock:
+            now = time.monotonic()
+            self._tokens = min(self.burst, self._tokens + (now - self._updated) * self.rate)
+            self._updated = now
+            if self._tokens >= 1:
+                self._tokens -= 1
+                return 0.0
+            return (1 - self._tokens) / self.rate
+
+
+class RateLimiter:
+    """One token bucket per tenant, created on first use."""
+
+    def __init__(self):
+        self._buckets: Dict[str, TokenBucket] = {}
+        self._lock = threading.Lock()
+
+    def check(self, tenant: Dict) -> float:
+        if not tenant.get("rate"):
+            return 0.0
+        with self._lock:
+            bucket = self._buckets.get(tenant["tenant"])
+            if bucket is None:
+                bucket = TokenBucket(tenant["rate"], tenant.get("burst") or tenant["rate"])
+                self._buckets[tenant["tenant"]] = bucket
+        return bucket.try_acquire()
+
+
+class FairScheduler:
+    """
+    Weighted fair queue with priority lanes in front of a fixed number of OCR slots.
+
+    Within a lane, start-time fair queuing is used: each waiting request is
+    tagged with a virtual finish time of max(virtual clock, tenant's last tag)
+    + 1/weight and free slots go to the smallest tag. A tenant with a long
+    backlog therefore only gets its weighted share while others have work
+    queued, and can use every slot when it is alone.
+
+    Across lanes, interactive work always goes first. Bulk work only takes a
+    slot while no interactive request is waiting, and never more than
+    concurrency - reserved_interactive slots, so an arriving interactive scan
+    finds a free slot (or the next one to free up) instead of queueing behind
+    a backfill.
+    """
+
+    def __init__(self, concurrency: int = OCR_CONCURRENCY, reserved_interactive: int = OCR_INTERACTIVE_RESERVED):
+        self.concurrency = concurrency
+        self.reserved_interactive = min(reserved_interactive, max(concurrency - 1, 0))
+        self._cond = threading.Condition()
+        self._active = {lane: 0 for lane in PRIORITIES}
+        self._queues = {lane: [] for lane in PRIORITIES}
+        self._virtual_time = {lane: 0.0 for lane in PRIORITIES}
+        self._last_tag: Dict[tuple, float] = {}
+        self._seq = itertools.count()
+        self._depth: Dict[str, int] = {}
+        self._max_depth: Dict[str, int] = {}
+
+    def _can_start(self, ticket, lane: str) -> bool:
+        if self._queues[lane][0] is not ticket:
+            return False
+        active = sum(self._active.values())
+        if lane == INTERACTIVE:
+            return active < self.concurrency
+        return (not self._queues[INTERACTIVE]
+                and active < self.concurrency
+                and self._active[BULK] < self.concurrency - self.reserved_interactive)
+
+    def acquire(self, tenant: str, weight: float = 1.0, timeout: Optional[float] = OCR_QUEUE_TIMEOUT,
+                priority: str = INTERACTIVE, cancelled: Optional[Callable[[], bool]] = None,
+                poll_interval: float = 0.1) -> bool:
+        """
+        Wait for an OCR slot. Returns False if none was granted within timeout,
+        or once cancelled() (polled every poll_interval) returns true.
+        """
+        deadline = None if timeout is None else time.monotonic() + timeout
+        with self._cond:
+            queue = self._queues[priority]
+            tag = (max(self._virtual_time[priority], self._last_tag.get((priority, tenant), 0.0))
+                   + 1.0 / max(weight, 0.01))
+            self._last_tag[(priority, tenant)] = tag
+            ticket = [tag, next(self._seq), tenant]
+            heapq.heappush(queue, ticket)
+            self._depth[tenant] = self._depth.get(tenant, 0) + 1
+            self._max_depth[tenant] = max(self._max_depth.get(tenant, 0), self._depth[tenant])
+
+            while not self._can_start(ticket, priority):
+                remaining = None if deadline is None else deadline - time.monotonic()
+                if (remaining is not None and remaining <= 0) or (cancelled is not None and cancelled()):
+                    queue.remove(ticket)
+                    heapq.heapify(queue)
+                    self._depth[tenant] -= 1
+                    self._cond.notify_all()
+                    return False
+                if cancelled is not None:
+                    remaining = poll_interval if remaining is None else min(remaining, poll_interval)
+                self._cond.wait(remaining)
+
+            heapq.heappop(queue)
+            self._active[priority] += 1
+            self._virtual_time[priority] = tag
+            self._depth[tenant] -= 1
+            # The next ticket may also fit into a free slot
+            self._cond.notify_all()
+            return True
+
+    def release(self, priority: str = INTERACTIVE) -> None:
+        with self._cond:
+            self._active[priority] -= 1
+            self._cond.notify_all()
+
+    def run(self, tenant: Dict, work: Callable, priority: str = INTERACTIVE,
+            cancelled: Optional[Callable[[], bool]] = None) -> Optional[Tuple[object, float]]:
+        """
+        work() in a slot of the tenant's fair share. Returns (result, seconds
+        queued), or None if no slot was granted (see acquire).
+        """
+        queued_at = time.perf_counter()
+        if not self.acquire(tenant["tenant"], tenant.get("weight", 1.0), priority=priority, cancelled=cancelled):
+            return None
+        queue_wait = time.perf_counter() - queued_at
+        try:
+            return work(), queue_wait
+        finally:
+            self.release(priority)
+
+    def stats(self) -> Dict:
+        with self._cond:
+            return {
+                "concurrency": self.concurrency,
+                "reserved_interactive": self.reserved_interactive,
+                "active": dict(self._active),
+                "queued": {lane: len(queue) for lane, queue in self._queues.items()},
+                "queue_depth": dict(self._depth),
+                "max_queue_depth": dict(self._max_depth)
+            }
+
+
+def resolve_priority(tenant: Dict, requested: Optional[str]) -> str:
+    """
+    Pick the lane for a request. Any caller may downgrade itself to bulk; only
+    tenants whose default lane is interactive may run interactive scans.
+    """
+    default = tenant.get("priority", INTERACTIVE)
+    if default not in PRIORITIES:
+        default = INTERACTIVE
+    if requested == BULK:
+        return BULK
+    return default
+
+
+class TenantMetrics:
+    """Per-tenant request counts and latency percentiles over a recent window."""
+
+    def __init__(self, window: int = 1000):
+        self._window = window
+        self._lock = threading.Lock()
+        self._tenants: Dict[str, Dict] = {}
+
+    def _tenant(self, tenant: str) -> Dict:
+        if tenant not in self._tenants:
+            self._tenants[tenant] = {
+                "requests": 0, "rate_limited": 0, "queue_timeouts": 0, "cancelled": 0, "over_budget": 0,
+                "latencies": deque(maxlen=self._window), "queue_waits": deque(maxlen=self._window)
+            }
+        return self._tenants[tenant]
+
+    def record(self, tenant: str, latency: float, queue_wait: Optional[float] = None) -> None:
+        with self._lock:
+            entry = self._tenant(tenant)
+            entry["requests"] += 1
+            entry["latencies"].append(latency)
+            if queue_wait is not None:
+                entry["queue_waits"].append(queue_wait)
+
+    def count(self, tenant: str, counter: str) -> None:
+        with self._lock:
+            self._tenant(tenant)[counter] += 1
+
+    def stats(self) -> Dict:
+        with self._lock:
+            return {
+                tenant: {
+                    "requests": entry["requests"],
+                    "rate_limited": entry["rate_limited"],
+                    "queue_timeouts": entry["queue_timeouts"],
+                    "cancelled": entry["cancelled"],
+                    "over_budget": entry["over_budget"],
+                    "latency_ms": percentiles(entry["latencies"], scale=1000),
+                    "queue_wait_ms": percentiles(entry["queue_waits"], scale=1000)
+                }
+                for tenant, entry in self._tenants.items()
+            }
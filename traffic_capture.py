@@ -0,0 +1,209 @@
+"""
+Traffic capture
+===============
+
+Opt-in recording of production scan traffic, so worker counts, queue limits
+and other settings can be tested offline against real load shapes with
+replay_traffic.py.
+
+Configuration:
+
+    TRAFFIC_CAPTURE        "" (off, default), "meta" or "images"
+    TRAFFIC_CAPTURE_DIR    capture directory (default traffic_capture)
+    TRAFFIC_CAPTURE_RATE   share of /api/scan requests recorded (default 1.0)
+
+A capture directory holds:
+
+    requests.jsonl   one line per /api/scan request: arrival time, tenant,
+                     priority, image hash and size, status, latency, queue
+                     wait and OCR time (null when the result came from the
+                     cache or a coalesced call)
+    responses.jsonl  the Vision response (word boxes) and OCR latency of each
+                     distinct image, so replays need no Vision calls
+    images/          the images themselves, by hash ("images" mode only)
+
+RecordedVisionClient stands in for vision.ImageAnnotatorClient during a
+replay: it answers from responses.jsonl and takes the recorded OCR latency.
+"""
+
+import hashlib
+import json
+import logging
+import os
+import random
+import threading
+import time
+from types import SimpleNamespace
+from typing import Dict, Iterator, List, Optional
+
+logger = logging.getLogger(__name__)
+
+TRAFFIC_CAPTURE = os.environ.get('TRAFFIC_CAPTURE', '').lower()
+TRAFFIC_CAPTURE_DIR = os.environ.get('TRAFFIC_CAPTURE_DIR', 'traffic_capture')
+TRAFFIC_CAPTURE_RATE = float(os.environ.get('TRAFFIC_CAPTURE_RATE', 1.0))
+
+MODES = ('meta', 'images')
+
+
+class TrafficCapture:
+    """Appends request and OCR response records to a capture directory."""
+
+    def __init__(self, directory: str = TRAFFIC_CAPTURE_DIR, mode: str = 'meta',
+                 sample_rate: float = TRAFFIC_CAPTURE_RATE):
+        self.directory = directory
+        self.mode = mode
+        self.sample_rate = sample_rate
+        self._lock = threading.Lock()
+        self._seen_responses = set(record["image_hash"] for record in iter_responses(directory))
+        os.makedirs(os.path.join(directory, 'images'), exist_ok=True)
+        # Line buffered so a crashed worker loses at most the line being written
+        self._requests = open(os.path.join(directory, 'requests.jsonl'), 'a', buffering=1)
+        self._responses = open(os.path.join(directory, 'responses.jsonl'), 'a', buffering=1)
+
+    def sampled(self) -> bool:
+        return self.sample_rate >= 1 or random.random() < self.sample_rate
+
+    def record_request(self, **record) -> None:
+        line = json.dumps(record)
+        with self._lock:
+            self._requests.write(line + '\n')
+
+    def record_ocr(self, image_digest: str, image_bytes: bytes, annotations, ocr_ms: float) -> None:
+        """Keep the first Vision response (and in images mode the image) of every distinct image."""
+        with self._lock:
+            if image_digest in self._seen_responses:
+                return
+            self._seen_responses.add(image_digest)
+        line = json.dumps({"image_hash": image_digest, "ocr_ms": round(ocr_ms, 2),
+                           "annotations": annotations_to_json(annotations)})
+        with self._lock:
+            self._responses.write(line + '\n')
+        if self.mode == 'images':
+            path = image_path(self.directory, image_digest)
+            if not os.path.exists(path):
+                with open(path + '.tmp', 'wb') as f:
+                    f.write(image_bytes)
+                os.replace(path + '.tmp', path)
+
+    def close(self) -> None:
+        with self._lock:
+            self._requests.close()
+            self._responses.close()
+
+
+def open_traffic_capture() -> Optional[TrafficCapture]:
+    """The capture configured by TRAFFIC_CAPTURE, or None when capture is off."""
+    if not TRAFFIC_CAPTURE:
+        return None
+    if TRAFFIC_CAPTURE not in MODES:
+        logger.warning(f"Unknown TRAFFIC_CAPTURE {TRAFFIC_CAPTURE!r}, traffic capture is off")
+        return None
+    try:
+        return TrafficCapture(TRAFFIC_CAPTURE_DIR, TRAFFIC_CAPTURE)
+    except OSError as e:
+        logger.warning(f"Traffic capture disabled: {str(e)}")
+        return None
+
+
+def image_path(directory: str, image_digest: str) -> str:
+    return os.path.join(directory, 'images', image_digest)
+
+
+def annotations_to_json(annotations) -> List[Dict]:
+    """Vision text_annotations as plain lists: description plus box vertices."""
+    return [{"description": annotation.description,
+             "vertices": [[vertex.x, vertex.y] for vertex in annotation.bounding_poly.vertices]
+             if getattr(annotation, 'bounding_poly', None) else []}
+            for annotation in annotations]
+
+
+def annotations_from_json(records: List[Dict]) -> List[SimpleNamespace]:
+    """Objects shaped like Vision's EntityAnnotation, enough for the scan code."""
+    return [SimpleNamespace(description=record["description"],
+                            bounding_poly=SimpleNamespace(vertices=[SimpleNamespace(x=x, y=y)
+                                                                    for x, y in record["vertices"]]))
+            for record in records]
+
+
+def _iter_jsonl(path: str) -> Iterator[Dict]:
+    try:
+        with open(path) as f:
+            for line in f:
+                try:
+                    yield json.loads(line)
+                except ValueError:
+                    continue  # torn last line of a capture that was still being written
+    except FileNotFoundError:
+        return
+
+
+def iter_requests(directory: str) -> Iterator[Dict]:
+    return _iter_jsonl(os.path.join(directory, 'requests.jsonl'))
+
+
+def iter_responses(directory: str) -> Iterator[Dict]:
+    return _iter_jsonl(os.path.join(directory, 'responses.jsonl'))
+
+
+def load_requests(directory: str) -> List[Dict]:
+    """The captured requests in arrival order."""
+    return sorted(iter_requests(directory), key=lambda record: record["arrived_at"])
+
+
+def replay_payload(directory: str, record: Dict) -> bytes:
+    """
+    The image to send for a captured request: the captured image if there is
+    one, otherwise deterministic filler of the recorded size (the same hash
+    always gives the same bytes, so cache hits and coalescing replay as
+    recorded).
+    """
+    try:
+        with open(image_path(directory, record["image_hash"]), 'rb') as f:
+            return f.read()
+    except (FileNotFoundError, TypeError):
+        pass
+    return random.Random(record["image_hash"]).randbytes(max(record.get("image_bytes") or 0, 1))
+
+
+class RecordedVisionClient:
+    """
+    Drop-in for vision.ImageAnnotatorClient that answers text_detection from a
+    capture and sleeps the recorded OCR latency divided by `speed`. Images
+    the capture has no response for get an empty result after the median
+    recorded latency.
+    """
+
+    def __init__(self, directory: str, speed: float = 1.0):
+        self.speed = speed
+        self.responses: Dict[str, Dict] = {record["image_hash"]: record for record in iter_responses(directory)}
+        latencies = sorted(record["ocr_ms"] for record in self.responses.values())
+        self.default_ms = latencies[len(latencies) // 2] if latencies else 0.0
+        # Replays without captured images send filler bytes; map their hashes back
+        self.aliases: Dict[str, str] = {}
+        mapped = set()
+        for record in iter_requests(directory):
+            digest = record.get("image_hash")
+            if digest and digest not in mapped and not os.path.exists(image_path(directory, digest)):
+                mapped.add(digest)
+                self.aliases[hashlib.sha256(replay_payload(directory, record)).hexdigest()] = digest
+        self.calls = 0
+
+    def __call__(self, *args, **kwargs) -> 'RecordedVisionClient':
+        # Installed in place of the client class, so "constructing" one returns this instance
+        return self
+
+    def text_detection(self, image=None, **kwargs):
+        self.calls += 1
+        digest = hashlib.sha256(image.content).hexdigest()
+        record = self.responses.get(self.aliases.get(digest, digest))
+        time.sleep((record["ocr_ms"] if record else self.default_ms) / 1000 / self.speed)
+        annotations = annotations_from_json(record["annotations"]) if record else []
+        return SimpleNamespace(text_annotations=annotations, error=SimpleNamespace(message=""))
+
+
+def install_recorded_vision(directory: str, speed: float = 1.0) -> RecordedVisionClient:
+    """Make every vision.ImageAnnotatorClient() in this process a RecordedVisionClient."""
+    from google.cloud import vision
+    client = RecordedVisionClient(directory, speed)
+    vision.ImageAnnotatorClient = client
+    return client
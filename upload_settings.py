@@ -0,0 +1,36 @@
+"""
+Upload settings
+===============
+
+Targets the browser upload page uses to shrink photos before posting them to
+/api/scan. Vision reads receipt text reliably well below full phone camera
+resolution, so downscaling on the device cuts upload time on cellular
+connections without hurting OCR.
+
+When the OCR budget is nearly spent (see ocr_budget.py) the apps ask for
+the reduced targets, UPLOAD_REDUCED_MAX_DIMENSION and UPLOAD_REDUCED_QUALITY.
+
+Each value can be overridden with an environment variable.
+"""
+
+import os
+from typing import Dict
+
+MAX_UPLOAD_BYTES = 10 * 1024 * 1024
+
+
+def get_upload_settings(reduced: bool = False) -> Dict:
+    """Return the client-side resize and re-encode parameters (the smaller ones when reduced)."""
+    formats = os.environ.get('UPLOAD_FORMATS', 'image/webp,image/jpeg')
+    max_dimension = int(os.environ.get('UPLOAD_MAX_DIMENSION', 2048))
+    quality = float(os.environ.get('UPLOAD_QUALITY', 0.85))
+    if reduced:
+        max_dimension = min(max_dimension, int(os.environ.get('UPLOAD_REDUCED_MAX_DIMENSION', 1280)))
+        quality = min(quality, float(os.environ.get('UPLOAD_REDUCED_QUALITY', 0.7)))
+    return {
+        "max_dimension": max_dimension,
+        "quality": quality,
+        "formats": [f.strip() for f in formats.split(',') if f.strip()],
+        "max_upload_bytes": MAX_UPLOAD_BYTES,
+        "reduced": reduced
+    }
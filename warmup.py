@@ -0,0 +1,211 @@
+"""
+Worker warm-up
+==============
+
+Liveness and readiness for the Flask apps. A worker is live as soon as it
+answers, but only ready once it has done the work the first scan would
+otherwise pay for:
+
+- imported the Google client libraries (and Pillow for the prescreen)
+- created its shared Vision client, parsed the credentials, fetched an
+  access token and opened the TLS/gRPC channel (optionally verified with a
+  real OCR call on a tiny image, WARMUP_OCR_PROBE=true, counted by the
+  spend governor under the tenant "warmup" and skipped when over budget)
+- run the extractors over a built-in sample receipt, which compiles and
+  exercises their regular expressions
+
+The steps run in a background thread started by install_warmup(). Failed
+steps are retried every WARMUP_RETRY_SECONDS, so a worker that starts
+before its credentials are reachable becomes ready once they are.
+
+    GET /api/live    200 while the process is up
+    GET /api/ready   200 once warm, 503 with the step status until then
+
+Point the platform's readiness/health check at /api/ready so traffic only
+reaches warm workers. WARMUP_ENABLED=false skips the warm-up (ready at once).
+"""
+
+import base64
+import importlib
+import logging
+import multiprocessing
+import os
+import threading
+import time
+from typing import Callable, Dict, List, Optional, Tuple
+
+from flask import Flask, jsonify
+
+logger = logging.getLogger(__name__)
+
+WARMUP_ENABLED = os.environ.get('WARMUP_ENABLED', 'true').lower() not in ('0', 'false', 'no')
+WARMUP_RETRY_SECONDS = float(os.environ.get('WARMUP_RETRY_SECONDS', 10))
+WARMUP_CHANNEL_TIMEOUT = float(os.environ.get('WARMUP_CHANNEL_TIMEOUT', 10))
+WARMUP_OCR_PROBE = os.environ.get('WARMUP_OCR_PROBE', 'false').lower() in ('1', 'true', 'yes')
+
+SAMPLE_RECEIPT = """COSTCO WHOLESALE
+Victoria #1234
+KIRKLAND WATER 5.99
+ORGANIC EGGS 8.49
+SUBTOTAL 14.48
+TAX 0.72
+**** TOTAL 15.20
+MASTERCARD $15.20
+2025/08/11 12:34:56
+"""
+
+WARMUP_TENANT = "warmup"
+
+# 1x1 white PNG for the optional OCR probe
+PROBE_IMAGE = base64.b64decode(
+    "iVBORw0KGgoAAAANSUhEUgAAAAEAAAABCAAAAAA6fptVAAAACklEQVR4nGP4DwABAQEAWfjlSQAAAABJRU5ErkJggg==")
+
+Step = Tuple[str, Callable[[], Optional[str]]]
+
+
+class Warmup:
+    """Runs the warm-up steps once each (retrying failures) and reports readiness."""
+
+    def __init__(self, steps: List[Step], retry_seconds: float = WARMUP_RETRY_SECONDS):
+        self.steps = steps
+        self.retry_seconds = retry_seconds
+        self.results: Dict[str, Dict] = {name: {"ok": False, "status": "pending"} for name, _ in steps}
+        self.started_at = time.time()
+        self.ready_at: Optional[float] = None
+        self._lock = threading.Lock()
+
+    @property
+    def ready(self) -> bool:
+        return self.ready_at is not None
+
+    def start(self) -> None:
+        threading.Thread(target=self.run, name="warmup", daemon=True).start()
+
+    def run(self) -> None:
+        while True:
+            for name, step in self.steps:
+                if self.results[name]["ok"]:
+                    continue
+                started = time.perf_counter()
+                try:
+                    detail = step()
+                    result = {"ok": True, "status": "done"}
+                    if detail:
+                        result["detail"] = detail
+                except Exception as e:
+                    result = {"ok": False, "status": "failed", "error": f"{type(e).__name__}: {str(e)}"}
+                    if result["error"] != self.results[name].get("error"):  # once per distinct failure
+                        logger.warning(f"Warm-up step {name} failed: {str(e)}")
+                result["ms"] = round((time.perf_counter() - started) * 1000, 1)
+                with self._lock:
+                    self.results[name] = result
+            if all(result["ok"] for result in self.results.values()):
+                self.ready_at = time.time()
+                logger.info(f"Worker ready after {self.ready_at - self.started_at:.2f}s of warm-up")
+                return
+            time.sleep(self.retry_seconds)
+
+    def status(self) -> Dict:
+        with self._lock:
+            steps = {name: dict(result) for name, result in self.results.items()}
+        return {
+            "status": "ready" if self.ready else "warming",
+            "warmup_seconds": round((self.ready_at or time.time()) - self.started_at, 2),
+            "steps": steps
+        }
+
+
+def import_modules(*names: str) -> Callable[[], str]:
+    """Step importing modules; names ending in '?' are optional."""
+    def step():
+        skipped = []
+        for name in names:
+            try:
+                importlib.import_module(name.rstrip('?'))
+            except ImportError:
+                if not name.endswith('?'):
+                    raise
+                skipped.append(name.rstrip('?'))
+        return f"not installed: {', '.join(skipped)}" if skipped else None
+    return step
+
+
+def warm_vision_client(get_client: Callable[[], object], timeout: float = WARMUP_CHANNEL_TIMEOUT,
+                       probe: bool = WARMUP_OCR_PROBE, governor=None) -> Callable[[], str]:
+    """
+    Step creating the shared client, fetching an access token and waiting for
+    the gRPC channel to connect, plus an OCR call on PROBE_IMAGE if `probe`.
+    The probe is billed like any Vision call, so it goes through `governor`
+    (an ocr_budget.SpendGovernor) when one is given.
+    """
+    def step():
+        client = get_client()
+        if client is None:
+            raise RuntimeError("Vision client could not be created")
+        done = []
+        transport = getattr(client, 'transport', None)
+        credentials = getattr(transport, '_credentials', None)
+        if credentials is not None and hasattr(credentials, 'refresh') and not getattr(credentials, 'valid', True):
+            from google.auth.transport.requests import Request
+            credentials.refresh(Request())
+            done.append("token")
+        channel = getattr(transport, 'grpc_channel', None)
+        if channel is not None:
+            import grpc
+            grpc.channel_ready_future(channel).result(timeout=timeout)
+            done.append("channel")
+        if probe:
+            from google.cloud import vision
+            from ocr_backends import backend_cost
+            from ocr_budget import BudgetExceeded
+            from tenant_scheduler import BULK
+            cost = backend_cost("vision")
+            try:
+                if governor:
+                    governor.admit(WARMUP_TENANT, "vision", cost, BULK)
+            except BudgetExceeded:
+                done.append("probe skipped (OCR budget)")
+            else:
+                try:
+                    response = client.text_detection(image=vision.Image(content=PROBE_IMAGE))
+                except Exception:
+                    if governor:
+                        governor.refund(WARMUP_TENANT, "vision", cost)
+                    raise
+                if response.error.message:
+                    raise RuntimeError(f"Vision API error: {response.error.message}")
+                done.append("probe")
+        return ', '.join(done) or "client created"
+    return step
+
+
+def warm_extractors(extract: Callable[[str], Dict]) -> Callable[[], str]:
+    """Step running the extractors over SAMPLE_RECEIPT; they must find all three fields."""
+    def step():
+        fields = extract(SAMPLE_RECEIPT)
+        missing = [name for name, value in fields.items() if not value]
+        if missing:
+            raise RuntimeError(f"sample receipt gave no {', '.join(missing)}")
+        return None
+    return step
+
+
+def install_warmup(app: Flask, steps: List[Step], enabled: Optional[bool] = None) -> Warmup:
+    """Register /api/live and /api/ready on a Flask app and start warming up in the background."""
+    if multiprocessing.current_process().name != 'MainProcess':
+        # The app module re-imported by a spawned image pool worker (python app.py): nothing to
+        # serve. parent_process() is not set yet while the worker imports the main module
+        enabled = False
+    warmup = Warmup(steps if (WARMUP_ENABLED if enabled is None else enabled) else [])
+
+    def live():
+        return jsonify({"status": "alive"})
+
+    def ready():
+        status = warmup.status()
+        return jsonify(status), 200 if warmup.ready else 503
+
+    app.add_url_rule('/api/live', 'live', live)
+    app.add_url_rule('/api/ready', 'ready', ready)
+    warmup.start()
+    return warmup
@@ -0,0 +1,294 @@
+"""
+Watch-folder ingestion
+======================
+
+Scans receipt images as scanners drop them into a shared directory.
+
+- New files are noticed with inotify when the optional inotify_simple
+  package is available on Linux. Otherwise the directory is polled.
+- A file is processed only once its size and mtime have been stable for
+  settle_seconds. This skips files that are still being copied or written
+  over a network share.
+- At most `workers` images are scanned at a time.
+- Every scanned image is appended, with its result, to a JSON Lines
+  checkpoint keyed by the SHA-256 of its contents. After a restart (or if
+  the same receipt is dropped again) it is not scanned a second time.
+- Finished files are moved to a processed/ folder, or failed/ when the file
+  cannot be read or no OCR backend can make sense of the image ("move").
+  They can instead be tagged with a user.receipt_scan extended attribute
+  ("tag") or left in place ("keep").
+- A scan that raises an exception with a retry_after (e.g. the OCR budget
+  deferring bulk work) leaves the file where it is; it is scanned again
+  after that many seconds.
+- Any other error (network, credentials, an OCR outage) is taken as
+  transient: the file stays where it is and is retried after retry_seconds,
+  doubling on each further failure up to max_retry_seconds.
+"""
+
+import json
+import logging
+import os
+import shutil
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timezone
+from typing import Callable, Dict, Optional
+
+from scan_coalescing import image_hash
+
+try:
+    from inotify_simple import INotify, flags as inotify_flags
+except ImportError:
+    INotify = None
+
+try:
+    from google.api_core.exceptions import InvalidArgument
+except ImportError:
+    InvalidArgument = None
+
+from ocr_backends import OcrError
+
+# Errors that mean the image itself is bad, so retrying it cannot help
+INVALID_IMAGE_ERRORS = (OcrError, InvalidArgument) if InvalidArgument else (OcrError,)
+
+logger = logging.getLogger(__name__)
+
+IMAGE_EXTENSIONS = ('.jpg', '.jpeg', '.png', '.webp', '.gif', '.bmp', '.tif', '.tiff')
+CHECKPOINT_FILE = 'scan_checkpoint.jsonl'
+TAG_ATTRIBUTE = 'user.receipt_scan'
+
+
+class FolderWatcher:
+    """Watch one directory and scan each new, fully written image exactly once."""
+
+    def __init__(self, directory: str, scan: Callable[[bytes, str], Dict], workers: int = 4,
+                 settle_seconds: float = 2.0, poll_interval: float = 1.0, on_done: str = 'move',
+                 checkpoint_path: Optional[str] = None, use_inotify: bool = True,
+                 retry_seconds: float = 30.0, max_retry_seconds: float = 900.0):
+        if on_done not in ('move', 'tag', 'keep'):
+            raise ValueError(f"on_done must be 'move', 'tag' or 'keep', not {on_done!r}")
+        self.directory = os.path.abspath(directory)
+        self.scan = scan
+        self.workers = workers
+        self.settle_seconds = settle_seconds
+        self.poll_interval = poll_interval
+        self.on_done = on_done
+        self.retry_seconds = retry_seconds
+        self.max_retry_seconds = max_retry_seconds
+        self.checkpoint_path = checkpoint_path or os.path.join(self.directory, CHECKPOINT_FILE)
+        self.processed_dir = os.path.join(self.directory, 'processed')
+        self.failed_dir = os.path.join(self.directory, 'failed')
+        self.use_inotify = use_inotify and INotify is not None
+        self._done = self._load_checkpoint()
+        # Shared by the watch loop and the scan workers: only touched under _lock
+        self._pending: Dict[str, tuple] = {}  # path -> (size, mtime_ns, stable since)
+        self._in_flight = set()  # paths and content hashes being scanned
+        self._handled: Dict[str, tuple] = {}  # path -> (size, mtime_ns) of files left in place
+        self._failures: Dict[str, int] = {}  # path -> transient failures in a row
+        self._lock = threading.Lock()
+        self._slots = threading.BoundedSemaphore(workers)
+        self._stop = threading.Event()
+        self.stats = {"scanned": 0, "duplicates": 0, "failed": 0, "deferred": 0, "retried": 0}
+
+    def _load_checkpoint(self) -> set:
+        done = set()
+        if os.path.exists(self.checkpoint_path):
+            with open(self.checkpoint_path) as f:
+                for line in f:
+                    try:
+                        done.add(json.loads(line)["image_hash"])
+                    except (ValueError, KeyError):
+                        continue  # torn last line after a crash
+        return done
+
+    def _write_checkpoint(self, entry: Dict) -> None:
+        with self._lock:
+            with open(self.checkpoint_path, 'a') as f:
+                f.write(json.dumps(entry) + '\n')
+                f.flush()
+                os.fsync(f.fileno())
+            self._done.add(entry["image_hash"])
+
+    def _candidate(self, path: str) -> bool:
+        name = os.path.basename(path)
+        return (name.lower().endswith(IMAGE_EXTENSIONS) and not name.startswith('.')
+                and os.path.dirname(path) == self.directory)
+
+    def _notice(self, path: str) -> None:
+        """Start (or restart) the settle timer for a file that appeared or changed."""
+        if not self._candidate(path):
+            return
+        try:
+            stat = os.stat(path)
+        except FileNotFoundError:
+            with self._lock:
+                self._pending.pop(path, None)
+            return
+        with self._lock:
+            if self._handled.get(path) == (stat.st_size, stat.st_mtime_ns):
+                return
+        if self.on_done == 'tag' and _tagged(path):
+            return
+        with self._lock:
+            seen = self._pending.get(path)
+            if seen is None or seen[:2] != (stat.st_size, stat.st_mtime_ns):
+                self._pending[path] = (stat.st_size, stat.st_mtime_ns, time.monotonic())
+
+    def _scan_directory(self) -> None:
+        with os.scandir(self.directory) as entries:
+            for entry in entries:
+                if entry.is_file():
+                    self._notice(entry.path)
+
+    def _ready_files(self):
+        """Files whose size and mtime have not changed for settle_seconds."""
+        now = time.monotonic()
+        with self._lock:
+            waiting = [path for path in self._pending if path not in self._in_flight]
+        for path in waiting:
+            self._notice(path)
+            with self._lock:
+                seen = self._pending.get(path)
+            if seen and now - seen[2] >= self.settle_seconds and seen[0] > 0:
+                yield path
+
+    def _process(self, path: str) -> None:
+        content = None
+        digest = None
+        retry_at = None
+        try:
+            with open(path, 'rb') as f:
+                content = f.read()
+            digest = image_hash(content)
+            with self._lock:
+                duplicate = digest in self._done or digest in self._in_flight
+                if not duplicate:
+                    self._in_flight.add(digest)
+            if duplicate:
+                logger.info(f"{os.path.basename(path)} was already scanned, skipping")
+                self._count("duplicates")
+                self._finish(path, digest)
+                return
+            result = self.scan(content, path)
+            self._write_checkpoint({
+                "image_hash": digest,
+                "file": os.path.basename(path),
+                "scanned_at": datetime.now(timezone.utc).isoformat(timespec='seconds'),
+                "result": result
+            })
+            self._count("scanned")
+            logger.info(f"Scanned {os.path.basename(path)}: {result}")
+            self._finish(path, digest)
+        except Exception as e:
+            retry_after = getattr(e, 'retry_after', None)
+            if retry_after:
+                self._count("deferred")
+                logger.info(f"Deferred {os.path.basename(path)} for {int(retry_after)}s: {str(e)}")
+                retry_at = time.monotonic() + retry_after
+            elif content is None or isinstance(e, INVALID_IMAGE_ERRORS):
+                # Unreadable file or an image no backend can read: retrying will not help
+                self._count("failed")
+                logger.error(f"Failed to scan {os.path.basename(path)}: {str(e)}")
+                if self.on_done == 'move' and os.path.exists(path):
+                    _move(path, self.failed_dir)
+            else:
+                with self._lock:
+                    failures = self._failures.get(path, 0) + 1
+                    self._failures[path] = failures
+                delay = min(self.retry_seconds * 2 ** (failures - 1), self.max_retry_seconds)
+                self._count("retried")
+                logger.warning(f"Could not scan {os.path.basename(path)} (attempt {failures}), "
+                               f"retrying in {delay:g}s: {str(e)}")
+                retry_at = time.monotonic() + delay
+        finally:
+            # Whatever stays in the folder (kept, tagged or failed) is not picked up
+            # again until it changes; a deferred file settles again from retry_at
+            try:
+                stat = os.stat(path)
+            except FileNotFoundError:
+                stat = None
+            with self._lock:
+                if stat and retry_at:
+                    self._pending[path] = (stat.st_size, stat.st_mtime_ns, retry_at)
+                else:
+                    self._failures.pop(path, None)
+                    if stat:
+                        self._handled[path] = (stat.st_size, stat.st_mtime_ns)
+                    self._pending.pop(path, None)
+                self._in_flight.discard(path)
+                self._in_flight.discard(digest)
+            self._slots.release()
+
+    def _count(self, outcome: str) -> None:
+        with self._lock:
+            self.stats[outcome] += 1
+
+    def _finish(self, path: str, digest: str) -> None:
+        if self.on_done == 'move':
+            _move(path, self.processed_dir)
+        elif self.on_done == 'tag':
+            try:
+                os.setxattr(path, TAG_ATTRIBUTE, digest.encode())
+            except (AttributeError, OSError):
+                pass  # no xattr support here; the checkpoint still prevents a rescan
+
+    def _dispatch(self, pool: ThreadPoolExecutor) -> None:
+        for path in self._ready_files():
+            if not self._slots.acquire(blocking=False):
+                return  # all workers busy; the file stays pending
+            with self._lock:
+                self._in_flight.add(path)
+            pool.submit(self._process, path)
+
+    def run(self) -> None:
+        """Watch until stop() is called, then wait for scans in progress."""
+        os.makedirs(self.directory, exist_ok=True)
+        inotify = None
+        if self.use_inotify:
+            inotify = INotify()
+            inotify.add_watch(self.directory, inotify_flags.CLOSE_WRITE | inotify_flags.MOVED_TO
+                              | inotify_flags.CREATE | inotify_flags.MODIFY)
+        logger.info(f"Watching {self.directory} ({'inotify' if inotify else 'polling'}, "
+                    f"{self.workers} workers, {len(self._done)} images already scanned)")
+        self._scan_directory()
+        last_poll = time.monotonic()
+        with ThreadPoolExecutor(max_workers=self.workers) as pool:
+            try:
+                while not self._stop.is_set():
+                    if inotify:
+                        for event in inotify.read(timeout=int(self.poll_interval * 500)):
+                            if event.name:
+                                self._notice(os.path.join(self.directory, event.name))
+                        # An occasional full listing catches anything inotify missed
+                        # (e.g. files written on another host of a network share)
+                        if time.monotonic() - last_poll >= 60:
+                            self._scan_directory()
+                            last_poll = time.monotonic()
+                    else:
+                        self._stop.wait(self.poll_interval)
+                        self._scan_directory()
+                    self._dispatch(pool)
+            finally:
+                if inotify:
+                    inotify.close()
+        logger.info(f"Stopped watching {self.directory}: {self.stats}")
+
+    def stop(self) -> None:
+        self._stop.set()
+
+
+def _tagged(path: str) -> bool:
+    try:
+        return bool(os.getxattr(path, TAG_ATTRIBUTE))
+    except (AttributeError, OSError):
+        return False
+
+
+def _move(path: str, folder: str) -> None:
+    os.makedirs(folder, exist_ok=True)
+    target = os.path.join(folder, os.path.basename(path))
+    if os.path.exists(target):
+        stem, ext = os.path.splitext(os.path.basename(path))
+        target = os.path.join(folder, f"{stem}-{int(time.time())}{ext}")
+    shutil.move(path, target)